@@ -1,16 +1,28 @@
-from flask import render_template, request, redirect, url_for, make_response, jsonify
+from flask import render_template, request, redirect, url_for, make_response, jsonify, Response, send_file, stream_with_context
 from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required, JWTManager
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.http import is_resource_modified
 from psycopg2.errors import UniqueViolation
 from flask_cors import cross_origin
 from flasgger.utils import swag_from
 from flasgger import Swagger
-from datetime import datetime
-from string import Template
-import json, os
+from functools import wraps
+from datetime import date, datetime
+import json, os, time
 
 from app.feedback import *
 from app.assistant import *
+from app.metrics import instrument, render_metrics
+from app.events import change_broker, stream_site_events
+from app.export import EXPORT_FORMATS, parse_export_args, stream_export
+from app.jobs import (fail_interrupted_jobs, get_jobs, get_result_path,
+                      parse_job_params, submit_job)
+from app.replicas import READ_PRIMARY_SECONDS, REPLICA_URIS
+from app.serialization import (RESERVATION_LIST_ENCODER,
+                               iter_reservation_rows, stream_rows)
+
+READ_PRIMARY_COOKIE = "read_primary_until"
+READ_PRIMARY_HEADER = "X-Read-Primary-Until"
 
 app.config["SWAGGER"] = {"title": "WCG-API", "universion": 1}
 app.config['SECRET_KEY'] = os.getenv("SECRET_KEY")
@@ -44,11 +56,142 @@ swagger_config = {
     "/api-doc/",
 }
 swagger = Swagger(app, config=swagger_config)
+instrument(app)
+
+
+def privilege_required(admin=False):
+    """Require a jwt token of a user with privileges to invoke the endpoint.
+
+    The privileges are read through the cache of get_user_privileges(), so
+    most requests are authorized without a database round trip.
+
+    Args:
+        admin (bool): True to allow admin users only
+    """
+
+    def decorator(view):
+
+        @wraps(view)
+        @jwt_required()
+        def wrapper(*args, **kwargs):
+            is_admin, has_privilege = get_user_privileges(get_jwt_identity())
+            if not is_admin and (admin or not has_privilege):
+                return {
+                    "feedback": AUTHENTICATION_FEEDBACK["unauthenticated"]
+                }
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def read_replica():
+    """Let a read-only endpoint read from a replica, see app/replicas.py.
+
+    A client whose READ_PRIMARY_COOKIE or READ_PRIMARY_HEADER is still
+    valid wrote recently and reads from the primary, as does everyone while
+    no replica is readable.
+    """
+
+    def decorator(view):
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                read_primary = max(
+                    float(request.cookies.get(READ_PRIMARY_COOKIE, 0)),
+                    float(request.headers.get(READ_PRIMARY_HEADER,
+                                              0))) > time.time()
+            except ValueError:
+                read_primary = False
+            if not read_primary:
+                g.replica_bind = db.choose_replica(app)
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@app.after_request
+def stick_to_primary(response):
+    """Send the clients that wrote to the primary for READ_PRIMARY_SECONDS,
+    so their next reads see their writes.
+
+    The clients without cookies send the READ_PRIMARY_HEADER of the
+    response back on their reads instead.
+    """
+    if REPLICA_URIS and request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        read_primary_until = str(time.time() + READ_PRIMARY_SECONDS)
+        response.set_cookie(READ_PRIMARY_COOKIE,
+                            read_primary_until,
+                            max_age=int(READ_PRIMARY_SECONDS) + 1,
+                            httponly=True)
+        response.headers[READ_PRIMARY_HEADER] = read_primary_until
+    return response
+
+
+def parse_page_args(default_limit=None):
+    """Read the keyset pagination parameters of the current request.
+
+    Args:
+        default_limit (int): the page size when "limit" is not given
+
+    Returns:
+        tuple: (after, limit, feedback) where feedback is None when the
+            parameters are valid
+    """
+    try:
+        after = int(request.args.get('after', 0))
+        limit = request.args.get('limit')
+        limit = int(limit) if limit is not None else default_limit
+    except ValueError:
+        return 0, default_limit, PAGINATION_FEEDBACK["invalid_cursor"]
+
+    if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+        return after, default_limit, PAGINATION_FEEDBACK["invalid_limit"]
+    return after, limit, None
+
+
+def conditional_response(kind, citizen_id, version, render):
+    """Answer a GET about a citizen, with a 304 when the client is current.
+
+    The ETag and Last-Modified come from the citizen's version, so an
+    If-None-Match or If-Modified-Since request is answered without loading
+    the citizen, and the body is served from get_cached_response().
+
+    Args:
+        kind (str): one of RESPONSE_KINDS
+        citizen_id (int): id of the citizen
+        version (tuple): (id, version, updated_at) from get_citizen_version()
+        render (function): returns the body when it is not cached
+    """
+    row_id, row_version, updated_at = version
+    etag = "{}-{}".format(row_id, row_version)
+    if is_resource_modified(request.environ, etag, last_modified=updated_at):
+        response = Response(
+            get_cached_response(kind, citizen_id, (row_id, row_version),
+                                render))
+    else:
+        response = Response(status=304)
+    response.set_etag(etag)
+    response.last_modified = updated_at
+    response.cache_control.no_cache = True
+    return response
+
+
+def stream_database_page(**context):
+    """Stream the database.html template while its rows are being read."""
+    app.update_template_context(context)
+    template = app.jinja_env.get_template('database.html')
+    return Response(stream_with_context(template.generate(context)))
 
 
 @app.route('/registration/<citizen_id>', methods=['GET'])
 @cross_origin()
 @swag_from("swagger/singleID.yml")
+@read_replica()
 def citizen_get_by_citizen_id(citizen_id):
     """Get the citizen information.
     
@@ -57,6 +200,8 @@ def citizen_get_by_citizen_id(citizen_id):
 
     Response Codes:
         200: get citizen information successfully
+        304: the citizen has not changed since the If-None-Match ETag or
+            the If-Modified-Since date
         404: invalid citizen id or the citizen is not registered
 
     Returns:
@@ -77,23 +222,25 @@ def citizen_get_by_citizen_id(citizen_id):
             - citizen not register or in database
     """
 
-    if not is_citizen_id(citizen_id):
+    citizen_id = parse_citizen_id(citizen_id)
+    if citizen_id is None:
         logger.error(REPORT_FEEDBACK["invalid_id"])
         return redirect(url_for('citizen'), 404)
 
-    if not is_registered(citizen_id):
+    version = get_citizen_version(citizen_id)
+    if version is None:
         logger.error(REPORT_FEEDBACK["not_registered"])
         return redirect(url_for('citizen'), 404)
 
-    person = get_citizen(citizen_id)
-    personal_data = person.get_dict()
-    logger.info("{} - get citizen data".format(citizen_id))
-    return json.dumps(personal_data, ensure_ascii=False)
+    logger.info("%s - get citizen data", citizen_id)
+    return conditional_response(
+        "citizen", citizen_id, version, lambda: json.dumps(
+            get_citizen(citizen_id).get_dict(), ensure_ascii=False))
 
 
 @app.route('/registration', methods=['POST'])
 @cross_origin()
-@jwt_required()
+@privilege_required()
 @swag_from("swagger/regispost.yml")
 def registration():
     """Register a citizen into the database.
@@ -127,110 +274,112 @@ def registration():
         json data: the feedback for unauthenticated usage of this endpoint
     """
 
-    user = Users.query.filter_by(username=get_jwt_identity()).first()
-    if not user.has_privilege and not user.is_admin:
-        return {"feedback": AUTHENTICATION_FEEDBACK["unauthenticated"]}
-
-    citizen_id = request.values['citizen_id']
-    name = request.values['name']
-    surname = request.values['surname']
-    birth_date = request.values['birth_date']
-    occupation = request.values['occupation']
-    phone_number = request.values['phone_number']
-    is_risk = request.values['is_risk']
-    address = request.values['address']
-
-    if not (citizen_id and name and surname and birth_date and occupation
-            and phone_number and is_risk and address):
-        logger.error(REGISTRATION_FEEDBACK["missing_key"])
-        return {"feedback": REGISTRATION_FEEDBACK["missing_key"]}
-
-    if not is_citizen_id(citizen_id):
-        logger.error(REGISTRATION_FEEDBACK["invalid_id"])
-        return {"feedback": REGISTRATION_FEEDBACK["invalid_id"]}
-
-    if not is_phone_number(phone_number):
-        logger.error(REGISTRATION_FEEDBACK["invalid_phone_number"])
-        return {"feedback": REGISTRATION_FEEDBACK["invalid_phone_number"]}
-
-    if is_registered(citizen_id):
-        logger.error(REGISTRATION_FEEDBACK["registered"])
-        return {"feedback": REGISTRATION_FEEDBACK["registered"]}
-
-    if is_phoned(phone_number):
-        logger.error(REGISTRATION_FEEDBACK["phoned"])
-        return {"feedback": REGISTRATION_FEEDBACK["phoned"]}
-
-    try:
-        birth_date = parsing_date(birth_date)
-        if delta_year(birth_date) <= 12:
-            logger.error(REGISTRATION_FEEDBACK["invalid_age"])
-            return {"feedback": REGISTRATION_FEEDBACK["invalid_age"]}
-    except ValueError:
-
-        logger.error(REGISTRATION_FEEDBACK["invalid_birthdate"])
-        return {"feedback": REGISTRATION_FEEDBACK["invalid_birthdate"]}
-
-    # TODO: check phone_number
+    feedback_key, row = validate_registration(request.values)
+    if feedback_key:
+        logger.error(REGISTRATION_FEEDBACK[feedback_key])
+        return {"feedback": REGISTRATION_FEEDBACK[feedback_key]}
 
+    # the unique constraints on citizen_id and phone_number reject duplicates
     try:
-        data = Citizen(int(citizen_id), name, surname, birth_date, occupation,
-                       phone_number, (is_risk == "true"), address)
+        data = Citizen(**row)
+        registration_data = data.get_dict()
         db.session.add(data)
         db.session.commit()
-    except:
+    except Exception as e:
         db.session.rollback()
-        logger.error(REGISTRATION_FEEDBACK["other"])
-        return {"feedback": REGISTRATION_FEEDBACK["other"]}
+        feedback = REGISTRATION_FEEDBACK[get_violation_key(e, "other")]
+        logger.error(feedback)
+        return {"feedback": feedback}
 
-    registration_data = data.get_dict()
     registration_data["feedback"] = REGISTRATION_FEEDBACK["success"]
     return json.dumps(registration_data, ensure_ascii=False), 201, {
         'Location':
         url_for('citizen_get_by_citizen_id',
-                citizen_id=data.citizen_id,
+                citizen_id=request.values['citizen_id'],
                 _external=True)
     }
 
 
+@app.route('/registration/batch', methods=['POST'])
+@cross_origin()
+@privilege_required()
+@swag_from("swagger/regisbatchpost.yml")
+def registration_batch():
+    """Register many citizens from a CSV or NDJSON upload.
+
+    The body is read and inserted REGISTRATION_BATCH_SIZE rows at a time and
+    the feedback is streamed back while the upload is still being read, so
+    memory stays flat whatever the size of the file.
+
+    Params (POST body):
+        text/csv: a header row with the fields of POST /registration,
+            then one citizen per row
+        application/x-ndjson: one json object per line with the fields of
+            POST /registration
+
+    Authentication:
+        jwt token: the bearer token that is required for invoking this endpoint
+
+    Response Codes:
+        200: the upload has been processed, see the feedback of every row
+        401: the user does not have permission to invoke this endpoint
+
+    Returns:
+        ndjson: one line per uploaded row in upload order:
+            {
+                "line",
+                "citizen_id",
+                "code",
+                "feedback"
+            }
+        json data: the feedback for unauthenticated usage of this endpoint
+    """
+    records = read_records(request.stream, request.mimetype == "text/csv")
+
+    def generate_feedback():
+        for line, citizen_id, feedback_key in register_citizens(records):
+            yield json.dumps(
+                {
+                    "line": line,
+                    "citizen_id": citizen_id,
+                    "code": feedback_key,
+                    "feedback": REGISTRATION_FEEDBACK[feedback_key]
+                },
+                ensure_ascii=False) + "\n"
+
+    logger.info("batch registration started")
+    return Response(stream_with_context(generate_feedback()),
+                    mimetype='application/x-ndjson')
+
+
 @app.route('/registration', methods=['DELETE'])
 @cross_origin()
-@jwt_required()
-@swag_from("swagger/citizendel.yml")
+@privilege_required(admin=True)
+@swag_from("swagger/resetdel.yml")
 def reset_citizen_db():
-    """Reset the citizen database.
-    
+    """Reset the citizen database in the background.
+
+    The citizens, their doses and reservations are deleted by a reset job,
+    see app/jobs.py.
+
     Authentication:
         jwt token: the bearer token that is required for invoking this endpoint
             and the authenticated user must have admin permissions.
 
     Response Codes:
-        200: the citizen database has been reset successfully
+        202: the reset job is queued, its URL is in the Location header
         401: user does not have admin privileges to reset the citizen table
 
     Returns:
-        response: the redirection to the list of citizens page
+        json data: the feedback, the URL and the status of the job
         json data: the feedback for unauthenticated usage of this endpoint
     """
-    user = Users.query.filter_by(username=get_jwt_identity()).first()
-    if not user.is_admin:
-        return {"feedback": AUTHENTICATION_FEEDBACK["unauthenticated"]}
-
-    try:
-        db.session.query(Citizen).delete()
-        db.session.query(Reservation).delete()
-        db.session.commit()
-    except:
-        db.session.rollback()
-        logger.error(DELETE_FEEDBACK["fail_reset"])
-
-    logger.info(DELETE_FEEDBACK["success_reset"])
-    return redirect(url_for('citizen'))
+    return accept_job("reset", {})
 
 
 @app.route('/registration/<citizen_id>', methods=['DELETE'])
 @cross_origin()
-@jwt_required()
+@privilege_required(admin=True)
 @swag_from("swagger/citizendel.yml")
 def delete_citizen_db(citizen_id):
     """Remove a citizen from the database.
@@ -255,11 +404,8 @@ def delete_citizen_db(citizen_id):
             - citizen not register or in database
         json data: the feedback for unauthenticated usage of this endpoint
     """
-    user = Users.query.filter_by(username=get_jwt_identity()).first()
-    if not user.is_admin:
-        return {"feedback": AUTHENTICATION_FEEDBACK["unauthenticated"]}
-
-    if not is_citizen_id(citizen_id):
+    citizen_id = parse_citizen_id(citizen_id)
+    if citizen_id is None:
         logger.error(DELETE_FEEDBACK["invalid_id"])
         return redirect(url_for('citizen'), 404)
 
@@ -270,10 +416,14 @@ def delete_citizen_db(citizen_id):
     try:
         person = get_citizen(citizen_id)
         db.session.delete(person)
-        db.session.query(Reservation).filter(
-            Reservation.citizen_id == citizen_id).delete()
+        deleted = db.session.execute(Reservation.__table__.delete().where(
+            Reservation.citizen_id == citizen_id).returning(
+                Reservation.id, Reservation.citizen_id,
+                Reservation.site_name)).fetchall()
+        record_reservation_changes("delete", deleted)
         db.session.commit()
-        logger.info("{} - citizen has been deleted".format(citizen_id))
+        forget_citizens([citizen_id])
+        logger.info("%s - citizen has been deleted", citizen_id)
     except:
         db.session.rollback()
         logger.error(DELETE_FEEDBACK["fail_delete"])
@@ -283,6 +433,7 @@ def delete_citizen_db(citizen_id):
 
 @app.route('/reservation/<citizen_id>', methods=['GET'])
 @cross_origin()
+@read_replica()
 def reservation_get_by_citizen_id(citizen_id):
     """Get all reservations for a specific citizen.
     
@@ -291,6 +442,8 @@ def reservation_get_by_citizen_id(citizen_id):
 
     Response Codes:
         200: gets the reservations of the citizen successfully
+        304: the reservations have not changed since the If-None-Match
+            ETag or the If-Modified-Since date
         404: invalid citizen id or the citizen is not registered
 
     Returns:
@@ -300,51 +453,237 @@ def reservation_get_by_citizen_id(citizen_id):
             - invalid citizen id
             - citizen not register or in database
     """
-    if not is_citizen_id(citizen_id):
+    citizen_id = parse_citizen_id(citizen_id)
+    if citizen_id is None:
         logger.error(REPORT_FEEDBACK["invalid_id"])
         return redirect(url_for('citizen'), 404)
 
-    if not is_registered(citizen_id):
+    version = get_citizen_version(citizen_id)
+    if version is None:
         logger.error(REPORT_FEEDBACK["not_registered"])
         return redirect(url_for('citizen'), 404)
 
-    reservations = []
-    for reservation in db.session.query(Reservation).filter(
-            Reservation.citizen_id == citizen_id):
-        reservation_data = reservation.get_dict()
-        reservations.append(reservation_data)
+    def render():
+        reservations = []
+        for reservation in get_reservations(citizen_id):
+            reservation_data = reservation.get_dict()
+            reservations.append(reservation_data)
+        return json.dumps(reservations, ensure_ascii=False)
 
-    logger.info("{} - get reservation data".format(citizen_id))
-    return json.dumps(reservations, ensure_ascii=False)
+    logger.info("%s - get reservation data", citizen_id)
+    return conditional_response("reservation", citizen_id, version, render)
 
 
 @app.route('/reservations', methods=['GET'])
 @cross_origin()
 @swag_from("swagger/reserveget.yml")
+@read_replica()
 def get_reservation():
     """Get all reservations in the database.
 
+    The reservations are read with their citizen in a single joined query
+    and streamed to the client, so the response is never held in memory.
+
+    Params (GET):
+        after (int): only return reservations with an id greater than this,
+            use the id of the last reservation of the previous page
+        limit (int): the maximum number of reservations to return (1 - 1000),
+            all reservations are returned when it is not given
+        format (string): "ndjson" to return one reservation per line
+
     Response Codes:
         200: gets the reservations of the citizen successfully
 
     Returns:
     list[json data]: a list of all reservations in the database
+    json data: the feedback of invalid pagination parameters
     """
-    reservations = []
-    for reservation in db.session.query(Reservation).all():
-        citizen_data = get_citizen(reservation.citizen_id).get_dict()
-        reservation_data = reservation.get_dict()
+    after, limit, feedback = parse_page_args()
+    if feedback:
+        logger.error(feedback)
+        return {"feedback": feedback}
 
-        reservation_data["citizen_data"] = citizen_data
-        reservations.append(reservation_data)
+    ndjson = (request.args.get('format') == 'ndjson'
+              or request.accept_mimetypes.best == 'application/x-ndjson')
 
     logger.info("service site get reservation data")
-    return json.dumps(reservations, ensure_ascii=False)
+    return Response(stream_with_context(
+        stream_rows(iter_reservation_rows(after, limit),
+                    RESERVATION_LIST_ENCODER, ndjson)),
+                    mimetype='application/x-ndjson'
+                    if ndjson else 'application/json')
+
+
+@app.route('/reservations/changes', methods=['GET'])
+@cross_origin()
+@swag_from("swagger/changesget.yml")
+def get_reservation_changes_feed():
+    """Get the reservations inserted, updated or deleted since a cursor.
+
+    A service site keeps the "next" cursor of each response and passes it
+    as "since" to the next call, so it only downloads what changed.
+
+    Params (GET):
+        since (string): the "next" cursor of the previous response, all
+            changes are returned when it is not given
+        limit (int): the maximum number of changes to return (1 - 1000),
+            DATABASE_PAGE_SIZE when it is not given
+
+    Response Codes:
+        200: gets the changes successfully
+
+    Returns:
+        json data: the changes in the order they were made and the cursor
+            to continue from:
+            {
+                "changes": [{
+                    "operation",
+                    "reservation_id",
+                    "citizen_id",
+                    "timestamp",
+                    "reservation"
+                }],
+                "next"
+            }
+        json data: the feedback of invalid pagination parameters
+    """
+    since = parse_change_cursor(request.args.get('since'))
+    _, limit, feedback = parse_page_args(DATABASE_PAGE_SIZE)
+    if since is None:
+        feedback = PAGINATION_FEEDBACK["invalid_since"]
+    if feedback:
+        logger.error(feedback)
+        return {"feedback": feedback}
+
+    changes = []
+    for change, reservation in get_reservation_changes(since, limit):
+        since = (change.transaction_id, change.id)
+        changes.append(get_change_dict(change, reservation))
+
+    logger.info("service site get reservation changes")
+    return {"changes": changes, "next": format_change_cursor(since)}
+
+
+@app.route('/stats', methods=['GET'])
+@cross_origin()
+@swag_from("swagger/statsget.yml")
+@read_replica()
+def get_stats():
+    """Get the reservation and dose counts by site, vaccine and day.
+
+    The counts are kept up to date by the database in the transaction of
+    every write, so the answer never scans the reservations or doses.
+
+    Params (GET):
+        group_by (string): comma separated keys among site_name,
+            vaccine_name and day, the counts are summed over the others,
+            all three when it is not given
+        site_name (string): only count this site
+        vaccine_name (string): only count this vaccine
+        from (string): only count from this day, YYYY-MM-DD
+        to (string): only count up to this day, YYYY-MM-DD
+
+    Response Codes:
+        200: gets the counts successfully
+
+    Returns:
+        json data: the counts of each group and their total:
+            {
+                "stats": [{
+                    "site_name",
+                    "vaccine_name",
+                    "day",
+                    "pending",
+                    "queued",
+                    "checked",
+                    "doses"
+                }],
+                "total": {"pending", "queued", "checked", "doses"}
+            }
+        json data: the feedback of invalid parameters
+    """
+    group_by = request.args.get('group_by', ",".join(STAT_KEYS))
+    group_by = [key.strip() for key in group_by.split(",") if key.strip()]
+    if not set(group_by) <= set(STAT_KEYS) or len(set(group_by)) < len(
+            group_by):
+        logger.error(STATS_FEEDBACK["invalid_group_by"])
+        return {"feedback": STATS_FEEDBACK["invalid_group_by"]}
+
+    try:
+        first_day, last_day = (datetime.strptime(
+            request.args[key], "%Y-%m-%d").date() if key in request.args else
+                               None for key in ('from', 'to'))
+    except ValueError:
+        logger.error(STATS_FEEDBACK["invalid_day"])
+        return {"feedback": STATS_FEEDBACK["invalid_day"]}
+
+    stats = []
+    total = dict.fromkeys((counter.key for counter in STAT_COUNTERS), 0)
+    for row in get_daily_stats(group_by, request.args.get('site_name'),
+                               request.args.get('vaccine_name'), first_day,
+                               last_day):
+        stat = row._asdict()
+        # unknown sites and days, see DailyStat
+        if stat.get("site_name") == "":
+            stat["site_name"] = None
+        if "day" in stat:
+            stat["day"] = stat["day"].isoformat(
+            ) if stat["day"] != date.min else None
+        for key in total:
+            total[key] += stat[key]
+        stats.append(stat)
+
+    logger.info("get stats by %s", group_by)
+    return {"stats": stats, "total": total}
+
+
+@app.route('/sites/<site_name>/events', methods=['GET'])
+@cross_origin()
+@swag_from("swagger/siteevents.yml")
+def get_site_events(site_name):
+    """Stream the reservation changes of a site as server-sent events.
+
+    A service site keeps one connection open instead of polling for new,
+    cancelled and queued reservations. The id of each event is a change
+    feed cursor, so a client that reconnects with the Last-Event-ID header
+    (or the last_event_id parameter) gets the changes it missed.
+
+    Args:
+        site_name (str): name of the vaccination site
+
+    Response Codes:
+        200: streams the events
+        503: this worker already serves EVENTS_MAX_STREAMS streams
+
+    Returns:
+        text/event-stream: an "insert", "update", "delete" or "reset" event
+            per change, with the json data of GET /reservations/changes
+        json data: the feedback of an invalid Last-Event-ID
+    """
+    last_event_id = request.headers.get('Last-Event-ID',
+                                        request.args.get('last_event_id'))
+    since = parse_change_cursor(
+        last_event_id) if last_event_id is not None else None
+    if last_event_id is not None and since is None:
+        logger.error(EVENTS_FEEDBACK["invalid_last_event_id"])
+        return {"feedback": EVENTS_FEEDBACK["invalid_last_event_id"]}
+
+    if change_broker.is_full():
+        logger.error(EVENTS_FEEDBACK["busy"])
+        return {"feedback": EVENTS_FEEDBACK["busy"]}, 503
+
+    logger.info("%s - service site listen to events", site_name)
+    return Response(stream_with_context(stream_site_events(site_name, since)),
+                    mimetype='text/event-stream',
+                    headers={
+                        'Cache-Control': 'no-cache',
+                        'X-Accel-Buffering': 'no'
+                    })
 
 
 @app.route('/reservation', methods=['POST'])
 @cross_origin()
-@jwt_required()
+@privilege_required()
 @swag_from("swagger/reservepost.yml")
 def reservation():
     """Make a reservation for a citizen and store it in the database.
@@ -382,10 +721,6 @@ def reservation():
         json data: the feedback for unauthenticated usage of this endpoint
     """
 
-    user = Users.query.filter_by(username=get_jwt_identity()).first()
-    if not user.has_privilege and not user.is_admin:
-        return {"feedback": AUTHENTICATION_FEEDBACK["unauthenticated"]}
-
     citizen_id = request.values['citizen_id']
     site_name = request.values['site_name']
     vaccine_name = request.values['vaccine_name']
@@ -393,7 +728,8 @@ def reservation():
         logger.error(RESERVATION_FEEDBACK["missing_key"])
         return {"feedback": RESERVATION_FEEDBACK["missing_key"]}
 
-    if not is_citizen_id(citizen_id):
+    citizen_id = parse_citizen_id(citizen_id)
+    if citizen_id is None:
         logger.error(RESERVATION_FEEDBACK["invalid_id"])
         return {"feedback": RESERVATION_FEEDBACK["invalid_id"]}
 
@@ -413,30 +749,37 @@ def reservation():
     is_valid, json_data = validate_vaccine(citizen, vaccine_name)
 
     if not is_valid:
-        logger.error("{} - {}".format(citizen_id, json_data['feedback']))
+        logger.error("%s - %s", citizen_id, json_data['feedback'])
         return json_data
 
+    # the unique index on unchecked reservations rejects concurrent duplicates
     try:
-        data = Reservation(int(citizen_id), site_name, vaccine_name)
+        data = Reservation(citizen_id, site_name, vaccine_name)
+        reservation_data = data.get_dict()
         db.session.add(data)
+        db.session.flush()
+        touch_citizens([citizen_id])
+        record_reservation_changes("insert",
+                                   [(data.id, citizen_id, site_name)])
         db.session.commit()
-        reservation_data = data.get_dict()
-        reservation_data["feedback"] = RESERVATION_FEEDBACK["success"]
-        return json.dumps(reservation_data, ensure_ascii=False), 201, {
-            'Location':
-            url_for('reservation_get_by_citizen_id',
-                    citizen_id=data.citizen_id,
-                    _external=True)
-        }
-    except:
+    except Exception as e:
         db.session.rollback()
-        logger.error(RESERVATION_FEEDBACK["other"])
-        return {"feedback": RESERVATION_FEEDBACK["other"]}
+        feedback = RESERVATION_FEEDBACK[get_violation_key(e, "other")]
+        logger.error(feedback)
+        return {"feedback": feedback}
+
+    reservation_data["feedback"] = RESERVATION_FEEDBACK["success"]
+    return json.dumps(reservation_data, ensure_ascii=False), 201, {
+        'Location':
+        url_for('reservation_get_by_citizen_id',
+                citizen_id=citizen_id,
+                _external=True)
+    }
 
 
 @app.route('/reservation/<citizen_id>', methods=['DELETE'])
 @cross_origin()
-@jwt_required()
+@privilege_required()
 @swag_from("swagger/reservedel.yml")
 def cancel_reservation(citizen_id):
     """Cancel a citizen's reservation and remove it from the database.
@@ -460,15 +803,12 @@ def cancel_reservation(citizen_id):
         json data: the feedback for unauthenticated usage of this endpoint
     """
 
-    user = Users.query.filter_by(username=get_jwt_identity()).first()
-    if not user.has_privilege and not user.is_admin:
-        return {"feedback": AUTHENTICATION_FEEDBACK["unauthenticated"]}
-
     if not (citizen_id):
         logger.error(CANCEL_RESERVATION_FEEDBACK["missing_key"])
         return {"feedback": CANCEL_RESERVATION_FEEDBACK["missing_key"]}
 
-    if not is_citizen_id(citizen_id):
+    citizen_id = parse_citizen_id(citizen_id)
+    if citizen_id is None:
         logger.error(CANCEL_RESERVATION_FEEDBACK["invalid_id"])
         return {"feedback": CANCEL_RESERVATION_FEEDBACK["invalid_id"]}
 
@@ -481,21 +821,24 @@ def cancel_reservation(citizen_id):
         return {"feedback": CANCEL_RESERVATION_FEEDBACK["not_reservation"]}
 
     try:
-        reservation = get_unchecked_reservations(citizen_id).first()
+        reservation = get_unchecked_reservation(citizen_id)
         db.session.delete(reservation)
+        touch_citizens([citizen_id])
+        record_reservation_changes(
+            "delete", [(reservation.id, citizen_id, reservation.site_name)])
         db.session.commit()
     except:
         db.session.rollback()
         logger.error(CANCEL_RESERVATION_FEEDBACK["invalid_reservation"])
         return {"feedback": CANCEL_RESERVATION_FEEDBACK["invalid_reservation"]}
 
-    logger.info("{} - cancel reservation".format(citizen_id))
+    logger.info("%s - cancel reservation", citizen_id)
     return {"feedback": CANCEL_RESERVATION_FEEDBACK["success"]}
 
 
 @app.route('/queue_report', methods=['POST'])
 @cross_origin()
-@jwt_required()
+@privilege_required()
 @swag_from("swagger/queuepost.yml")
 def update_queue():
     """Update the queue of the reservation.
@@ -520,11 +863,7 @@ def update_queue():
             - invalid reservation
         json data: the feedback for unauthenticated usage of this endpoint
     """
-    user = Users.query.filter_by(username=get_jwt_identity()).first()
-    if not user.has_privilege and not user.is_admin:
-        return {"feedback": AUTHENTICATION_FEEDBACK["unauthenticated"]}
-
-    citizen_id = request.values['citizen_id']
+    citizen_id = parse_citizen_id(request.values['citizen_id'])
     queue = request.values['queue']
 
     try:
@@ -537,21 +876,102 @@ def update_queue():
         return {"feedback": REPORT_FEEDBACK["invalid_time_format"]}
 
     try:
-        reservation = get_unchecked_reservations(citizen_id).first()
+        reservation = get_unchecked_reservation(citizen_id)
         reservation.queue = queue
+        touch_citizens([citizen_id])
+        record_reservation_changes(
+            "update", [(reservation.id, citizen_id, reservation.site_name)])
         db.session.commit()
     except:
         db.session.rollback()
         logger.error(REPORT_FEEDBACK["invalid_reservation"])
         return {"feedback": REPORT_FEEDBACK["invalid_reservation"]}
 
-    logger.info("{} - updated queue - queue: {}".format(citizen_id, queue))
+    logger.info("%s - updated queue - queue: %s", citizen_id, queue)
     return {"feedback": REPORT_FEEDBACK["success"]}
 
 
+@app.route('/queue_report/schedule', methods=['POST'])
+@cross_origin()
+@privilege_required()
+@swag_from("swagger/schedulepost.yml")
+def schedule_site_queue():
+    """Queue all waiting reservations of a site into slots of limited capacity.
+
+    Params (POST):
+        site_name (string): the name of the vaccination site
+        start (string): the start of the first slot
+        end (string): the end of the time range
+            both in the format '%Y-%m-%d %H:%M:%S.%f'
+        slot_minutes (string): the length of a slot in minutes
+        capacity (string): the number of citizens a slot can take
+
+    Authentication:
+        jwt token: the bearer token that is required for invoking this endpoint
+
+    Response Codes:
+        200: the waiting reservations have been queued
+        401: the user does not have permission to invoke this endpoint
+
+    Returns:
+        json data: the feedback and the number of reservations queued:
+            {
+                "scheduled",
+                "feedback"
+            }
+        json data: the feedback of failed scheduling if the following occurs:
+            - missing attribute
+            - invalid start or end datetime
+            - start is in the past or not before end
+            - invalid slot_minutes or capacity
+        json data: the feedback for unauthenticated usage of this endpoint
+    """
+    site_name = request.values.get('site_name')
+    start = request.values.get('start')
+    end = request.values.get('end')
+    slot_minutes = request.values.get('slot_minutes')
+    capacity = request.values.get('capacity')
+
+    if not (site_name and start and end and slot_minutes and capacity):
+        logger.error(SCHEDULE_FEEDBACK["missing_key"])
+        return {"feedback": SCHEDULE_FEEDBACK["missing_key"]}
+
+    try:
+        start = datetime.strptime(start, "%Y-%m-%d %H:%M:%S.%f")
+        end = datetime.strptime(end, "%Y-%m-%d %H:%M:%S.%f")
+    except ValueError:
+        logger.error(SCHEDULE_FEEDBACK["invalid_time_format"])
+        return {"feedback": SCHEDULE_FEEDBACK["invalid_time_format"]}
+
+    if start <= datetime.now() or end <= start:
+        logger.error(SCHEDULE_FEEDBACK["invalid_time"])
+        return {"feedback": SCHEDULE_FEEDBACK["invalid_time"]}
+
+    try:
+        slot_minutes = int(slot_minutes)
+        capacity = int(capacity)
+    except ValueError:
+        slot_minutes = capacity = 0
+    if slot_minutes <= 0 or capacity <= 0:
+        logger.error(SCHEDULE_FEEDBACK["invalid_slot"])
+        return {"feedback": SCHEDULE_FEEDBACK["invalid_slot"]}
+
+    try:
+        scheduled = schedule_queue(site_name, start, end, slot_minutes,
+                                   capacity)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        logger.exception(SCHEDULE_FEEDBACK["other"])
+        return {"feedback": SCHEDULE_FEEDBACK["other"]}
+
+    logger.info("%s - scheduled %s reservations", site_name, scheduled)
+    return {"scheduled": scheduled, "feedback": SCHEDULE_FEEDBACK["success"]}
+
+
 @app.route('/report_taken', methods=['POST'])
 @cross_origin()
-@jwt_required()
+@privilege_required()
 @swag_from("swagger/reportpost.yml")
 def update_citizen_db():
     """Accepts the report sent by service sites and update citizen's list of vaccine taken.
@@ -580,10 +1000,6 @@ def update_citizen_db():
             - citizen already has reservation when the option is walk-in
         json data: the feedback for unauthenticated usage of this endpoint
     """
-    user = Users.query.filter_by(username=get_jwt_identity()).first()
-    if not user.has_privilege and not user.is_admin:
-        return {"feedback": AUTHENTICATION_FEEDBACK["unauthenticated"]}
-
     citizen_id = request.values['citizen_id']
     vaccine_name = request.values['vaccine_name']
     option = request.values['option']
@@ -592,66 +1008,360 @@ def update_citizen_db():
         logger.error(REPORT_FEEDBACK["missing_key"])
         return {"feedback": REPORT_FEEDBACK["missing_key"]}
 
-    if not is_citizen_id(citizen_id):
+    citizen_id = parse_citizen_id(citizen_id)
+    if citizen_id is None:
         logger.error(REPORT_FEEDBACK["invalid_id"])
         return {"feedback": REPORT_FEEDBACK["invalid_id"]}
 
-    if not is_registered(citizen_id):
-        logger.error(REPORT_FEEDBACK["not_registered"])
-        return {"feedback": REPORT_FEEDBACK["not_registered"]}
+    citizen, reservation = load_citizen_context(citizen_id)
+    feedback_key, feedback = check_report(citizen, reservation, vaccine_name,
+                                          option)
+    if feedback_key != "success":
+        logger.error("%s - %s", citizen_id, feedback)
+        return {"feedback": feedback}
 
-    if not is_vaccine_name(vaccine_name):
-        logger.error(REPORT_FEEDBACK["invalid_vaccine"])
-        return {"feedback": REPORT_FEEDBACK["invalid_vaccine"]}
-
-    if (option == "walk-in"):
-        if is_reserved(citizen_id):
-            logger.error(REPORT_FEEDBACK["has_reservation"])
-            return {"feedback": REPORT_FEEDBACK["has_reservation"]}
-        try:
-            citizen = get_citizen(citizen_id)
-            is_valid, feedback = validate_vaccine(citizen, vaccine_name)
-            if not is_valid:
-                logger.error("{} - {}".format(citizen_id,
-                                              feedback['feedback']))
-                return feedback
-            citizen.vaccine_taken = [*(citizen.vaccine_taken), vaccine_name]
-            db.session.commit()
-        except:
-            db.session.rollback()
-            logger.error(REPORT_FEEDBACK["other"])
-            return {"feedback": REPORT_FEEDBACK["other"]}
-
-        logger.info("{} - updated citizen - vaccine name: {}".format(
-            citizen_id, vaccine_name))
-        return {"feedback": REPORT_FEEDBACK["success"]}
-
-    elif (option == "reserve"):
-        if not is_reserved(citizen_id):
-            logger.error(REPORT_FEEDBACK["not_reservation"])
-            return {"feedback": REPORT_FEEDBACK["not_reservation"]}
-
-        try:
-            citizen_data = get_citizen(citizen_id)
-            citizen_data.vaccine_taken = [
-                *(citizen_data.vaccine_taken), vaccine_name
-            ]
-            reservation_data = get_unchecked_reservations(citizen_id).filter(
-                Reservation.vaccine_name == vaccine_name).first()
-            reservation_data.checked = True
-            db.session.commit()
-        except:
-            db.session.rollback()
-            logger.error(REPORT_FEEDBACK["not_match_vaccine"])
-            return {"feedback": REPORT_FEEDBACK["not_match_vaccine"]}
-
-        logger.info("{} - updated citizen - vaccine name: {}".format(
-            citizen_id, vaccine_name))
-        return {"feedback": REPORT_FEEDBACK["success"]}
+    try:
+        if option == "reserve":
+            record_dose(citizen, reservation, vaccine_name)
+            record_reservation_changes(
+                "update",
+                [(reservation.id, citizen_id, reservation.site_name)])
+        else:
+            record_dose(citizen, None, vaccine_name)
+        touch_citizens([citizen_id])
+        db.session.commit()
+    except:
+        db.session.rollback()
+        logger.error(REPORT_FEEDBACK["other"])
+        return {"feedback": REPORT_FEEDBACK["other"]}
 
-    else:
-        logger.error(REPORT_FEEDBACK["invalid_option"])
-        return {"feedback": REPORT_FEEDBACK["invalid_option"]}
+    logger.info("%s - updated citizen - vaccine name: %s", citizen_id,
+                vaccine_name)
+    return {"feedback": REPORT_FEEDBACK["success"]}
+
+
+@app.route('/report_taken/batch', methods=['POST'])
+@cross_origin()
+@privilege_required()
+@swag_from("swagger/reportbatchpost.yml")
+def update_citizen_db_batch():
+    """Accepts the end-of-day reports of a service site in one upload.
+
+    The reports are applied REPORT_BATCH_SIZE at a time: the citizens and
+    reservations of a chunk are loaded with two queries, every report is
+    checked with the rules of POST /report_taken in upload order and the
+    chunk is committed in one transaction.
+
+    Params (POST body):
+        text/csv: a header row of citizen_id, vaccine_name and option,
+            then one report per row
+        application/x-ndjson: one json object per line with the fields of
+            POST /report_taken
+
+    Authentication:
+        jwt token: the bearer token that is required for invoking this endpoint
+
+    Response Codes:
+        200: the upload has been processed, see the feedback of every report
+        401: the user does not have permission to invoke this endpoint
+
+    Returns:
+        ndjson: one line per uploaded report in upload order:
+            {
+                "line",
+                "citizen_id",
+                "code",
+                "feedback"
+            }
+        json data: the feedback for unauthenticated usage of this endpoint
+    """
+    records = read_records(request.stream, request.mimetype == "text/csv")
+
+    def generate_feedback():
+        for line, citizen_id, feedback_key, feedback in report_doses(records):
+            yield json.dumps(
+                {
+                    "line": line,
+                    "citizen_id": citizen_id,
+                    "code": feedback_key,
+                    "feedback": feedback
+                },
+                ensure_ascii=False) + "\n"
+
+    logger.info("batch report started")
+    return Response(stream_with_context(generate_feedback()),
+                    mimetype='application/x-ndjson')
+
+
+@app.route('/export/<table>', methods=['GET'])
+@cross_origin()
+@privilege_required(admin=True)
+@swag_from("swagger/exportget.yml")
+def export_table(table):
+    """Export the citizen or reservation table as CSV or NDJSON.
+
+    The rows are streamed from a server-side cursor, so any table size
+    can be exported. python -m app.export writes the same output to a file.
+
+    Args:
+        table (str): "citizen" or "reservation"
+
+    Params (GET):
+        format (string): "csv" (default) or "ndjson"
+        columns (string): comma separated column names, all of them when
+            it is not given
+        since (string): ISO date or datetime, only export the rows of the
+            citizens updated since then
+        gzip (string): "true" to compress the output
+
+    Authentication:
+        jwt token: a jwt token of an admin user
+
+    Response Codes:
+        200: streams the export
+        401: the user does not have permission to invoke this endpoint
+
+    Returns:
+        file: the export, named after the table and the format
+        json data: the feedback of invalid parameters
+    """
+    export_format = request.args.get('format', 'csv')
+    columns, since, feedback = parse_export_args(table, export_format,
+                                                 request.args.get('columns'),
+                                                 request.args.get('since'))
+    if feedback:
+        logger.error(feedback)
+        return {"feedback": feedback}
+
+    gzip = request.args.get('gzip', '').lower() == 'true'
+    filename = "{}.{}".format(table, export_format)
+    if gzip:
+        filename += ".gz"
+    logger.info("export %s %s since %s", table, export_format, since)
+    return Response(
+        stream_with_context(
+            stream_export(table, columns, export_format, since, gzip)),
+        mimetype='application/gzip'
+        if gzip else EXPORT_FORMATS[export_format],
+        headers={
+            'Content-Disposition': 'attachment; filename="{}"'.format(filename)
+        })
+
+
+def accept_job(kind, params, upload=None):
+    """Queue a job and answer 202 with its URL, see submit_job()"""
+    job = submit_job(kind, params, get_jwt_identity(), upload)
+    url = url_for('get_job', job_id=job.id, _external=True)
+    return {
+        "feedback": JOB_FEEDBACK["accepted"],
+        "url": url,
+        "job": job.get_dict()
+    }, 202, {
+        'Location': url
+    }
+
+
+def get_job_dict(job):
+    """Return the status of a job with the URL of its result file"""
+    job_data = job.get_dict()
+    if get_result_path(job):
+        job_data["result_url"] = url_for('get_job_result',
+                                         job_id=job.id,
+                                         _external=True)
+    return job_data
+
+
+@app.route('/jobs/<kind>', methods=['POST'])
+@cross_origin()
+@privilege_required(admin=True)
+@swag_from("swagger/jobpost.yml")
+def post_job(kind):
+    """Run a long admin operation in the background.
+
+    Args:
+        kind (str): "reset", "registration", "report", "export" or
+            "recompute_stats"
+
+    Params:
+        registration, report: the body of POST /registration/batch or
+            POST /report_taken/batch
+        export: table and the params of GET /export/<table>
+
+    Authentication:
+        jwt token: a jwt token of an admin user
+
+    Response Codes:
+        202: the job is queued, its URL is in the Location header
+        401: the user does not have permission to invoke this endpoint
+
+    Returns:
+        json data: the feedback, the URL and the status of the job
+        json data: the feedback of invalid parameters
+    """
+    params, feedback = parse_job_params(kind, request.values,
+                                        request.mimetype)
+    if feedback:
+        logger.error(feedback)
+        return {"feedback": feedback}
+
+    if kind in ("registration", "report"):
+        return accept_job(kind, params, request.stream)
+    return accept_job(kind, params)
+
+
+@app.route('/jobs', methods=['GET'])
+@cross_origin()
+@privilege_required(admin=True)
+@swag_from("swagger/joblistget.yml")
+def get_job_list():
+    """Return the most recent jobs, newest first.
+
+    Authentication:
+        jwt token: a jwt token of an admin user
+
+    Returns:
+        json data: {"jobs": the status of each job}
+    """
+    fail_interrupted_jobs()
+    return {"jobs": [get_job_dict(job) for job in get_jobs()]}
+
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+@cross_origin()
+@privilege_required(admin=True)
+@swag_from("swagger/jobget.yml")
+def get_job(job_id):
+    """Return the status and the progress of a job.
+
+    Authentication:
+        jwt token: a jwt token of an admin user
+
+    Response Codes:
+        200: the status of the job
+        404: the job does not exist
+
+    Returns:
+        json data: the status of the job, with a result_url once its
+            result file is ready
+    """
+    fail_interrupted_jobs()
+    job = db.session.get(Job, job_id)
+    if job is None:
+        logger.error(JOB_FEEDBACK["not_found"])
+        return {"feedback": JOB_FEEDBACK["not_found"]}, 404
+    return get_job_dict(job)
+
+
+@app.route('/jobs/<int:job_id>/result', methods=['GET'])
+@cross_origin()
+@privilege_required(admin=True)
+@swag_from("swagger/jobresultget.yml")
+def get_job_result(job_id):
+    """Download the file of a succeeded export or import job.
+
+    Authentication:
+        jwt token: a jwt token of an admin user
+
+    Response Codes:
+        200: the file of the job
+        404: the job does not exist, has no result file, or its file is
+            on another host
+
+    Returns:
+        file: the export, or the NDJSON feedback of every line of an import
+    """
+    job = db.session.get(Job, job_id)
+    path = get_result_path(job) if job is not None else None
+    if path is None:
+        feedback = JOB_FEEDBACK["no_result"]
+        if job is not None and job.status == "succeeded" and (
+                job.result or {}).get("filename"):
+            feedback = JOB_FEEDBACK["result_elsewhere"]
+        logger.error(feedback)
+        return {"feedback": feedback}, 404
+    return send_file(path,
+                     mimetype=job.result["mimetype"],
+                     as_attachment=True,
+                     download_name=job.result["filename"])
+
+
+@app.route('/vaccine_sequence', methods=['GET'])
+@cross_origin()
+@swag_from("swagger/sequenceget.yml")
+def get_vaccine_sequence():
+    """Get the vaccine sequence rules in use.
+
+    Response Codes:
+        200: gets the rules successfully
+
+    Returns:
+        json data: the version of the rules and the available next vaccines
+            for every list of vaccines taken
+            {
+                "version",
+                "available": [{"vaccine_taken", "available_vaccine"}]
+            }
+    """
+    rules = get_vaccine_rules()
+    return json.dumps(
+        {
+            "version":
+            rules.version,
+            "available": [{
+                "vaccine_taken": list(taken),
+                "available_vaccine": list(vaccines)
+            } for taken, vaccines in sorted(rules.available.items())]
+        },
+        ensure_ascii=False)
+
+
+@app.route('/vaccine_sequence', methods=['POST'])
+@cross_origin()
+@privilege_required(admin=True)
+@swag_from("swagger/sequencepost.yml")
+def update_vaccine_sequence():
+    """Publish a new version of the vaccine sequence rules.
+
+    Every worker starts using the new rules within
+    VACCINE_RULES_CHECK_SECONDS.
+
+    Params (POST json):
+        sequences (list[list[string]]): every allowed order of vaccines
+
+    Authentication:
+        jwt token: the bearer token that is required for invoking this endpoint
+            and the authenticated user must have admin permissions.
+
+    Response Codes:
+        201: the new rules have been published
+        401: user does not have admin privileges to change the rules
+
+    Returns:
+        json data: the new version and the feedback of successful response
+        json data: the feedback of failed update if the sequences are invalid
+        json data: the feedback for unauthenticated usage of this endpoint
+    """
+    data = request.get_json(silent=True) or {}
+    sequences = data.get("sequences")
+    if not (isinstance(sequences, list) and sequences and all(
+            isinstance(pattern, list) and pattern and all(
+                isinstance(name, str) and name for name in pattern)
+            for pattern in sequences)):
+        logger.error(VACCINE_SEQUENCE_FEEDBACK["invalid_sequence"])
+        return {"feedback": VACCINE_SEQUENCE_FEEDBACK["invalid_sequence"]}
+
+    try:
+        version = publish_vaccine_sequence(sequences)
+    except:
+        db.session.rollback()
+        logger.exception(VACCINE_SEQUENCE_FEEDBACK["other"])
+        return {"feedback": VACCINE_SEQUENCE_FEEDBACK["other"]}
+
+    logger.info("published vaccine sequence version %s", version)
+    return {
+        "version": version,
+        "feedback": VACCINE_SEQUENCE_FEEDBACK["success"]
+    }, 201
 
 
 @app.route('/register_user', methods=['POST'])
@@ -684,6 +1394,7 @@ def register_user():
 
         db.session.add(new_user)
         db.session.commit()
+        forget_user_privileges(data['username'])
         feedback = REGISTER_USER_FEEDBACK["successful_registration"]
         return json.dumps(feedback, ensure_ascii=False), 201
     except Exception as e:
@@ -767,76 +1478,71 @@ def queue_report_usage():
 
 @app.route('/database/citizen', methods=['GET'])
 @cross_origin()
+@read_replica()
 def citizen():
     """
-    Render html template that display citizen's information.
-    """
-    tbody = ""
-    for person in db.session.query(Citizen).all():
-        tbody += f"<tr>"
-        tbody += f'<th scope="row">{person.citizen_id}</th>'
-        tbody += f"<td>{person.name}</td>"
-        tbody += f"<td>{person.surname}</td>"
-        tbody += f"<td>{person.birth_date}</td>"
-        tbody += f"<td>{person.occupation}</td>"
-        tbody += f"<td>{person.phone_number}</td>"
-        tbody += f"<td>{person.is_risk}</td>"
-        tbody += f"<td>{person.address}</td>"
-        tbody += f"<td>{person.vaccine_taken}</td>"
-        tbody += f"</tr>"
-
-    html = render_template('database.html')
-    html = Template(html).safe_substitute(
+    Render html template that display citizen's information,
+    one page of DATABASE_PAGE_SIZE citizens at a time.
+    """
+    after, limit, feedback = parse_page_args(DATABASE_PAGE_SIZE)
+    if feedback:
+        logger.error(feedback)
+
+    def generate_rows():
+        for person in iter_page(Citizen, after, limit):
+            yield person.id, (format_citizen_id(person.citizen_id),
+                              person.name, person.surname,
+                              person.birth_date, person.occupation,
+                              person.phone_number, person.is_risk,
+                              person.address, person.vaccine_taken)
+
+    return stream_database_page(
         title="Citizen",
-        count=db.session.query(Citizen).count(),
+        count=approximate_count(Citizen),
         unit="person(s)",
-        thead="""<tr>
-            <th scope="col">Citizen ID</th>
-            <th scope="col">Firstname</th>
-            <th scope="col">Lastname</th>
-            <th scope="col">Birth Date</th>
-            <th scope="col">Occupation</th>
-            <th scope="col">Phone Number</th>
-            <th scope="col">COVID-risks medical</th>
-            <th scope="col">Address</th>
-            <th scope="col">Vaccine Taken</th>
-            </tr>""",
-        tbody=tbody)
-    return html
+        columns=("Citizen ID", "Firstname", "Lastname", "Birth Date",
+                 "Occupation", "Phone Number", "COVID-risks medical",
+                 "Address", "Vaccine Taken"),
+        rows=generate_rows(),
+        limit=limit)
 
 
 @app.route('/database/reservation', methods=['GET'])
 @cross_origin()
+@read_replica()
 def reservation_database():
     """
-    Render html template that display reservation's information.
-    """
-    tbody = ""
-    for reservation in db.session.query(Reservation).all():
-        tbody += f"<tr>"
-        tbody += f'<th scope="row">{reservation.citizen_id}</th>'
-        tbody += f"<td>{reservation.site_name}</td>"
-        tbody += f"<td>{reservation.vaccine_name}</td>"
-        tbody += f'<td>{reservation.timestamp.strftime("%Y-%m-%d, %H:%M:%S")}</td>'
-        tbody += f'<td>{reservation.queue.strftime("%Y-%m-%d, %H:%M:%S") if reservation.queue else "TBC"}</td>'
-        tbody += f"<td>{reservation.checked}</td>"
-        tbody += f"</tr>"
-
-    html = render_template('database.html')
-    html = Template(html).safe_substitute(
+    Render html template that display reservation's information,
+    one page of DATABASE_PAGE_SIZE reservations at a time.
+    """
+    after, limit, feedback = parse_page_args(DATABASE_PAGE_SIZE)
+    if feedback:
+        logger.error(feedback)
+
+    def generate_rows():
+        for reservation in iter_page(Reservation, after, limit):
+            yield reservation.id, (
+                format_citizen_id(reservation.citizen_id),
+                reservation.site_name, reservation.vaccine_name,
+                reservation.timestamp.strftime("%Y-%m-%d, %H:%M:%S"),
+                reservation.queue.strftime("%Y-%m-%d, %H:%M:%S")
+                if reservation.queue else "TBC", reservation.checked)
+
+    return stream_database_page(
         title="Reservation",
-        count=db.session.query(Reservation).count(),
+        count=approximate_count(Reservation),
         unit="reservation(s)",
-        thead="""<tr>
-            <th scope="col">Citizen ID</th>
-            <th scope="col">Site Name</th>
-            <th scope="col">Vaccine Name</th>
-            <th scope="col">Timestamp</th>
-            <th scope="col">Queue</th>
-            <th scope="col">Checked</th>
-            </tr>""",
-        tbody=tbody)
-    return html
+        columns=("Citizen ID", "Site Name", "Vaccine Name", "Timestamp",
+                 "Queue", "Checked"),
+        rows=generate_rows(),
+        limit=limit)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Expose the metrics of every worker in the Prometheus text format."""
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
 
 
 if __name__ == '__main__':
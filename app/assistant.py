@@ -1,5 +1,72 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from flask import g
+from psycopg2.errors import UniqueViolation
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import joinedload
 from app.models import *
+from app.feedback import *
+from collections import Counter, OrderedDict, namedtuple
+from sqlalchemy import text
+import numpy as np
+import codecs, csv, json, re, threading, time
+
+STREAM_BATCH_SIZE = 1000
+MAX_PAGE_SIZE = 1000
+DATABASE_PAGE_SIZE = 100
+COUNT_CACHE_SECONDS = 60
+REGISTRATION_BATCH_SIZE = 1000
+REPORT_BATCH_SIZE = 1000
+PRIVILEGE_CACHE_SECONDS = 60
+PRIVILEGE_CACHE_SIZE = 1024
+RESPONSE_CACHE_SIZE = 4096
+RESPONSE_KINDS = ("citizen", "reservation")
+CHANGE_CHANNEL = "reservation_change"
+STAT_KEYS = ("site_name", "vaccine_name", "day")
+STAT_COUNTERS = (DailyStat.pending, DailyStat.queued, DailyStat.checked,
+                 DailyStat.doses)
+
+REGISTRATION_FIELDS = ("citizen_id", "name", "surname", "birth_date",
+                       "occupation", "phone_number", "is_risk", "address")
+
+UNIQUE_VIOLATION_KEYS = {
+    "citizen_citizen_id_key": "registered",
+    "citizen_phone_number_key": "phoned",
+    "uq_reservation_unchecked_citizen": "double_reservation",
+}
+
+ID_CHECKSUM_WEIGHTS = np.arange(13, 1, -1)
+ID_DIGIT_VALUES = 10**np.arange(12, -1, -1, dtype=np.int64)
+
+MONTH_ABBREVIATIONS = {
+    month: number
+    for number, month in enumerate([
+        "jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct",
+        "nov", "dec"
+    ], 1)
+}
+
+# the day, month and year of strptime, whose day may be a space and a digit
+DATE_PARTS = {
+    "day": r"(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])",
+    "month": r"(1[0-2]|0[1-9]|[1-9])",
+    "year": r"(\d\d\d\d)"
+}
+
+# the formats of parsing_date() as (pattern, index of year, month, day)
+DATE_PATTERNS = [(re.compile(pattern.format(**DATE_PARTS)), indexes)
+                 for pattern, indexes in [
+                     (r"{day}\s+([A-Za-z]{{3}})\s+{year}", (2, 1, 0)),
+                     ("{day}-{month}-{year}", (2, 1, 0)),
+                     ("{year}-{month}-{day}", (0, 1, 2)),
+                     ("{day}/{month}/{year}", (2, 1, 0)),
+                     ("{year}/{month}/{day}", (0, 1, 2)),
+                 ]]
+
+_count_cache = {}
+_privilege_cache = OrderedDict()
+_privilege_lock = threading.Lock()
+_response_cache = OrderedDict()
+_response_lock = threading.Lock()
 
 VACCINE_SEQUENCE = [
     ["Pfizer", "Pfizer"],
@@ -19,6 +86,91 @@ VACCINE_SEQUENCE = [
 ]
 
 
+VACCINE_RULES_CHECK_SECONDS = 30
+
+VaccineRules = namedtuple("VaccineRules",
+                          ["version", "available", "names", "checked_at"])
+
+_vaccine_rules = None
+
+
+def compile_vaccine_sequence(sequences, version=0):
+    """Precompute the available vaccines after every prefix of the sequences
+
+    Args:
+        sequences (list): lists of vaccine names in the order they are taken
+        version (int): version of the rule set
+
+    Returns:
+        VaccineRules: the sorted available vaccines keyed by the tuple of
+            vaccines taken, and the set of all vaccine names
+    """
+    available = {}
+    for pattern in sequences:
+        for length in range(len(pattern)):
+            available.setdefault(tuple(pattern[:length]),
+                                 set()).add(pattern[length])
+    return VaccineRules(
+        version, {
+            taken: tuple(sorted(vaccines))
+            for taken, vaccines in available.items()
+        }, frozenset(name for pattern in sequences for name in pattern),
+        time.monotonic())
+
+
+def get_vaccine_rules():
+    """Return the compiled vaccine sequence rules in use.
+
+    The rules come from the highest version in the vaccine_sequence table,
+    or VACCINE_SEQUENCE while the table is empty. Every worker checks the
+    version at most every VACCINE_RULES_CHECK_SECONDS and swaps in the newly
+    compiled rules when it changed.
+
+    Returns:
+        VaccineRules: the compiled rules
+    """
+    global _vaccine_rules
+    rules = _vaccine_rules
+    now = time.monotonic()
+    if rules and rules.checked_at + VACCINE_RULES_CHECK_SECONDS > now:
+        return rules
+
+    version = db.session.query(db.func.max(VaccineSequence.version)).scalar()
+    if version is None:
+        rules = compile_vaccine_sequence(VACCINE_SEQUENCE)
+    elif rules is None or rules.version != version:
+        rules = compile_vaccine_sequence([
+            sequence.vaccines for sequence in VaccineSequence.query.filter_by(
+                version=version).order_by(VaccineSequence.id)
+        ], version)
+    else:
+        rules = rules._replace(checked_at=now)
+    _vaccine_rules = rules
+    return rules
+
+
+def publish_vaccine_sequence(sequences):
+    """Store sequences as the new version of the rules and use it right away
+
+    Args:
+        sequences (list): lists of vaccine names in the order they are taken
+
+    Returns:
+        int: the new version
+    """
+    global _vaccine_rules
+    # serialize concurrent publishers so each gets its own version
+    db.session.execute(
+        text("LOCK TABLE vaccine_sequence IN SHARE ROW EXCLUSIVE MODE"))
+    version = (db.session.query(db.func.max(
+        VaccineSequence.version)).scalar() or 0) + 1
+    db.session.add_all(
+        [VaccineSequence(version, list(pattern)) for pattern in sequences])
+    db.session.commit()
+    _vaccine_rules = compile_vaccine_sequence(sequences, version)
+    return version
+
+
 def get_available_vaccine(vaccine_taken: list):
     """Return sorted list of available vaccine calculate from the vaccine that citizen have taken
 
@@ -28,13 +180,7 @@ def get_available_vaccine(vaccine_taken: list):
     Returns:
         list: list of available vaccine
     """
-    available_vaccine = set()
-    for pattern in VACCINE_SEQUENCE:
-        length = len(vaccine_taken)
-        if length < len(pattern) and pattern[:length] == vaccine_taken:
-            available_vaccine.add(pattern[length])
-            
-    return sorted(list(available_vaccine))
+    return list(get_vaccine_rules().available.get(tuple(vaccine_taken), ()))
 
 
 def parsing_date(date_str: str):
@@ -96,87 +242,946 @@ def valid_id(thai_id) -> bool:
     return checksum == digits[12]
 
 
-def is_citizen_id(citizen_id):
-    """Return True if citizen_id is a string 13 digits
+def make_citizen_id(number):
+    """Return the valid 13 digits citizen id with number as its first 12
+    digits, for synthetic citizens"""
+    digits = str(number).zfill(12)
+    checksum = sum(int(digit) * weight
+                   for digit, weight in zip(digits, range(13, 1, -1)))
+    return digits + str((11 - checksum % 11) % 10)
+
+
+def check_citizen_ids(citizen_ids):
+    """Validate a column of citizen ids at once, like parse_citizen_id()
+
+    The ids are viewed as a matrix of code points and the checksum of every
+    row is one matrix product.
+
+    Args:
+        citizen_ids (list): citizen ids as strings
+
+    Returns:
+        tuple: (numpy bool array of valid rows, numpy int64 array of the ids,
+            0 for invalid rows)
+    """
+    values = np.array(citizen_ids, dtype=str)
+    if values.dtype.itemsize == 0:
+        values = values.astype("U1")
+    valid = (np.char.str_len(values) == 13) & np.char.isdigit(values)
+    numbers = np.zeros(len(values), dtype=np.int64)
+    if not valid.any():
+        return valid, numbers
+
+    rows = np.flatnonzero(valid)
+    digits = values[rows].astype("U13").view(np.uint32).reshape(
+        -1, 13).astype(np.int64) - ord("0")
+    is_ascii = ((digits >= 0) & (digits <= 9)).all(axis=1)
+    checksum = (11 - (digits[:, :12] @ ID_CHECKSUM_WEIGHTS) % 11) % 10
+    checked = is_ascii & (checksum == digits[:, 12])
+    numbers[rows[checked]] = digits[checked] @ ID_DIGIT_VALUES
+    valid[rows] = checked
+
+    # other unicode digits are rare, leave them to the scalar path
+    for row in rows[~is_ascii]:
+        number = parse_citizen_id(citizen_ids[row])
+        if number is not None:
+            valid[row] = True
+            numbers[row] = number
+    return valid, numbers
+
+
+def check_phone_numbers(phone_numbers):
+    """Validate a column of phone numbers at once, like is_phone_number()
+
+    Args:
+        phone_numbers (list): phone numbers as strings
+
+    Returns:
+        numpy bool array: True for valid rows
+    """
+    values = np.array(phone_numbers, dtype=str)
+    if values.dtype.itemsize == 0:
+        values = values.astype("U1")
+    return (np.char.str_len(values) == 10) & np.isin(
+        values.astype("U2"), ["06", "08", "09"])
+
+
+def parse_dates(date_strs):
+    """Parse a column of dates at once, like parsing_date()
+
+    The format of every value is found by pattern instead of trying each
+    format in turn, and the calendar check is done on whole arrays.
+
+    Args:
+        date_strs (list): dates in one of the formats of parsing_date()
+
+    Returns:
+        numpy datetime64[D] array: the dates, NaT for invalid rows
+    """
+    years = np.zeros(len(date_strs), dtype=np.int64)
+    months = np.zeros(len(date_strs), dtype=np.int64)
+    days = np.zeros(len(date_strs), dtype=np.int64)
+    for row, date_str in enumerate(date_strs):
+        for pattern, (year, month, day) in DATE_PATTERNS:
+            match = pattern.fullmatch(date_str)
+            if match:
+                parts = match.groups()
+                years[row] = int(parts[year])
+                months[row] = int(parts[month]) if parts[month].isdigit(
+                ) else MONTH_ABBREVIATIONS.get(parts[month].lower(), 0)
+                days[row] = int(parts[day])
+                break
+
+    valid = (years >= 1) & (months >= 1) & (months <= 12) & (days >= 1)
+    first_day = (np.where(valid, years, 1970) - 1970) * 12 + np.where(
+        valid, months, 1) - 1
+    first_day = first_day.astype("datetime64[M]").astype("datetime64[D]")
+    next_month = (first_day.astype("datetime64[M]") + 1).astype(
+        "datetime64[D]")
+    valid &= days <= (next_month - first_day).astype(np.int64)
+    return np.where(valid, first_day + (days - 1),
+                    np.datetime64("NaT", "D"))
+
+
+def validate_registration_columns(citizen_ids, phone_numbers, birth_dates):
+    """Validate whole columns of registrations, like validate_registration()
+
+    Args:
+        citizen_ids (list): citizen ids as strings
+        phone_numbers (list): phone numbers as strings
+        birth_dates (list): birth dates as strings
+
+    Returns:
+        tuple: (list of REGISTRATION_FEEDBACK keys, None for valid rows,
+            numpy int64 array of the citizen ids,
+            numpy datetime64[D] array of the birth dates)
+    """
+    valid_id, numbers = check_citizen_ids(citizen_ids)
+    valid_phone = check_phone_numbers(phone_numbers)
+    dates = parse_dates(birth_dates)
+    valid_date = ~np.isnat(dates)
+    ages = datetime.now().year - (
+        dates.astype("datetime64[Y]").astype(np.int64) + 1970)
+
+    codes = np.select([
+        ~valid_id, ~valid_phone, ~valid_date, ages <= 12
+    ], ["invalid_id", "invalid_phone_number", "invalid_birthdate",
+        "invalid_age"], "")
+    return [code or None for code in codes.tolist()], numbers, dates
+
+
+def get_user_privileges(username):
+    """Return the privileges of an API user, cached for a short time.
+
+    The cache keeps the PRIVILEGE_CACHE_SIZE most recently used users, each
+    for PRIVILEGE_CACHE_SECONDS, so a privilege change takes effect in every
+    worker within that time.
+
+    Args:
+        username (str): username of the user
+
+    Returns:
+        tuple: (is_admin, has_privilege), both False for an unknown user
+    """
+    now = time.monotonic()
+    with _privilege_lock:
+        cached = _privilege_cache.get(username)
+        if cached and cached[0] > now:
+            _privilege_cache.move_to_end(username)
+            return cached[1]
+
+    user = Users.query.filter_by(username=username).first()
+    privileges = (bool(user.is_admin),
+                  bool(user.has_privilege)) if user else (False, False)
+
+    with _privilege_lock:
+        _privilege_cache[username] = (now + PRIVILEGE_CACHE_SECONDS,
+                                      privileges)
+        _privilege_cache.move_to_end(username)
+        while len(_privilege_cache) > PRIVILEGE_CACHE_SIZE:
+            _privilege_cache.popitem(last=False)
+    return privileges
+
+
+def forget_user_privileges(username):
+    """Drop the cached privileges of a user after the user is created or changed
+
+    Args:
+        username (str): username of the user
+    """
+    with _privilege_lock:
+        _privilege_cache.pop(username, None)
+
+
+def parse_citizen_id(citizen_id):
+    """Return the integer value of citizen_id if it is a valid 13 digits id
 
     Args:
         citizen_id (string): id of a citizen
 
     Returns:
-        bool: True if valid citizen_id, False otherwise
+        int: the citizen id to compare with the BIGINT columns, None if invalid
     """
-    return citizen_id.isdigit() and len(citizen_id) == 13 and valid_id(citizen_id)
+    if (isinstance(citizen_id, str) and citizen_id.isdigit()
+            and len(citizen_id) == 13 and valid_id(citizen_id)):
+        return int(citizen_id)
+    return None
 
 
 def is_phone_number(phone_number):
     return not (len(phone_number) != 10 or phone_number[0] != '0' or phone_number[1] not in ['6', '8', '9'])
 
 
-def is_registered(citizen_id):
-    """Return True if citizen_id is registered in database
+def load_citizen_context(citizen_id):
+    """Return the citizen and their unchecked reservation, loaded once per request.
+
+    The citizen, their doses and their unchecked reservation are read in a
+    single query and memoized on flask.g, so the is_* helpers and getters
+    below share it instead of querying again.
 
     Args:
-        citizen_id (string): id of a citizen
+        citizen_id (int): id of a citizen
 
     Returns:
-        bool: True if citizen_id is registered, False otherwise
+        tuple: (Citizen, Reservation), either can be None when it does not exist
+    """
+    contexts = g.setdefault("citizen_contexts", {})
+    key = str(citizen_id)
+    if key not in contexts:
+        row = db.session.query(Citizen, Reservation).outerjoin(
+            Reservation,
+            db.and_(Reservation.citizen_id == Citizen.citizen_id,
+                    Reservation.checked == False)).options(
+                        joinedload(Citizen.doses)).filter(
+                            Citizen.citizen_id == citizen_id).first()
+        contexts[key] = tuple(row) if row else (None, None)
+    return contexts[key]
+
+
+def validate_registration(values):
+    """Check the registration fields of a citizen.
+
+    Args:
+        values (dict): the fields of REGISTRATION_FIELDS as strings
+
+    Returns:
+        tuple: (feedback key, None) if the registration is invalid,
+            (None, the Citizen arguments) if it is valid
     """
-    return db.session.query(Citizen).filter(
-        Citizen.citizen_id == citizen_id).count() >= 1
+    if not all(values.get(field) for field in REGISTRATION_FIELDS):
+        return "missing_key", None
+
+    citizen_id = parse_citizen_id(values["citizen_id"])
+    if citizen_id is None:
+        return "invalid_id", None
+
+    if not is_phone_number(values["phone_number"]):
+        return "invalid_phone_number", None
+
+    try:
+        birth_date = parsing_date(values["birth_date"]).date()
+    except ValueError:
+        return "invalid_birthdate", None
+    if delta_year(birth_date) <= 12:
+        return "invalid_age", None
+
+    return None, registration_row(values, citizen_id, birth_date)
 
 
-def is_phoned(phone_number):
-    """Return True if phone_number is registered in database
+def registration_row(values, citizen_id, birth_date):
+    """Return the Citizen arguments of a validated registration
 
     Args:
-        phone_number (string): phone number
+        values (dict): the fields of REGISTRATION_FIELDS as strings
+        citizen_id (int): the parsed citizen id
+        birth_date (date): the parsed birth date
 
     Returns:
-        bool: True if phone_number is registered, False otherwise
+        dict: the Citizen arguments
+    """
+    return {
+        "citizen_id": citizen_id,
+        "name": values["name"],
+        "surname": values["surname"],
+        "birth_date": birth_date,
+        "occupation": values["occupation"],
+        "phone_number": values["phone_number"],
+        "is_risk": values["is_risk"] == "true",
+        "address": values["address"]
+    }
+
+
+def iter_chunks(items, size):
+    """Yield lists of up to size consecutive items
+
+    Args:
+        items (iterable): the items to split
+        size (int): the maximum length of a chunk
+
+    Returns:
+        generator: lists of items
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def read_records(stream, is_csv):
+    """Read the uploaded records of a batch request one at a time.
+
+    Args:
+        stream (iterable): the binary request body, read line by line
+        is_csv (bool): True for CSV with a header row, False for NDJSON
+
+    Returns:
+        generator: a dict of string values per record, an empty dict for an
+            NDJSON line that is not a json object
+    """
+    # request.stream may be the server's raw input, which only iterates
+    text = codecs.iterdecode(stream, "utf-8-sig")
+    if is_csv:
+        yield from csv.DictReader(text)
+        return
+
+    for line in text:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        if not isinstance(record, dict):
+            yield {}
+            continue
+        yield {
+            key: json.dumps(value) if isinstance(value, bool) else
+            (str(value) if value is not None else None)
+            for key, value in record.items()
+        }
+
+
+def register_citizens(records):
+    """Register citizens in chunks of REGISTRATION_BATCH_SIZE.
+
+    Every chunk is validated column by column with
+    validate_registration_columns(), inserted with one multi-row INSERT that
+    skips duplicates and committed on its own.
+
+    Args:
+        records (iterable): dicts of registration fields
+
+    Returns:
+        generator: (line, citizen_id, REGISTRATION_FEEDBACK key) per record
+    """
+    for chunk in iter_chunks(enumerate(records, 1), REGISTRATION_BATCH_SIZE):
+        yield from register_chunk(chunk)
+
+
+def insert_registrations(valid):
+    """Insert the validated rows of register_chunk() in one transaction and
+    set their feedback key, the ids or phone numbers already registered
+    are skipped
+
+    Args:
+        valid (list): [line, citizen id, None, registration_row()] results
+    """
+    inserted = {
+        citizen_id
+        for citizen_id, in db.session.execute(
+            postgresql.insert(Citizen.__table__).values(
+                [result[3] for result in valid]).on_conflict_do_nothing(
+                ).returning(Citizen.citizen_id))
+    }
+    skipped = []
+    for result in valid:
+        if result[3]["citizen_id"] in inserted:
+            inserted.discard(result[3]["citizen_id"])
+            result[2] = "success"
+        else:
+            skipped.append(result)
+
+    if skipped:
+        registered = {
+            citizen_id
+            for citizen_id, in db.session.query(Citizen.citizen_id).filter(
+                Citizen.citizen_id.in_(
+                    [result[3]["citizen_id"] for result in skipped]))
+        }
+        for result in skipped:
+            result[2] = ("registered"
+                         if result[3]["citizen_id"] in registered else "phoned")
+    db.session.commit()
+
+
+def register_chunk(chunk):
+    """Register one chunk of register_citizens()"""
+    results = []
+    complete = []
+    for line, values in chunk:
+        result = [line, values.get("citizen_id"), None, None]
+        results.append(result)
+        if all(values.get(field) for field in REGISTRATION_FIELDS):
+            complete.append((result, values))
+        else:
+            result[2] = "missing_key"
+
+    feedback_keys, citizen_ids, birth_dates = validate_registration_columns(
+        [values["citizen_id"] for result, values in complete],
+        [values["phone_number"] for result, values in complete],
+        [values["birth_date"] for result, values in complete])
+    for (result, values), feedback_key, citizen_id, birth_date in zip(
+            complete, feedback_keys, citizen_ids.tolist(),
+            birth_dates.tolist()):
+        result[2] = feedback_key
+        if feedback_key is None:
+            result[3] = registration_row(values, citizen_id, birth_date)
+
+    valid = [result for result in results if result[2] is None]
+    if valid:
+        try:
+            insert_registrations(valid)
+        except Exception:
+            # a row the table refuses, e.g. a name too long for its column,
+            # fails the whole insert: the rows are inserted one by one so
+            # that only it is rejected
+            db.session.rollback()
+            logger.warning("batch registration - chunk failed, registering "
+                           "its %s rows one by one", len(valid))
+            for result in valid:
+                try:
+                    insert_registrations([result])
+                except Exception:
+                    db.session.rollback()
+                    logger.exception(REGISTRATION_FEEDBACK["other"])
+                    result[2] = "other"
+
+    logger.info("batch registration - %s of %s rows registered",
+                sum(result[2] == "success" for result in results),
+                len(results))
+    for line, citizen_id, feedback_key, row in results:
+        yield line, citizen_id, feedback_key
+
+
+def is_registered(citizen_id):
+    """Return True if citizen_id is registered in database
+
+    Args:
+        citizen_id (int): id of a citizen
+
+    Returns:
+        bool: True if citizen_id is registered, False otherwise
     """
-    return db.session.query(Citizen).filter(
-        Citizen.phone_number == phone_number).count() >= 1
+    return load_citizen_context(citizen_id)[0] is not None
 
 
 def is_reserved(citizen_id):
     """Return True if citizen_id is reserved in database
 
     Args:
-        citizen_id (string): id of a citizen
+        citizen_id (int): id of a citizen
 
     Returns:
         bool: True if citizen_id is reserved, False otherwise
     """
-    return db.session.query(Reservation).filter(
-        Reservation.citizen_id == citizen_id).filter(
-            Reservation.checked == False).count() > 0
+    return load_citizen_context(citizen_id)[1] is not None
 
 
-def get_unchecked_reservations(citizen_id):
-    """Return query of unchecked reservations of citizen
+def get_reservations(citizen_id):
+    """Return query of all reservations of citizen
 
     Args:
-        citizen_id (string): id of a citizen
+        citizen_id (int): id of a citizen
 
     Returns:
-        query: citizen's unchecked reservations
+        query: citizen's reservations
     """
     return db.session.query(Reservation).filter(
-        Reservation.citizen_id == citizen_id).filter(
-            Reservation.checked == False)
+        Reservation.citizen_id == citizen_id)
+
+
+def get_unchecked_reservation(citizen_id):
+    """Return the unchecked reservation of citizen
+
+    Args:
+        citizen_id (int): id of a citizen
+
+    Returns:
+        Reservation: citizen's unchecked reservation, None if there is none
+    """
+    return load_citizen_context(citizen_id)[1]
 
 
 def get_citizen(citizen_id):
     """Return citizen of the citizen_id
 
     Args:
-        citizen_id (string): id of a citizen
+        citizen_id (int): id of a citizen
 
     Returns:
         Citizen: citizen of the citizen_id
     """
-    return db.session.query(Citizen).filter(
-        Citizen.citizen_id == citizen_id).first()
+    return load_citizen_context(citizen_id)[0]
+
+
+def get_citizen_version(citizen_id):
+    """Return the validators of a citizen's data without loading the row
+
+    Args:
+        citizen_id (int): id of a citizen
+
+    Returns:
+        tuple: (id, version, updated_at) of the citizen, None if not
+            registered. The id changes when a citizen is deleted and
+            registered again, the version on every change since.
+    """
+    return db.session.query(Citizen.id, Citizen.version,
+                            Citizen.updated_at).filter(
+                                Citizen.citizen_id == citizen_id).first()
+
+
+def get_cached_response(kind, citizen_id, version, render):
+    """Return a serialized response about a citizen from the LRU cache
+
+    The RESPONSE_CACHE_SIZE most recently used bodies are kept. A body is
+    only reused while the citizen's (id, version) is the one it was rendered
+    for, so a write served by another worker is never hidden.
+
+    Args:
+        kind (str): one of RESPONSE_KINDS
+        citizen_id (int): id of the citizen
+        version (tuple): (id, version) from get_citizen_version()
+        render (function): returns the body when it is not cached
+
+    Returns:
+        str: the body
+    """
+    key = (kind, citizen_id)
+    with _response_lock:
+        cached = _response_cache.get(key)
+        if cached and cached[0] == version:
+            _response_cache.move_to_end(key)
+            return cached[1]
+
+    body = render()
+    with _response_lock:
+        _response_cache[key] = (version, body)
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+    return body
+
+
+def forget_citizens(citizen_ids=None):
+    """Drop the cached responses of citizens, of all of them if None"""
+    with _response_lock:
+        if citizen_ids is None:
+            _response_cache.clear()
+            return
+        for citizen_id in citizen_ids:
+            for kind in RESPONSE_KINDS:
+                _response_cache.pop((kind, citizen_id), None)
+
+
+def touch_citizens(citizen_ids):
+    """Bump the version of citizens whose data changed, in the current
+    transaction, and drop their cached responses
+
+    Every write to a citizen, their reservations or doses calls it.
+
+    Args:
+        citizen_ids (collection): ids of the citizens
+    """
+    citizen_ids = set(citizen_ids)
+    if not citizen_ids:
+        return
+    db.session.query(Citizen).filter(
+        Citizen.citizen_id.in_(citizen_ids)).update(
+            {
+                Citizen.version: Citizen.version + 1,
+                Citizen.updated_at: datetime.utcnow()
+            },
+            synchronize_session=False)
+    forget_citizens(citizen_ids)
+
+
+def record_reservation_changes(operation, reservations):
+    """Append reservation changes to the change feed, in the current
+    transaction
+
+    Every write to the reservation table calls it, see ReservationChange.
+    The sites of the changes are notified on CHANGE_CHANNEL when the
+    transaction commits, a reset notifies every site with an empty payload.
+
+    Args:
+        operation (str): "insert", "update", "delete" or "reset"
+        reservations (iterable): (reservation id, citizen id, site name) of
+            the changed reservations
+    """
+    timestamp = datetime.utcnow()
+    changes = [{
+        "operation": operation,
+        "reservation_id": reservation_id,
+        "citizen_id": citizen_id,
+        "site_name": site_name,
+        "timestamp": timestamp
+    } for reservation_id, citizen_id, site_name in reservations]
+    if not changes:
+        return
+    db.session.execute(ReservationChange.__table__.insert(), changes)
+    # Postgres drops the duplicate notifications of a transaction
+    db.session.execute(text("SELECT pg_notify(:channel, :site_name)"), [{
+        "channel": CHANGE_CHANNEL,
+        "site_name": site_name or ""
+    } for site_name in {change["site_name"] for change in changes}])
+
+
+def parse_change_cursor(cursor):
+    """Return the (transaction_id, id) of a change feed cursor, or None
+
+    Args:
+        cursor (str): "<transaction_id>.<id>" of the last change read, None
+            to read from the start
+    """
+    if cursor is None:
+        return 0, 0
+    try:
+        transaction_id, change_id = (int(part) for part in cursor.split("."))
+    except ValueError:
+        return None
+    return transaction_id, change_id
+
+
+def format_change_cursor(since):
+    """Return the cursor string of a (transaction_id, id), the inverse of
+    parse_change_cursor()"""
+    return "{}.{}".format(*since)
+
+
+def get_reservation_changes(since, limit, site_name=None):
+    """Return the reservation changes after a cursor, with the current
+    state of the reservations
+
+    Only the changes of transactions older than every running transaction
+    are returned, so a change committed later can never appear before a
+    cursor that was already handed out.
+
+    Args:
+        since (tuple): (transaction_id, id) from parse_change_cursor()
+        limit (int): the maximum number of changes
+        site_name (str): only return the changes of this site and the
+            resets, all changes when None
+
+    Returns:
+        list: (ReservationChange, Reservation or None if it no longer
+            exists) in feed order
+    """
+    query = db.session.query(ReservationChange, Reservation).outerjoin(
+        Reservation, Reservation.id == ReservationChange.reservation_id)
+    if site_name is not None:
+        query = query.filter(
+            db.or_(ReservationChange.site_name == site_name,
+                   ReservationChange.operation == "reset"))
+    return query.filter(
+        db.tuple_(ReservationChange.transaction_id, ReservationChange.id) >
+        since).filter(
+            ReservationChange.transaction_id < db.func.txid_snapshot_xmin(
+                db.func.txid_current_snapshot())).order_by(
+                    ReservationChange.transaction_id,
+                    ReservationChange.id).limit(limit).all()
+
+
+def get_last_change_cursor():
+    """Return the (transaction_id, id) of the last change
+    get_reservation_changes() can return, (0, 0) if there is none"""
+    last = db.session.query(
+        ReservationChange.transaction_id, ReservationChange.id).filter(
+            ReservationChange.transaction_id < db.func.txid_snapshot_xmin(
+                db.func.txid_current_snapshot())).order_by(
+                    ReservationChange.transaction_id.desc(),
+                    ReservationChange.id.desc()).first()
+    return tuple(last) if last else (0, 0)
+
+
+def get_change_dict(change, reservation):
+    """Return the json data of a change of get_reservation_changes()"""
+    return {
+        "operation": change.operation,
+        "reservation_id": change.reservation_id,
+        "citizen_id": format_citizen_id(change.citizen_id)
+        if change.citizen_id is not None else None,
+        "timestamp": str(change.timestamp),
+        "reservation": reservation.get_dict() if reservation else None
+    }
+
+
+def get_violation_key(error, default):
+    """Return the feedback key of the unique constraint violated by a failed write
+
+    Args:
+        error (Exception): the error raised by the commit
+        default (str): the feedback key for any other error
+
+    Returns:
+        str: key of REGISTRATION_FEEDBACK or RESERVATION_FEEDBACK
+    """
+    orig = getattr(error, "orig", None)
+    if isinstance(orig, UniqueViolation):
+        return UNIQUE_VIOLATION_KEYS.get(orig.diag.constraint_name, default)
+    return default
+
+
+def add_dose(citizen, vaccine_name, site_name=None):
+    """Append a dose to the citizen's vaccine history.
+
+    Only the new Dose row is inserted on commit, the earlier doses are untouched.
+
+    Args:
+        citizen (Citizen): the citizen who took the vaccine
+        vaccine_name (str): name of the vaccine
+        site_name (str): name of the vaccination site, None if unknown
+
+    Returns:
+        Dose: the new dose
+    """
+    dose = Dose(citizen.citizen_id, vaccine_name,
+                len(citizen.doses) + 1, site_name)
+    citizen.doses.append(dose)
+    return dose
+
+
+def record_dose(citizen, reservation, vaccine_name):
+    """Record a dose taken by the citizen, checking their reservation if any
+
+    Args:
+        citizen (Citizen): the citizen who took the vaccine
+        reservation (Reservation): the reservation the dose was taken for,
+            None for a walk-in
+        vaccine_name (str): name of the vaccine
+
+    Returns:
+        Dose: the new dose
+    """
+    if reservation is None:
+        return add_dose(citizen, vaccine_name)
+    reservation.checked = True
+    return add_dose(citizen, vaccine_name, reservation.site_name)
+
+
+def check_report(citizen, reservation, vaccine_name, option):
+    """Check a dose report against the citizen's history and reservation
+
+    Args:
+        citizen (Citizen): the citizen, None if not registered
+        reservation (Reservation): the citizen's unchecked reservation, None if none
+        vaccine_name (str): name of the vaccine taken
+        option (str): "walk-in" or "reserve"
+
+    Returns:
+        tuple: (REPORT_FEEDBACK key, feedback), the key is "success" when
+            the dose can be recorded, or "invalid_sequence" with the
+            feedback of validate_vaccine()
+    """
+    if citizen is None:
+        return "not_registered", REPORT_FEEDBACK["not_registered"]
+
+    if not is_vaccine_name(vaccine_name):
+        return "invalid_vaccine", REPORT_FEEDBACK["invalid_vaccine"]
+
+    if option == "walk-in":
+        if reservation is not None:
+            return "has_reservation", REPORT_FEEDBACK["has_reservation"]
+        is_valid, json_data = validate_vaccine(citizen, vaccine_name)
+        if not is_valid:
+            return "invalid_sequence", json_data["feedback"]
+
+    elif option == "reserve":
+        if reservation is None:
+            return "not_reservation", REPORT_FEEDBACK["not_reservation"]
+        if reservation.vaccine_name != vaccine_name:
+            return "not_match_vaccine", REPORT_FEEDBACK["not_match_vaccine"]
+
+    else:
+        return "invalid_option", REPORT_FEEDBACK["invalid_option"]
+
+    return "success", REPORT_FEEDBACK["success"]
+
+
+def report_doses(records):
+    """Apply dose reports in chunks of REPORT_BATCH_SIZE.
+
+    Args:
+        records (iterable): dicts with citizen_id, vaccine_name and option
+
+    Returns:
+        generator: (line, citizen_id, REPORT_FEEDBACK key, feedback) per record
+    """
+    for chunk in iter_chunks(enumerate(records, 1), REPORT_BATCH_SIZE):
+        yield from report_chunk(chunk)
+
+
+def report_chunk(chunk):
+    """Apply one chunk of report_doses()"""
+    results = []
+    for line, values in chunk:
+        citizen_id = parse_citizen_id(values.get("citizen_id"))
+        if not (values.get("citizen_id") and values.get("vaccine_name")
+                and values.get("option")):
+            feedback_key = "missing_key"
+        elif citizen_id is None:
+            feedback_key = "invalid_id"
+        else:
+            feedback_key = None
+        results.append([
+            line,
+            values.get("citizen_id"), feedback_key,
+            REPORT_FEEDBACK.get(feedback_key), citizen_id, values
+        ])
+
+    pending = [result for result in results if result[2] is None]
+    if pending:
+        citizen_ids = {result[4] for result in pending}
+        citizens = {
+            citizen.citizen_id: citizen
+            for citizen in db.session.query(Citizen).filter(
+                Citizen.citizen_id.in_(citizen_ids))
+        }
+        reservations = {
+            reservation.citizen_id: reservation
+            for reservation in db.session.query(Reservation).filter(
+                Reservation.citizen_id.in_(citizen_ids)).filter(
+                    Reservation.checked == False)
+        }
+
+        checked = []
+        for result in pending:
+            citizen_id, values = result[4], result[5]
+            reservation = reservations.get(citizen_id)
+            result[2], result[3] = check_report(citizens.get(citizen_id),
+                                                reservation,
+                                                values["vaccine_name"],
+                                                values["option"])
+            if result[2] == "success":
+                reservation = reservations.pop(
+                    citizen_id) if values["option"] == "reserve" else None
+                record_dose(citizens[citizen_id], reservation,
+                            values["vaccine_name"])
+                if reservation is not None:
+                    checked.append((reservation.id, citizen_id,
+                                    reservation.site_name))
+        touch_citizens(result[4] for result in pending
+                       if result[2] == "success")
+        record_reservation_changes("update", checked)
+
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            logger.exception(REPORT_FEEDBACK["other"])
+            for result in pending:
+                if result[2] == "success":
+                    result[2], result[3] = "other", REPORT_FEEDBACK["other"]
+
+    logger.info("batch report - %s of %s doses recorded",
+                sum(result[2] == "success" for result in results),
+                len(results))
+    for line, citizen_id, feedback_key, feedback, *_ in results:
+        yield line, citizen_id, feedback_key, feedback
+
+
+def schedule_queue(site_name, start, end, slot_minutes, capacity):
+    """Give a queue to the waiting reservations of a site, filling every slot.
+
+    The slots of slot_minutes from start to end each take up to capacity
+    reservations, less the ones already queued in them. Unchecked
+    reservations of the site without a queue are queued at-risk citizens
+    first, then by reservation time, with one UPDATE. The reservations are
+    locked with SKIP LOCKED so a concurrent cancel or report is neither
+    blocked nor overwritten. The schedules of a site take its advisory lock
+    before counting the booked slots, until the transaction ends, so two of
+    them cannot both fill the same free places.
+
+    Args:
+        site_name (str): name of the vaccination site
+        start (datetime): the start of the first slot
+        end (datetime): the end of the time range
+        slot_minutes (int): length of a slot
+        capacity (int): number of citizens a slot can take
+
+    Returns:
+        int: the number of reservations queued
+    """
+    slot_length = timedelta(minutes=slot_minutes)
+    slot_count = int((end - start) / slot_length)
+
+    db.session.execute(
+        text("SELECT pg_advisory_xact_lock(hashtext('schedule_queue'), "
+             "hashtext(:site_name))"), {"site_name": site_name})
+    booked = Counter()
+    for queue, count in db.session.query(
+            Reservation.queue, db.func.count()).filter(
+                Reservation.site_name == site_name).filter(
+                    Reservation.queue >= start).filter(
+                        Reservation.queue < start +
+                        slot_length * slot_count).group_by(Reservation.queue):
+        booked[int((queue - start) / slot_length)] += count
+
+    slots, firsts, lasts = [], [], []
+    total = 0
+    for index in range(slot_count):
+        free = capacity - booked[index]
+        if free > 0:
+            slots.append(start + slot_length * index)
+            firsts.append(total + 1)
+            lasts.append(total + free)
+            total += free
+
+    if total == 0:
+        return 0
+
+    result = db.session.execute(
+        text("""
+        WITH waiting AS (
+            SELECT reservation.id, citizen.is_risk, reservation.timestamp
+            FROM reservation
+            JOIN citizen ON citizen.citizen_id = reservation.citizen_id
+            WHERE reservation.site_name = :site_name
+                AND NOT reservation.checked
+                AND reservation.queue IS NULL
+            ORDER BY citizen.is_risk DESC NULLS LAST,
+                reservation.timestamp, reservation.id
+            LIMIT :total
+            FOR UPDATE OF reservation SKIP LOCKED
+        ), ranked AS (
+            SELECT id, row_number() OVER (
+                ORDER BY is_risk DESC NULLS LAST, timestamp, id) AS position
+            FROM waiting
+        ), slot AS (
+            SELECT * FROM unnest(CAST(:slots AS TIMESTAMP[]),
+                                 CAST(:firsts AS INTEGER[]),
+                                 CAST(:lasts AS INTEGER[]))
+                AS slot (queue, first, last)
+        )
+        UPDATE reservation SET queue = slot.queue
+        FROM ranked JOIN slot
+            ON ranked.position BETWEEN slot.first AND slot.last
+        WHERE reservation.id = ranked.id
+        RETURNING reservation.id, reservation.citizen_id,
+            reservation.site_name"""), {
+            "site_name": site_name,
+            "total": total,
+            "slots": slots,
+            "firsts": firsts,
+            "lasts": lasts
+        })
+    queued = result.fetchall()
+    touch_citizens(citizen_id for reservation_id, citizen_id, _ in queued)
+    record_reservation_changes("update", queued)
+    return len(queued)
 
 
 def is_vaccine_name(vaccine_name):
@@ -188,12 +1193,12 @@ def is_vaccine_name(vaccine_name):
     Returns:
         bool: True if vaccine_name is valid, False otherwise
     """
-    return any(vaccine_name in sublist for sublist in VACCINE_SEQUENCE)
+    return vaccine_name in get_vaccine_rules().names
 
 
 def validate_vaccine(citizen, vaccine_name):
     vaccines = get_available_vaccine(citizen.vaccine_taken)
-    print("Going to check vaccine")
+    logger.debug("Going to check vaccine")
     if not vaccine_name in vaccines:
         if len(vaccines) == 0:
             feedback = f"reservation failed: you finished all vaccinations"
@@ -203,3 +1208,96 @@ def validate_vaccine(citizen, vaccine_name):
             feedback = f"reservation failed: your available vaccines are only {vaccines}"
         return False, {"feedback": feedback}
     return True, {}
+
+
+def iter_page(model, after=0, limit=DATABASE_PAGE_SIZE):
+    """Yield one keyset page of a table in id order through a server-side cursor.
+
+    Args:
+        model (db.Model): the model of the table
+        after (int): only rows with an id greater than this are returned
+        limit (int): maximum number of rows
+
+    Returns:
+        generator: model instances
+    """
+    return db.session.query(model).filter(model.id > after).order_by(
+        model.id).limit(limit).execution_options(
+            stream_results=True).yield_per(STREAM_BATCH_SIZE)
+
+
+def get_daily_stats(group_by,
+                    site_name=None,
+                    vaccine_name=None,
+                    first_day=None,
+                    last_day=None):
+    """Return the reservation and dose counters summed by some of the
+    site, vaccine and day, read from the daily_stat table
+
+    Args:
+        group_by (list): names of the DailyStat keys to group by, the counts
+            are summed over the other keys
+        site_name (str): only count this site, all sites when None
+        vaccine_name (str): only count this vaccine, all vaccines when None
+        first_day (date): only count the days from this one, None for no
+            limit
+        last_day (date): only count the days up to this one, None for no
+            limit
+
+    Returns:
+        list: rows of the group_by keys then pending, queued, checked and
+            doses, in key order
+    """
+    keys = [getattr(DailyStat, key) for key in group_by]
+    query = db.session.query(
+        *keys, *(db.func.coalesce(db.func.sum(counter), 0).label(counter.key)
+                 for counter in STAT_COUNTERS))
+    # the counters of a key can drop back to zero, such rows are left out
+    query = query.filter(db.or_(*(counter != 0 for counter in STAT_COUNTERS)))
+    if site_name is not None:
+        query = query.filter(DailyStat.site_name == site_name)
+    if vaccine_name is not None:
+        query = query.filter(DailyStat.vaccine_name == vaccine_name)
+    if first_day is not None:
+        query = query.filter(DailyStat.day >= first_day)
+    if last_day is not None:
+        query = query.filter(DailyStat.day <= last_day)
+    if keys:
+        query = query.group_by(*keys).order_by(*keys)
+    return query.all()
+
+
+def recompute_daily_stats():
+    """Rebuild the daily_stat counters from the reservation and dose tables,
+    in the current transaction"""
+    for statement in RECOMPUTE_DAILY_STATS:
+        db.session.execute(text(statement))
+
+
+def approximate_count(model):
+    """Return the estimated number of rows of a table, cached for a short time.
+
+    The estimate comes from the planner statistics, so it costs no table scan.
+    An exact count is used when the statistics have no rows, the table has
+    never been analyzed (reltuples is -1, or 0 before PostgreSQL 14) or is
+    empty, and counting it is cheap.
+
+    Args:
+        model (db.Model): the model of the table
+
+    Returns:
+        int: estimated number of rows
+    """
+    table = model.__tablename__
+    cached = _count_cache.get(table)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    count = db.session.execute(
+        text("SELECT reltuples::bigint FROM pg_class WHERE relname = :table"),
+        {"table": table}).scalar()
+    if count is None or count <= 0:
+        count = db.session.query(model).count()
+
+    _count_cache[table] = (time.monotonic() + COUNT_CACHE_SECONDS, count)
+    return count
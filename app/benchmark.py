@@ -0,0 +1,117 @@
+"""Compare the scalar and column-wise registration validation.
+
+    $ python -m app.benchmark [ROWS]
+
+Synthetic registrations, valid and invalid, are validated row by row with
+validate_registration() and column by column with
+validate_registration_columns(). The command exits with status 1 if the two
+paths disagree on any row, and prints the rows per second of both.
+"""
+import random
+import sys
+import time
+
+from app.assistant import *
+
+DEFAULT_ROWS = 100000
+
+DATE_FORMATS = ['%d %b %Y', '%d-%m-%Y', '%Y-%m-%d', '%d/%m/%Y', '%Y/%m/%d']
+INVALID_CITIZEN_IDS = ["", "123", "abcdefghijklm", "1111111111111",
+                       "11111111111190", "๑๑๑๑๑๑๑๑๑๑๑๑๙"]
+INVALID_PHONE_NUMBERS = ["", "0711111111", "081111111", "08111111111"]
+INVALID_BIRTH_DATES = ["", "30-02-1990", "31/04/1990", "1990-13-01",
+                       "1 Foo 1990", "1990-1-1 ", "1  Jan 1990", "29-02-2000",
+                       "29-02-1900", "01 jan 2020", " 1 Jan 2000",
+                       " 1-02-2000", "2000/ 2/ 1", "  1 Jan 2000",
+                       " 2000-01-01", " 01 Jan 2000"]
+
+
+def make_rows(count, seed=0):
+    """Return count registrations, about one in ten of them invalid"""
+    generator = random.Random(seed)
+    rows = []
+    for number in range(count):
+        birth_date = datetime(generator.randint(1920, 2020),
+                              generator.randint(1, 12),
+                              generator.randint(1, 28))
+        values = {
+            "citizen_id": make_citizen_id(100000000000 + number),
+            "name": "name",
+            "surname": "surname",
+            "birth_date": birth_date.strftime(generator.choice(DATE_FORMATS)),
+            "occupation": "occupation",
+            "phone_number": "08{:08d}".format(number),
+            "is_risk": "false",
+            "address": "address"
+        }
+        if generator.random() < 0.1:
+            field, choices = generator.choice([
+                ("citizen_id", INVALID_CITIZEN_IDS),
+                ("phone_number", INVALID_PHONE_NUMBERS),
+                ("birth_date", INVALID_BIRTH_DATES),
+            ])
+            values[field] = generator.choice(choices)
+        rows.append(values)
+    return rows
+
+
+def validate_scalar(rows):
+    """Return the validate_registration() results of rows"""
+    return [validate_registration(values) for values in rows]
+
+
+def validate_columns(rows):
+    """Return the validate_registration_columns() results of rows, in the
+    same form as validate_scalar()"""
+    complete = [
+        values for values in rows
+        if all(values.get(field) for field in REGISTRATION_FIELDS)
+    ]
+    feedback_keys, citizen_ids, birth_dates = validate_registration_columns(
+        [values["citizen_id"] for values in complete],
+        [values["phone_number"] for values in complete],
+        [values["birth_date"] for values in complete])
+    results = iter(
+        zip(complete, feedback_keys, citizen_ids.tolist(),
+            birth_dates.tolist()))
+    validated = []
+    for values in rows:
+        if not all(values.get(field) for field in REGISTRATION_FIELDS):
+            validated.append(("missing_key", None))
+            continue
+        values, feedback_key, citizen_id, birth_date = next(results)
+        validated.append((feedback_key, None) if feedback_key else (
+            None, registration_row(values, citizen_id, birth_date)))
+    return validated
+
+
+def measure(validate, rows):
+    """Return the result of validate(rows) and its rows per second"""
+    start = time.perf_counter()
+    result = validate(rows)
+    return result, len(rows) / (time.perf_counter() - start)
+
+
+def main(argv):
+    count = int(argv[0]) if argv else DEFAULT_ROWS
+    rows = make_rows(count)
+
+    scalar, scalar_speed = measure(validate_scalar, rows)
+    columns, columns_speed = measure(validate_columns, rows)
+
+    mismatches = [(values, expected, actual)
+                  for values, expected, actual in zip(rows, scalar, columns)
+                  if expected != actual]
+    for values, expected, actual in mismatches[:10]:
+        print("MISMATCH {}: scalar {} columns {}".format(
+            values, expected, actual))
+
+    print("rows     {}".format(count))
+    print("scalar   {:,.0f} rows/s".format(scalar_speed))
+    print("columns  {:,.0f} rows/s ({:.1f}x)".format(
+        columns_speed, columns_speed / scalar_speed))
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
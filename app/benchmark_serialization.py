@@ -0,0 +1,134 @@
+"""Compare the ORM and the row tuple serialization of GET /reservations.
+
+    $ python -m app.benchmark_serialization [ROWS]
+
+The first ROWS reservations of the database, with their citizens, are
+serialized as the JSON array of GET /reservations, once through the ORM
+objects and get_dict(), once through iter_reservation_rows() and
+RESERVATION_LIST_ENCODER. Each path runs REPEAT times and the best run
+counts. The command exits with status 1 if the two bodies differ, and
+prints the microseconds per row of both, split into reading the rows and
+encoding them. Seed the database with app.population first.
+"""
+import sys
+import time
+
+from app.serialization import *
+
+DEFAULT_ROWS = 10000
+REPEAT = 3
+
+
+def iter_reservations_with_citizen(after=0, limit=None):
+    """Yield reservation rows joined with their citizen in id order, as
+    GET /reservations read them before app/serialization.py
+
+    Args:
+        after (int): only reservations with an id greater than this are returned
+        limit (int): maximum number of reservations, None for no limit
+
+    Returns:
+        generator: (Reservation, Citizen) tuples
+    """
+    query = db.session.query(Reservation, Citizen).join(
+        Citizen, Citizen.citizen_id == Reservation.citizen_id).filter(
+            Reservation.id > after).order_by(Reservation.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.execution_options(stream_results=True).yield_per(
+        STREAM_BATCH_SIZE)
+
+
+def stream_json(items):
+    """Serialize an iterable of dicts as a JSON array, as GET /reservations
+    did before app/serialization.py
+
+    Args:
+        items (iterable): dicts to serialize
+
+    Returns:
+        generator: chunks of the serialized response body
+    """
+    yield "["
+    separator = ""
+    for item in items:
+        yield separator + json.dumps(item, ensure_ascii=False)
+        separator = ", "
+    yield "]"
+
+
+def read_orm(count):
+    """Return the (Reservation, Citizen) of the first count reservations,
+    with their doses loaded"""
+    return list(iter_reservations_with_citizen(0, count))
+
+
+def encode_orm(rows):
+    """Return the GET /reservations body of read_orm() rows, as the
+    endpoint built it before app/serialization.py"""
+
+    def generate_reservations():
+        for reservation, citizen in rows:
+            reservation_data = reservation.get_dict()
+            reservation_data["id"] = reservation.id
+            reservation_data["citizen_data"] = citizen.get_dict()
+            yield reservation_data
+
+    return "".join(stream_json(generate_reservations()))
+
+
+def read_tuples(count):
+    """Return the batches of row tuples of the first count reservations"""
+    return list(iter_reservation_rows(0, count))
+
+
+def encode_tuples(batches):
+    return "".join(stream_rows(batches, RESERVATION_LIST_ENCODER))
+
+
+def measure(read, encode, count):
+    """Return the body of the best of REPEAT runs and the microseconds per
+    row spent reading and encoding in it"""
+    best = None
+    for _ in range(REPEAT):
+        db.session.remove()
+        start = time.perf_counter()
+        rows = read(count)
+        middle = time.perf_counter()
+        body = encode(rows)
+        end = time.perf_counter()
+        if best is None or end - start < best[1] + best[2]:
+            best = (body, middle - start, end - middle)
+    return best
+
+
+def main(argv):
+    count = int(argv[0]) if argv else DEFAULT_ROWS
+    with app.app_context():
+        count = min(count, db.session.query(Reservation).count())
+        if count == 0:
+            print("no reservations, seed the database with app.population")
+            return 1
+        orm, orm_read, orm_encode = measure(read_orm, encode_orm, count)
+        tuples, tuples_read, tuples_encode = measure(read_tuples,
+                                                     encode_tuples, count)
+
+    if orm != tuples:
+        index = next(index for index, (expected, actual) in enumerate(
+            zip(orm, tuples)) if expected != actual)
+        print("MISMATCH at character {}: orm {!r} tuples {!r}".format(
+            index, orm[index - 80:index + 80], tuples[index - 80:index + 80]))
+
+    scale = 10**6 / count
+    print("rows     {}".format(count))
+    print("orm      {:.1f} us/row (read {:.1f}, encode {:.1f})".format(
+        (orm_read + orm_encode) * scale, orm_read * scale, orm_encode * scale))
+    print("tuples   {:.1f} us/row (read {:.1f}, encode {:.1f}) ({:.1f}x)".format(
+        (tuples_read + tuples_encode) * scale, tuples_read * scale,
+        tuples_encode * scale,
+        (orm_read + orm_encode) / (tuples_read + tuples_encode)))
+    return 1 if orm != tuples else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,243 @@
+"""Server-sent events of the reservation changes of each site.
+
+    GET /sites/<site_name>/events
+
+Every write to a reservation is recorded by record_reservation_changes(),
+which notifies the site on the CHANGE_CHANNEL of Postgres when the
+transaction commits. Each process runs one ChangeBroker thread that
+LISTENs on the channel, reads the new changes once with
+get_reservation_changes() and puts the formatted events on the queues of
+its subscriptions, so the gunicorn workers all see the writes of each
+other and a change is read once per worker, not once per client.
+
+The id of an event is its change feed cursor. A client that reconnects
+with a Last-Event-ID header first gets the changes it missed from the
+reservation_change table, then the live events.
+
+Configuration, from the environment:
+    EVENTS_MAX_STREAMS (int): open event streams per process, each holds a
+        worker thread, see gunicorn.conf.py
+    EVENTS_POLL_SECONDS (float): the broker reads the changes at least
+        this often, in case a notification was missed
+"""
+import json
+import os
+import queue
+import select
+import threading
+import time
+
+from app.assistant import *
+
+EVENTS_MAX_STREAMS = int(os.getenv("EVENTS_MAX_STREAMS", 16))
+EVENTS_POLL_SECONDS = float(os.getenv("EVENTS_POLL_SECONDS", 5))
+EVENTS_HEARTBEAT_SECONDS = 15
+EVENTS_RETRY_MILLISECONDS = 3000
+EVENTS_QUEUE_SIZE = 1000
+
+
+def format_event(cursor, change, reservation):
+    """Return the text/event-stream message of a change"""
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(
+        format_change_cursor(cursor), change.operation,
+        json.dumps(get_change_dict(change, reservation), ensure_ascii=False))
+
+
+class Subscription:
+    """The live events of one site for one client.
+
+    Attributes:
+        site_name (str): name of the vaccination site
+        events (Queue): (cursor, message) of the changes of the site
+        overflowed (bool): True once an event was dropped because the
+            client reads too slowly, the stream is then closed and the
+            client resumes from its Last-Event-ID
+    """
+
+    def __init__(self, site_name):
+        self.site_name = site_name
+        self.events = queue.Queue(EVENTS_QUEUE_SIZE)
+        self.overflowed = False
+
+    def put(self, cursor, message):
+        try:
+            self.events.put_nowait((cursor, message))
+        except queue.Full:
+            self.overflowed = True
+
+
+class ChangeBroker:
+    """Fan the reservation changes out to the subscriptions of this process.
+
+    The broker thread starts with the first subscription. It only follows
+    the change feed while there are subscriptions, its cursor is set again
+    from the last change when the next client subscribes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.count = 0
+        self.cursor = None
+        self.thread = None
+
+    def subscribe(self, site_name):
+        """Return a new Subscription of site_name, None if this process
+        already serves EVENTS_MAX_STREAMS streams
+
+        Must be called before the client reads its missed changes, the
+        broker then publishes every change that comes after them.
+        """
+        with self.lock:
+            if self.is_full():
+                return None
+            if self.cursor is None:
+                self.cursor = get_last_change_cursor()
+            subscription = Subscription(site_name)
+            self.subscriptions.setdefault(site_name, set()).add(subscription)
+            self.count += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name="change-broker",
+                                               daemon=True)
+                self.thread.start()
+        return subscription
+
+    def is_full(self):
+        return self.count >= EVENTS_MAX_STREAMS
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.site_name)
+            if subscriptions and subscription in subscriptions:
+                subscriptions.remove(subscription)
+                self.count -= 1
+                if not subscriptions:
+                    del self.subscriptions[subscription.site_name]
+
+    def listen(self):
+        """Return a psycopg2 connection, out of the pool, that LISTENs on
+        CHANGE_CHANNEL"""
+        connection = db.engine.raw_connection()
+        connection.detach()
+        listener = connection.connection
+        listener.autocommit = True
+        listener.cursor().execute("LISTEN {}".format(CHANGE_CHANNEL))
+        return listener
+
+    def wait(self, listener):
+        """Wait up to EVENTS_POLL_SECONDS for notifications.
+
+        Returns:
+            set: the site names notified, "" when every site was
+        """
+        if select.select([listener], [], [], EVENTS_POLL_SECONDS)[0]:
+            listener.poll()
+        sites = {notify.payload for notify in listener.notifies}
+        listener.notifies.clear()
+        return sites
+
+    def run(self):
+        listener = None
+        while True:
+            try:
+                with app.app_context():
+                    if listener is None:
+                        listener = self.listen()
+                    sites = self.wait(listener)
+                    with self.lock:
+                        if not self.subscriptions:
+                            self.cursor = None
+                            continue
+                        if sites and "" not in sites and not sites & set(
+                                self.subscriptions):
+                            continue
+                    self.publish()
+            except Exception:
+                logger.exception("change broker failed, reconnecting")
+                if listener is not None:
+                    listener.close()
+                    listener = None
+                time.sleep(EVENTS_POLL_SECONDS)
+
+    def publish(self):
+        """Put the changes after the broker cursor on the queues of the
+        subscriptions of their site, a reset on every queue"""
+        try:
+            while True:
+                with self.lock:
+                    since = self.cursor
+                changes = get_reservation_changes(since, STREAM_BATCH_SIZE)
+                for change, reservation in changes:
+                    cursor = (change.transaction_id, change.id)
+                    message = format_event(cursor, change, reservation)
+                    with self.lock:
+                        if change.operation == "reset":
+                            targets = [
+                                subscription
+                                for subscriptions in self.subscriptions.values()
+                                for subscription in subscriptions
+                            ]
+                        else:
+                            targets = list(
+                                self.subscriptions.get(change.site_name, ()))
+                    for subscription in targets:
+                        subscription.put(cursor, message)
+                with self.lock:
+                    if changes:
+                        self.cursor = (changes[-1][0].transaction_id,
+                                       changes[-1][0].id)
+                if len(changes) < STREAM_BATCH_SIZE:
+                    return
+        finally:
+            db.session.remove()
+
+
+change_broker = ChangeBroker()
+
+
+def stream_site_events(site_name, since):
+    """Yield the text/event-stream of the reservation changes of a site.
+
+    Args:
+        site_name (str): name of the vaccination site
+        since (tuple): (transaction_id, id) of the Last-Event-ID of the
+            client, None to only stream the changes from now on
+
+    Yields:
+        str: the missed changes then the live ones, with a comment every
+            EVENTS_HEARTBEAT_SECONDS so dead connections are noticed
+    """
+    subscription = change_broker.subscribe(site_name)
+    if subscription is None:
+        logger.error(EVENTS_FEEDBACK["busy"])
+        return
+
+    try:
+        yield "retry: {}\n\n".format(EVENTS_RETRY_MILLISECONDS)
+        if since is None:
+            since = get_last_change_cursor()
+        while True:
+            changes = get_reservation_changes(since, STREAM_BATCH_SIZE,
+                                              site_name)
+            for change, reservation in changes:
+                since = (change.transaction_id, change.id)
+                yield format_event(since, change, reservation)
+            if len(changes) < STREAM_BATCH_SIZE:
+                break
+        # the stream holds no database connection while it waits
+        db.session.remove()
+
+        while not subscription.overflowed:
+            try:
+                cursor, message = subscription.events.get(
+                    timeout=EVENTS_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if cursor > since:
+                since = cursor
+                yield message
+        logger.info("%s - event stream overflowed", site_name)
+    finally:
+        change_broker.unsubscribe(subscription)
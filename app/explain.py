@@ -0,0 +1,177 @@
+"""Check that every lookup in app/assistant.py is served by an index.
+
+    $ python -m app.explain
+
+Everything runs in one transaction that is rolled back at the end, so it
+can be pointed at any database: sample citizens, doses and reservations are
+inserted first, then each helper, the writes of schedule_queue() and
+report_chunk() included, is called in a request context while its SQL is
+recorded, and every recorded statement is explained with sequential scans
+disabled. A sequential scan that is still in the plan means no index can
+answer the lookup, and the command exits with status 1 so a missing or
+unusable index is caught before it reaches a national-sized table.
+"""
+from datetime import date
+from sqlalchemy import event
+import sys
+
+from app.assistant import *
+from app.jobs import fail_interrupted_jobs, get_jobs
+from app.serialization import iter_reservation_rows
+
+SAMPLE_CITIZEN_ID = 1111111111119
+SAMPLE_WALK_IN_CITIZEN_ID = 2222222222227
+SAMPLE_SITE_NAME = "OGYHSite"
+SAMPLE_VACCINE_NAME = "Pfizer"
+# the statements that have a plan, not the SAVEPOINTs of the session
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+CHECKS = [
+    ("load_citizen_context", lambda: load_citizen_context(SAMPLE_CITIZEN_ID)),
+    ("get_citizen_version", lambda: get_citizen_version(SAMPLE_CITIZEN_ID)),
+    ("get_reservations", lambda: get_reservations(SAMPLE_CITIZEN_ID).all()),
+    ("iter_reservation_rows",
+     lambda: list(iter_reservation_rows(0, MAX_PAGE_SIZE))),
+    ("get_reservation_changes",
+     lambda: get_reservation_changes((0, 0), MAX_PAGE_SIZE)),
+    ("get_reservation_changes site",
+     lambda: get_reservation_changes((0, 0), MAX_PAGE_SIZE, SAMPLE_SITE_NAME)),
+    ("get_last_change_cursor", get_last_change_cursor),
+    ("get_daily_stats", lambda: get_daily_stats(["day"], SAMPLE_SITE_NAME)),
+    ("iter_page citizen", lambda: list(iter_page(Citizen))),
+    ("iter_page reservation", lambda: list(iter_page(Reservation))),
+    ("get_jobs", get_jobs),
+    ("fail_interrupted_jobs", fail_interrupted_jobs),
+    ("schedule_queue",
+     lambda: schedule_queue(SAMPLE_SITE_NAME,
+                            datetime.now() + timedelta(days=1),
+                            datetime.now() + timedelta(days=1, hours=1), 30,
+                            10)),
+    ("report_chunk",
+     lambda: list(
+         report_chunk([(1, {
+             "citizen_id": format_citizen_id(SAMPLE_CITIZEN_ID),
+             "vaccine_name": SAMPLE_VACCINE_NAME,
+             "option": "reserve"
+         }), (2, {
+             "citizen_id": format_citizen_id(SAMPLE_WALK_IN_CITIZEN_ID),
+             "vaccine_name": SAMPLE_VACCINE_NAME,
+             "option": "walk-in"
+         })]))),
+]
+
+
+def seed_sample_data():
+    """Insert the citizens, dose and reservation the CHECKS look up, in
+    place of the rows of the database that have their ids or phone numbers
+    """
+    citizen_ids = [SAMPLE_CITIZEN_ID, SAMPLE_WALK_IN_CITIZEN_ID]
+    phone_numbers = [
+        "08{:08d}".format(index) for index in range(len(citizen_ids))
+    ]
+    Reservation.query.filter(Reservation.citizen_id.in_(citizen_ids)).delete(
+        synchronize_session=False)
+    Citizen.query.filter(
+        db.or_(Citizen.citizen_id.in_(citizen_ids),
+               Citizen.phone_number.in_(phone_numbers))).delete(
+                   synchronize_session=False)
+    db.session.add_all([
+        Citizen(citizen_id, "Sample", "Citizen", date(1990, 1, 1), "Sample",
+                phone_number, False, "Sample")
+        for citizen_id, phone_number in zip(citizen_ids, phone_numbers)
+    ])
+    db.session.flush()
+    db.session.add(Dose(SAMPLE_CITIZEN_ID, SAMPLE_VACCINE_NAME, 1,
+                        SAMPLE_SITE_NAME))
+    db.session.add(
+        Reservation(SAMPLE_CITIZEN_ID, SAMPLE_SITE_NAME, SAMPLE_VACCINE_NAME))
+    db.session.commit()
+
+
+def capture_statements(helper):
+    """Return the (statement, parameters) executed by helper"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(EXPLAINABLE):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        with app.test_request_context():
+            helper()
+            db.session.rollback()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+    return statements
+
+
+def join_transaction(connection):
+    """Bind db.session to connection, whose transaction it never ends: a
+    commit or rollback of the session ends a SAVEPOINT instead
+
+    Returns:
+        scoped_session: the session it replaces
+    """
+    session = db.session
+    db.session = db.create_scoped_session({"bind": connection, "binds": {}})
+    savepoints = [connection.begin_nested()]
+
+    @event.listens_for(db.session, "after_transaction_end")
+    def restart_savepoint(session, transaction):
+        if not savepoints[0].is_active:
+            savepoints[0] = connection.begin_nested()
+
+    return session
+
+
+def find_seq_scans(plan):
+    """Yield the tables read by a sequential scan in a JSON plan node"""
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan["Relation Name"]
+    for child in plan.get("Plans", []):
+        yield from find_seq_scans(child)
+
+
+def explain(connection, statement, parameters):
+    """Return the JSON plan of a statement, the first of an executemany"""
+    if isinstance(parameters, (list, tuple)) and parameters and isinstance(
+            parameters[0], (dict, list, tuple)):
+        parameters = parameters[0]
+    cursor = connection.connection.cursor()
+    cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+    return cursor.fetchone()[0][0]["Plan"]
+
+
+def main():
+    failures = 0
+    connection = db.engine.connect()
+    transaction = connection.begin()
+    connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+    session = join_transaction(connection)
+    try:
+        with app.app_context():
+            seed_sample_data()
+        for name, helper in CHECKS:
+            for statement, parameters in capture_statements(helper):
+                tables = sorted(
+                    set(
+                        find_seq_scans(
+                            explain(connection, statement, parameters))))
+                if tables:
+                    failures += 1
+                    print("FAIL {}: sequential scan on {}".format(
+                        name, ", ".join(tables)))
+                    print("    " + " ".join(statement.split()))
+                else:
+                    print("ok   {}".format(name))
+    finally:
+        db.session.remove()
+        db.session = session
+        transaction.rollback()
+        connection.close()
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,274 @@
+"""Export the citizen or reservation table as CSV or NDJSON.
+
+    $ python -m app.export citizen --format csv --gzip -o citizen.csv.gz
+
+The rows are read through a server-side cursor in batches of
+EXPORT_BATCH_SIZE, written to a reused buffer and optionally compressed as
+they go, so the memory used does not grow with the table. GET
+/export/<table> streams the same output to admins.
+
+--since only exports the rows of the citizens whose data changed since
+then, in UTC, see touch_citizens(): the citizens updated, and the reservations of
+those citizens.
+"""
+from collections import OrderedDict
+import argparse
+import io
+import sys
+import zlib
+
+from app.assistant import *
+from app.serialization import VACCINE_TAKEN
+
+EXPORT_BATCH_SIZE = 10000
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+# the columns of each table that can be exported, by name, in their
+# default order
+EXPORT_COLUMNS = {
+    "citizen":
+    OrderedDict([
+        ("citizen_id", Citizen.citizen_id),
+        ("name", Citizen.name),
+        ("surname", Citizen.surname),
+        ("birth_date", Citizen.birth_date),
+        ("occupation", Citizen.occupation),
+        ("phone_number", Citizen.phone_number),
+        ("is_risk", Citizen.is_risk),
+        ("address", Citizen.address),
+        ("vaccine_taken", VACCINE_TAKEN),
+        ("updated_at", Citizen.updated_at),
+    ]),
+    "reservation":
+    OrderedDict([
+        ("id", Reservation.id),
+        ("citizen_id", Reservation.citizen_id),
+        ("site_name", Reservation.site_name),
+        ("vaccine_name", Reservation.vaccine_name),
+        ("timestamp", Reservation.timestamp),
+        ("queue", Reservation.queue),
+        ("checked", Reservation.checked),
+    ]),
+}
+EXPORT_MODELS = {"citizen": Citizen, "reservation": Reservation}
+
+
+def parse_export_args(table, export_format, columns, since):
+    """Check the options of an export.
+
+    Args:
+        table (str): "citizen" or "reservation"
+        export_format (str): "csv" or "ndjson"
+        columns (str): comma separated column names, None for all of them
+        since (str): ISO date or datetime, None to export every row
+
+    Returns:
+        tuple: (list of column names, since datetime or None, feedback or
+            None), the feedback is a value of EXPORT_FEEDBACK
+    """
+    if table not in EXPORT_COLUMNS:
+        return None, None, EXPORT_FEEDBACK["invalid_table"]
+    if export_format not in EXPORT_FORMATS:
+        return None, None, EXPORT_FEEDBACK["invalid_format"]
+
+    if columns is None:
+        columns = list(EXPORT_COLUMNS[table])
+    else:
+        columns = [name.strip() for name in columns.split(",")]
+        if not columns or any(name not in EXPORT_COLUMNS[table]
+                              for name in columns) or len(
+                                  set(columns)) < len(columns):
+            return None, None, EXPORT_FEEDBACK["invalid_columns"]
+
+    if since is not None:
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            return None, None, EXPORT_FEEDBACK["invalid_since"]
+    return columns, since, None
+
+
+def iter_export_rows(table, columns, since=None):
+    """Yield batches of the exported rows in id order through a
+    server-side cursor
+
+    Args:
+        table (str): "citizen" or "reservation"
+        columns (list): names of the EXPORT_COLUMNS of the table
+        since (datetime): only export the rows of the citizens updated
+            since then in UTC, None for all rows
+
+    Returns:
+        generator: lists of up to EXPORT_BATCH_SIZE row tuples
+    """
+    model = EXPORT_MODELS[table]
+    query = db.select(*(EXPORT_COLUMNS[table][name]
+                        for name in columns)).select_from(model)
+    if since is not None:
+        if model is Reservation:
+            query = query.join(Citizen,
+                               Citizen.citizen_id == Reservation.citizen_id)
+        query = query.where(Citizen.updated_at >= since)
+    return db.session.execute(query.order_by(model.id),
+                              execution_options={
+                                  "stream_results": True
+                              }).partitions(EXPORT_BATCH_SIZE)
+
+
+def get_converters(table, columns, export_format):
+    """Return the function turning the value of each column into what the
+    format writes, None for the values written as they are
+
+    Citizen ids keep their leading zeros and dates are written as in the
+    API. The csv module writes the other values with str(), lists are
+    written as JSON.
+    """
+    converters = []
+    for name in columns:
+        column_type = EXPORT_COLUMNS[table][name].type
+        if name == "citizen_id":
+            converters.append(format_citizen_id)
+        elif export_format == "csv" and isinstance(column_type, db.ARRAY):
+            converters.append(
+                lambda value: json.dumps(value, ensure_ascii=False))
+        elif export_format == "ndjson" and isinstance(
+                column_type, (db.Date, db.DateTime)):
+            converters.append(str)
+        else:
+            converters.append(None)
+    return converters
+
+
+def convert_rows(converters, rows):
+    """Return the rows with their values converted, see get_converters()"""
+    converted = [(index, convert)
+                 for index, convert in enumerate(converters) if convert]
+    if not converted:
+        return rows
+    result = []
+    for row in rows:
+        row = list(row)
+        for index, convert in converted:
+            if row[index] is not None:
+                row[index] = convert(row[index])
+        result.append(row)
+    return result
+
+
+def encode_csv(converters, columns, batches):
+    """Yield the header then one chunk of CSV lines per batch"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue()
+    for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(convert_rows(converters, rows))
+        yield buffer.getvalue()
+
+
+def encode_ndjson(converters, columns, batches):
+    """Yield one chunk of json lines per batch"""
+    buffer = []
+    for rows in batches:
+        buffer.extend(
+            json.dumps(dict(zip(columns, row)), ensure_ascii=False)
+            for row in convert_rows(converters, rows))
+        buffer.append("")
+        yield "\n".join(buffer)
+        buffer.clear()
+
+
+def compress(chunks):
+    """Gzip a stream of text chunks on the fly
+
+    Returns:
+        generator: the compressed bytes, nothing is yielded for the chunks
+            too small to fill a deflate block
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def count_rows(batches, progress):
+    """Yield the batches, calling progress with the size of each"""
+    for rows in batches:
+        progress(len(rows))
+        yield rows
+
+
+def stream_export(table, columns, export_format="csv", since=None,
+                  gzip=False, progress=None):
+    """Return the export of a table as a generator of chunks, str, or bytes
+    when gzip is True
+
+    Args:
+        table (str): "citizen" or "reservation"
+        columns (list): names of the EXPORT_COLUMNS of the table
+        export_format (str): "csv" or "ndjson"
+        since (datetime): see iter_export_rows()
+        gzip (bool): True to compress the output
+        progress (callable): called with the number of rows of every batch
+            read, see app/jobs.py
+    """
+    encode = encode_csv if export_format == "csv" else encode_ndjson
+    batches = iter_export_rows(table, columns, since)
+    if progress is not None:
+        batches = count_rows(batches, progress)
+    chunks = encode(get_converters(table, columns, export_format), columns,
+                    batches)
+    return compress(chunks) if gzip else chunks
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.export",
+        description="Export the citizen or reservation table.")
+    parser.add_argument("table", choices=sorted(EXPORT_COLUMNS))
+    parser.add_argument("--format",
+                        default="csv",
+                        choices=sorted(EXPORT_FORMATS))
+    parser.add_argument("--columns",
+                        help="comma separated column names, all by default")
+    parser.add_argument("--since",
+                        help="only export the rows of the citizens updated "
+                        "since this ISO date or datetime in UTC")
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("-o",
+                        "--output",
+                        help="file to write, the standard output by default")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    columns, since, feedback = parse_export_args(args.table, args.format,
+                                                 args.columns, args.since)
+    if feedback:
+        print(feedback, file=sys.stderr)
+        return 2
+
+    if args.output:
+        output = open(args.output, "wb")
+    else:
+        output = sys.stdout.buffer
+    try:
+        with app.app_context():
+            for chunk in stream_export(args.table, columns, args.format, since,
+                                       args.gzip):
+                output.write(chunk if args.gzip else chunk.encode())
+    finally:
+        if args.output:
+            output.close()
+        else:
+            output.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
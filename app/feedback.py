@@ -45,6 +45,21 @@ REPORT_FEEDBACK = {
     'other':                'report failed: something go wrong, please contact admin'
 }
 
+SCHEDULE_FEEDBACK = {
+    'success':              'schedule success!',
+    'missing_key':          'schedule failed: missing some attribute',
+    'invalid_time_format':  'schedule failed: invalid start or end datetime format',
+    'invalid_time':         'schedule failed: can only schedule a future time range',
+    'invalid_slot':         'schedule failed: slot_minutes and capacity need to be positive integers',
+    'other':                'schedule failed: something went wrong, please contact the admin'
+}
+
+VACCINE_SEQUENCE_FEEDBACK = {
+    'success':              'vaccine sequence updated!',
+    'invalid_sequence':     'update failed: sequences need to be a list of lists of vaccine names',
+    'other':                'update failed: something went wrong, please contact the admin'
+}
+
 DELETE_FEEDBACK = {
     'success_reset':        'all citizens have been deleted',
     'fail_reset':           'failed to reset citizen database',
@@ -59,6 +74,38 @@ REGISTER_USER_FEEDBACK = {
     "duplicated_registration" : "registration failed: user already exists"
 }
 
+PAGINATION_FEEDBACK = {
+    'invalid_cursor':       'request failed: "after" and "limit" need to be integers',
+    'invalid_limit':        'request failed: "limit" need to be between 1 and 1000',
+    'invalid_since':        'request failed: "since" need to be the "next" cursor of a previous response'
+}
+
+STATS_FEEDBACK = {
+    'invalid_group_by':     'request failed: "group_by" need to be a comma separated list of site_name, vaccine_name and day',
+    'invalid_day':          'request failed: "from" and "to" need to be dates in the YYYY-MM-DD format'
+}
+
+EXPORT_FEEDBACK = {
+    'invalid_table':        'export failed: only the citizen and reservation tables can be exported',
+    'invalid_format':       'export failed: "format" need to be csv or ndjson',
+    'invalid_columns':      'export failed: "columns" need to be a comma separated list of columns of the table',
+    'invalid_since':        'export failed: "since" need to be an ISO date or datetime'
+}
+
+JOB_FEEDBACK = {
+    'accepted':             'the job has been queued, poll its url for the progress',
+    'invalid_kind':         'job failed: the kind need to be reset, registration, report, export or recompute_stats',
+    'not_found':            'job failed: the job does not exist',
+    'no_result':            'job failed: the job has no result file',
+    'result_elsewhere':     'job failed: the result file is not in the JOB_DIR of this host',
+    'interrupted':          'job failed: the process running it stopped'
+}
+
+EVENTS_FEEDBACK = {
+    'invalid_last_event_id':    'request failed: "Last-Event-ID" need to be the id of a previous event',
+    'busy':                     'request failed: too many event streams, please try again later'
+}
+
 # LOGIN_FEEDBACK = {
 
 # }
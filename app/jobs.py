@@ -0,0 +1,452 @@
+"""Run the long admin operations in the background.
+
+    POST /jobs/<kind>
+    GET /jobs/<job_id>
+
+A job is a row of the job table. submit_job() stores it and queues it on
+the JOB_WORKERS threads of the process, and the endpoint answers 202 with
+the URL of the job at once. The runner of the kind in JOB_RUNNERS reports
+its progress to the job table at most every JOB_PROGRESS_SECONDS, so any
+worker process can answer the polls. The file a job writes, an export or
+the feedback of an import, is kept in JOB_DIR for GET
+/jobs/<job_id>/result.
+
+A reset TRUNCATEs the citizen, dose and reservation tables. When other
+transactions hold them for longer than JOB_LOCK_TIMEOUT_SECONDS it
+deletes the rows that exist JOB_DELETE_CHUNK_SIZE at a time instead, each
+chunk in its own transaction, so the other requests are never blocked for
+long.
+
+The jobs of a process that died stay queued or running in the table until
+fail_interrupted_jobs() marks them failed, the job endpoints call it for
+the processes of their host.
+
+The job table is shared, but JOB_DIR and the interrupted job checks are
+local to a host: the deployment must run on a single host, or give every
+host the same JOB_DIR on shared storage, otherwise the result of a job is
+only found by the host that ran it, and the jobs of a host that went away
+stay running.
+
+    $ python -m app.jobs recompute_stats
+
+runs a job in the foreground and records it in the table, for cron.
+
+Configuration, from the environment:
+    JOB_WORKERS (int): jobs run at the same time by each process
+    JOB_DIR (str): directory of the uploads and of the files the jobs
+        write, on storage shared by every host of the deployment
+    JOB_LOCK_TIMEOUT_SECONDS (float): how long a reset waits for the lock
+        of the TRUNCATE before deleting in chunks
+"""
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.errors import LockNotAvailable
+from sqlalchemy.exc import OperationalError
+import argparse
+import os
+import socket
+import sys
+import tempfile
+
+from app.assistant import *
+from app.export import (EXPORT_FORMATS, EXPORT_MODELS, parse_export_args,
+                        stream_export)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 1))
+JOB_DIR = os.getenv("JOB_DIR",
+                    os.path.join(tempfile.gettempdir(), "government-jobs"))
+JOB_LOCK_TIMEOUT_SECONDS = float(os.getenv("JOB_LOCK_TIMEOUT_SECONDS", 5))
+JOB_DELETE_CHUNK_SIZE = 10000
+JOB_PROGRESS_SECONDS = 1
+JOB_LIST_SIZE = 50
+JOB_UNFINISHED = ("queued", "running")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_worker():
+    """Return the "host:pid" of this process"""
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def get_upload_path(job_id):
+    return os.path.join(JOB_DIR, "job-{}.upload".format(job_id))
+
+
+def get_output_path(job_id):
+    return os.path.join(JOB_DIR, "job-{}.output".format(job_id))
+
+
+def update_job(job_id, **values):
+    """Update a job in its own transaction, apart from the work of the job"""
+    values["updated_at"] = datetime.now()
+    with db.engine.begin() as connection:
+        connection.execute(Job.__table__.update().where(
+            Job.id == job_id).values(**values))
+
+
+class Progress:
+    """Count the units of work of a job and report them to the job table,
+    at most every JOB_PROGRESS_SECONDS
+
+    Attributes:
+        done (int): units of work done
+        total (int): units of work to do, None when unknown
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.done = 0
+        self.total = None
+        self.reported = time.monotonic()
+
+    def set_total(self, total):
+        self.total = total
+        self.report()
+
+    def __call__(self, count=1):
+        self.done += count
+        if time.monotonic() - self.reported >= JOB_PROGRESS_SECONDS:
+            self.report()
+
+    def report(self):
+        self.reported = time.monotonic()
+        update_job(self.job_id, done=self.done, total=self.total)
+
+
+def reset_citizens(job_id, params, progress):
+    """Delete every citizen with their doses and reservations, like the
+    former DELETE /registration"""
+    try:
+        db.session.execute(
+            text("SET LOCAL lock_timeout = {}".format(
+                int(JOB_LOCK_TIMEOUT_SECONDS * 1000))))
+        db.session.execute(text("TRUNCATE citizen, dose, reservation"))
+    except OperationalError as e:
+        if not isinstance(e.orig, LockNotAvailable):
+            raise
+        db.session.rollback()
+        logger.warning("reset - the tables are busy, deleting in chunks")
+        return delete_citizens(progress)
+
+    record_reservation_changes("reset", [(None, None, None)])
+    db.session.commit()
+    forget_citizens()
+    logger.info(DELETE_FEEDBACK["success_reset"])
+    return {"method": "truncate"}
+
+
+def delete_citizens(progress):
+    """Delete the reservations then the citizens that exist now,
+    JOB_DELETE_CHUNK_SIZE rows per transaction
+
+    The deleted reservations are recorded in the change feed chunk by chunk,
+    the rows written meanwhile are kept, so no reset is recorded.
+    """
+    last_reservation = db.session.query(db.func.max(
+        Reservation.id)).scalar() or 0
+    last_citizen = db.session.query(db.func.max(Citizen.id)).scalar() or 0
+    progress.set_total(
+        db.session.query(Reservation).filter(
+            Reservation.id <= last_reservation).count() +
+        db.session.query(Citizen).filter(Citizen.id <= last_citizen).count())
+    db.session.commit()
+
+    while True:
+        chunk = db.select(Reservation.id).where(
+            Reservation.id <= last_reservation).order_by(
+                Reservation.id).limit(JOB_DELETE_CHUNK_SIZE).scalar_subquery()
+        deleted = db.session.execute(Reservation.__table__.delete().where(
+            Reservation.id.in_(chunk)).returning(
+                Reservation.id, Reservation.citizen_id,
+                Reservation.site_name)).fetchall()
+        if not deleted:
+            break
+        record_reservation_changes("delete", deleted)
+        db.session.commit()
+        progress(len(deleted))
+
+    # the doses go with their citizen, see Dose.citizen_id
+    while True:
+        chunk = db.select(Citizen.id).where(
+            Citizen.id <= last_citizen).order_by(
+                Citizen.id).limit(JOB_DELETE_CHUNK_SIZE).scalar_subquery()
+        deleted = db.session.execute(Citizen.__table__.delete().where(
+            Citizen.id.in_(chunk)).returning(Citizen.citizen_id)).scalars().all()
+        if not deleted:
+            break
+        db.session.commit()
+        forget_citizens(deleted)
+        progress(len(deleted))
+
+    logger.info(DELETE_FEEDBACK["success_reset"])
+    return {"method": "delete", "deleted": progress.done}
+
+
+def write_feedback(job_id, progress, results):
+    """Write the feedback of every line of an import as NDJSON, like the
+    batch endpoints, and count the codes
+
+    Args:
+        results (iterable): (line, citizen_id, code, feedback)
+    """
+    codes = Counter()
+    with open(get_output_path(job_id), "w", encoding="utf-8") as output:
+        for line, citizen_id, code, feedback in results:
+            output.write(
+                json.dumps(
+                    {
+                        "line": line,
+                        "citizen_id": citizen_id,
+                        "code": code,
+                        "feedback": feedback
+                    },
+                    ensure_ascii=False) + "\n")
+            codes[code] += 1
+            progress()
+    return {
+        "lines": sum(codes.values()),
+        "codes": dict(codes),
+        "filename": "job-{}-feedback.ndjson".format(job_id),
+        "mimetype": "application/x-ndjson"
+    }
+
+
+def import_registrations(job_id, params, progress):
+    """Register the citizens of an upload, like POST /registration/batch"""
+    with open(get_upload_path(job_id), "rb") as upload:
+        results = register_citizens(read_records(upload, params["csv"]))
+        return write_feedback(job_id, progress,
+                              ((line, citizen_id, key,
+                                REGISTRATION_FEEDBACK[key])
+                               for line, citizen_id, key in results))
+
+
+def import_reports(job_id, params, progress):
+    """Apply the dose reports of an upload, like POST /report_taken/batch"""
+    with open(get_upload_path(job_id), "rb") as upload:
+        return write_feedback(
+            job_id, progress, report_doses(read_records(upload,
+                                                        params["csv"])))
+
+
+def export_rows(job_id, params, progress):
+    """Export a table to a file, like GET /export/<table>"""
+    table, export_format = params["table"], params["format"]
+    columns, since, feedback = parse_export_args(table, export_format,
+                                                 params["columns"],
+                                                 params["since"])
+    if feedback:
+        raise ValueError(feedback)
+    if since is None:
+        progress.set_total(approximate_count(EXPORT_MODELS[table]))
+
+    filename = "{}.{}".format(table, export_format)
+    chunks = stream_export(table, columns, export_format, since,
+                           params["gzip"], progress)
+    if params["gzip"]:
+        with open(get_output_path(job_id), "wb") as output:
+            output.writelines(chunks)
+        filename += ".gz"
+    else:
+        with open(get_output_path(job_id), "w", encoding="utf-8") as output:
+            output.writelines(chunks)
+    return {
+        "rows": progress.done,
+        "filename": filename,
+        "mimetype": "application/gzip"
+        if params["gzip"] else EXPORT_FORMATS[export_format]
+    }
+
+
+def recompute_stats(job_id, params, progress):
+    """Rebuild the counters of GET /stats, see recompute_daily_stats()"""
+    recompute_daily_stats()
+    db.session.commit()
+    return {"rows": db.session.query(DailyStat).count()}
+
+
+# the function of each kind of job, called with the id and the params of
+# the job and its Progress, it returns the result of the job
+JOB_RUNNERS = {
+    "reset": reset_citizens,
+    "registration": import_registrations,
+    "report": import_reports,
+    "export": export_rows,
+    "recompute_stats": recompute_stats,
+}
+
+
+def parse_job_params(kind, values, mimetype):
+    """Return the params of a job from the request that submits it
+
+    Args:
+        kind (str): a key of JOB_RUNNERS
+        values (dict): the query string and form of the request
+        mimetype (str): the mimetype of the uploaded body of an import
+
+    Returns:
+        tuple: (params, feedback or None), the feedback is a value of
+            JOB_FEEDBACK or EXPORT_FEEDBACK
+    """
+    if kind not in JOB_RUNNERS:
+        return None, JOB_FEEDBACK["invalid_kind"]
+    if kind in ("registration", "report"):
+        return {"csv": mimetype == "text/csv"}, None
+    if kind == "export":
+        params = {
+            "table": values.get("table"),
+            "format": values.get("format", "csv"),
+            "columns": values.get("columns"),
+            "since": values.get("since"),
+            "gzip": values.get("gzip", "").lower() == "true"
+        }
+        feedback = parse_export_args(params["table"], params["format"],
+                                     params["columns"], params["since"])[2]
+        return (None, feedback) if feedback else (params, None)
+    return {}, None
+
+
+def create_job(kind, params, username, upload=None):
+    """Store a queued job
+
+    Args:
+        kind (str): a key of JOB_RUNNERS
+        params (dict): arguments of the job, see parse_job_params()
+        username (str): admin who submitted the job, None for the command
+        upload (iterable): the binary body of an import, read line by line
+            and kept in JOB_DIR until the job ends, None for other kinds
+
+    Returns:
+        Job: the queued job
+    """
+    path = None
+    if upload is not None:
+        os.makedirs(JOB_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=JOB_DIR, delete=False) as spool:
+            spool.writelines(upload)
+            path = spool.name
+    try:
+        job = Job(kind, params, get_worker(), username)
+        db.session.add(job)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        if path:
+            os.remove(path)
+        raise
+    if path:
+        os.replace(path, get_upload_path(job.id))
+    return job
+
+
+def submit_job(kind, params, username, upload=None):
+    """Store a job and queue it on the threads of this process, see
+    create_job()"""
+    global _executor
+    job = create_job(kind, params, username, upload)
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(JOB_WORKERS,
+                                           thread_name_prefix="job")
+    _executor.submit(run_job, job.id)
+    logger.info("job %s - %s queued", job.id, kind)
+    return job
+
+
+def run_job(job_id):
+    """Run a queued job in the current thread and store its outcome"""
+    with app.app_context():
+        job = db.session.get(Job, job_id)
+        kind, params = job.kind, job.params
+        job.status = "running"
+        job.worker = get_worker()
+        job.started_at = job.updated_at = datetime.now()
+        db.session.commit()
+        logger.info("job %s - %s started", job_id, kind)
+
+        progress = Progress(job_id)
+        try:
+            result = JOB_RUNNERS[kind](job_id, params, progress)
+            values = {
+                "status": "succeeded",
+                "result": result,
+                "total": progress.done
+                if progress.total is None else progress.total
+            }
+            logger.info("job %s - %s succeeded", job_id, kind)
+        except Exception as e:
+            db.session.rollback()
+            values = {"status": "failed", "error": str(e) or repr(e)}
+            logger.error("job %s - %s failed: %s", job_id, kind, e)
+        finally:
+            db.session.remove()
+            if os.path.exists(get_upload_path(job_id)):
+                os.remove(get_upload_path(job_id))
+        update_job(job_id,
+                   done=progress.done,
+                   finished_at=datetime.now(),
+                   **values)
+
+
+def is_alive(pid):
+    """Return True if a process of this host has this pid"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def fail_interrupted_jobs():
+    """Mark failed the unfinished jobs of the processes of this host that
+    ended, a restart or a crash interrupted them"""
+    prefix = socket.gethostname() + ":"
+    jobs = db.session.query(Job.id, Job.worker).filter(
+        Job.status.in_(JOB_UNFINISHED), Job.worker.startswith(prefix)).all()
+    db.session.commit()
+    for job_id, worker in jobs:
+        if is_alive(int(worker[len(prefix):])):
+            continue
+        with db.engine.begin() as connection:
+            connection.execute(Job.__table__.update().where(
+                Job.id == job_id, Job.status.in_(JOB_UNFINISHED)).values(
+                    status="failed",
+                    error=JOB_FEEDBACK["interrupted"],
+                    updated_at=datetime.now(),
+                    finished_at=datetime.now()))
+        logger.error("job %s - %s", job_id, JOB_FEEDBACK["interrupted"])
+
+
+def get_jobs():
+    """Return the JOB_LIST_SIZE most recent jobs, newest first"""
+    return Job.query.order_by(Job.id.desc()).limit(JOB_LIST_SIZE).all()
+
+
+def get_result_path(job):
+    """Return the path of the file of a succeeded job, None if it has none"""
+    if job.status != "succeeded" or not (job.result or {}).get("filename"):
+        return None
+    path = get_output_path(job.id)
+    return path if os.path.exists(path) else None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.jobs",
+        description="Run a job in the foreground and record it.")
+    parser.add_argument("kind", choices=["recompute_stats", "reset"])
+    args = parser.parse_args(argv)
+    with app.app_context():
+        fail_interrupted_jobs()
+        job_id = create_job(args.kind, {}, None).id
+        run_job(job_id)
+        job = db.session.get(Job, job_id)
+        print(json.dumps(job.get_dict(), ensure_ascii=False))
+        return 0 if job.status == "succeeded" else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,460 @@
+"""Load test of the government API.
+
+Boot the app in this process against a throwaway Postgres database, which
+is emptied and migrated first:
+
+    $ python -m app.loadtest --database-url postgresql://localhost/loadtest
+
+or drive a server that is already running, e.g. gunicorn, whose database
+receives a new block of citizens:
+
+    $ python -m app.loadtest --url http://localhost:8000
+
+A population of citizens is registered through /registration/batch and a
+user logs in through /login. Then --concurrency threads send a weighted
+mix of requests for --duration seconds, moving citizens through
+registration, reservation, queue and report. The throughput, the
+p50/p95/p99 latencies and the SQL statements per request, read from
+/metrics, are printed per endpoint.
+
+A write counts as an error unless it answers the success feedback, the
+API reports most rejected writes with status 200.
+
+--save-baseline writes the results to a JSON file, --compare fails with
+status 1 when throughput, p95, the share of errors or queries per request
+are worse than the baseline by more than --tolerance.
+"""
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+import argparse
+import base64
+import http.client
+import json
+import logging
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from app.feedback import (REGISTRATION_FEEDBACK, REPORT_FEEDBACK,
+                          RESERVATION_FEEDBACK)
+
+DEFAULT_BASELINE = "loadtest-baseline.json"
+POPULATION_START = 500000000000
+USERNAME = "loadtest"
+PASSWORD = "loadtest"
+SITE_NAME = "LoadTestSite"
+VACCINE_NAME = "Pfizer"
+
+# (operation, weight, route label of /metrics)
+OPERATIONS = [
+    ("registration", 10, "/registration"),
+    ("reservation", 10, "/reservation"),
+    ("queue_report", 8, "/queue_report"),
+    ("report_taken", 6, "/report_taken"),
+    ("reservations", 6, "/reservations"),
+    ("get_citizen", 35, "/registration/<citizen_id>"),
+    ("get_reservation", 25, "/reservation/<citizen_id>"),
+]
+PERCENTILES = (50, 95, 99)
+QUERY_METRIC = re.compile(
+    r'^government_request_queries_(sum|count)\{route="([^"]*)"\} (\S+)$')
+
+
+class Client:
+    """A keep-alive HTTP connection of one load test thread"""
+
+    def __init__(self, url, token=None):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname,
+                                                     parts.port)
+        self.headers = {"Authorization": "Bearer " + token} if token else {}
+
+    def request(self, method, path, body=None, headers=None):
+        """Return the status and body of a request"""
+        try:
+            self.connection.request(method, path, body,
+                                    dict(self.headers, **(headers or {})))
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            raise
+
+    def post_form(self, path, values):
+        body = "&".join("{}={}".format(key, value)
+                        for key, value in values.items())
+        return self.request(
+            "POST", path, body,
+            {"Content-Type": "application/x-www-form-urlencoded"})
+
+
+def citizen_values(number):
+    """Return the registration fields of the synthetic citizen number"""
+    from app.assistant import make_citizen_id
+    return {
+        "citizen_id": make_citizen_id(POPULATION_START + number),
+        "name": "Load",
+        "surname": "Test{}".format(number),
+        "birth_date": "1980-01-01",
+        "occupation": "tester",
+        "phone_number": "06{:08d}".format(number % 10**8),
+        "is_risk": "false",
+        "address": "Bangkok"
+    }
+
+
+def read_feedback(body):
+    """Return the feedback of a JSON response body, or None"""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    return data.get("feedback") if isinstance(data, dict) else None
+
+
+class Population:
+    """The synthetic citizens, by the next step they can take
+
+    Citizens are numbered from start, the first size of them are seeded
+    and the following ones are registered during the run.
+    """
+
+    def __init__(self, start, size):
+        self.lock = threading.Lock()
+        self.start = start
+        self.size = size
+        self.next_number = start + size
+        self.unreserved = deque(range(start, start + size))
+        self.reserved = deque()
+        self.queued = deque()
+
+    def sample(self, generator):
+        """Return the number of a random seeded citizen"""
+        return self.start + generator.randrange(self.size)
+
+    def new_number(self):
+        with self.lock:
+            self.next_number += 1
+            return self.next_number - 1
+
+    def take(self, step):
+        """Return a citizen number waiting for step, or None"""
+        with self.lock:
+            citizens = getattr(self, step)
+            return citizens.popleft() if citizens else None
+
+    def put(self, step, number):
+        with self.lock:
+            getattr(self, step).append(number)
+
+
+class LoadTest:
+    """Send the OPERATIONS mix and collect the latency of every request"""
+
+    def __init__(self, url, token, population, seed):
+        self.url = url
+        self.token = token
+        self.population = population
+        self.seed = seed
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def run(self, concurrency, duration):
+        deadline = time.monotonic() + duration
+        threads = [
+            threading.Thread(target=self.work, args=(worker, deadline))
+            for worker in range(concurrency)
+        ]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - start
+
+    def work(self, worker, deadline):
+        generator = random.Random(self.seed * 1000 + worker)
+        client = Client(self.url, self.token)
+        names = [name for name, weight, route in OPERATIONS]
+        weights = [weight for name, weight, route in OPERATIONS]
+        while time.monotonic() < deadline:
+            operation = generator.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                operation, ok = getattr(self, operation)(client, generator)
+            except (OSError, http.client.HTTPException):
+                ok = False
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.latencies[operation].append(elapsed)
+                if not ok:
+                    self.errors[operation] += 1
+
+    def registration(self, client, generator):
+        number = self.population.new_number()
+        status, body = client.post_form("/registration",
+                                        citizen_values(number))
+        ok = read_feedback(body) == REGISTRATION_FEEDBACK["success"]
+        if ok:
+            self.population.put("unreserved", number)
+        return "registration", ok
+
+    def reservation(self, client, generator):
+        number = self.population.take("unreserved")
+        if number is None:
+            return self.get_citizen(client, generator)
+        status, body = client.post_form(
+            "/reservation", {
+                "citizen_id": citizen_values(number)["citizen_id"],
+                "site_name": SITE_NAME,
+                "vaccine_name": VACCINE_NAME
+            })
+        ok = read_feedback(body) == RESERVATION_FEEDBACK["success"]
+        if ok:
+            self.population.put("reserved", number)
+        return "reservation", ok
+
+    def queue_report(self, client, generator):
+        number = self.population.take("reserved")
+        if number is None:
+            return self.get_reservation(client, generator)
+        queue = datetime.now() + timedelta(days=1)
+        status, body = client.post_form(
+            "/queue_report", {
+                "citizen_id": citizen_values(number)["citizen_id"],
+                "queue": queue.strftime("%Y-%m-%d %H:%M:%S.%f")
+            })
+        ok = read_feedback(body) == REPORT_FEEDBACK["success"]
+        if ok:
+            self.population.put("queued", number)
+        return "queue_report", ok
+
+    def report_taken(self, client, generator):
+        number = self.population.take("queued")
+        if number is None:
+            return self.get_reservation(client, generator)
+        status, body = client.post_form(
+            "/report_taken", {
+                "citizen_id": citizen_values(number)["citizen_id"],
+                "vaccine_name": VACCINE_NAME,
+                "option": "reserve"
+            })
+        ok = read_feedback(body) == REPORT_FEEDBACK["success"]
+        return "report_taken", ok
+
+    def reservations(self, client, generator):
+        status, body = client.request("GET", "/reservations?limit=100")
+        return "reservations", status < 400
+
+    def get_citizen(self, client, generator):
+        number = self.population.sample(generator)
+        status, body = client.request(
+            "GET", "/registration/" + citizen_values(number)["citizen_id"])
+        return "get_citizen", status < 400
+
+    def get_reservation(self, client, generator):
+        number = self.population.sample(generator)
+        status, body = client.request(
+            "GET", "/reservation/" + citizen_values(number)["citizen_id"])
+        return "get_reservation", status < 400
+
+
+def boot(database_url):
+    """Serve the app against an emptied database, return its url"""
+    os.environ["SQLALCHEMY_DATABASE_URI"] = database_url
+    os.environ.setdefault("SECRET_KEY", "loadtest")
+    from werkzeug.serving import make_server
+    from app.app import app, db, logger
+    from app.migrations import migrate
+
+    with app.app_context():
+        db.reflect()
+        db.drop_all()
+    migrate()
+
+    logger.setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}".format(server.server_port)
+
+
+def login(url):
+    """Register the load test user and return its access token"""
+    client = Client(url)
+    client.post_form("/register_user", {
+        "username": USERNAME,
+        "password": PASSWORD
+    })
+    credentials = base64.b64encode("{}:{}".format(USERNAME,
+                                                  PASSWORD).encode()).decode()
+    status, body = client.request("POST", "/login", headers={
+        "Authorization": "Basic " + credentials
+    })
+    if status != 200:
+        raise SystemExit("login failed: {}".format(body.decode()))
+    return json.loads(body)["access_token"]
+
+
+def seed(url, token, population):
+    """Register the seeded citizens through /registration/batch"""
+    numbers = range(population.start, population.start + population.size)
+    body = "".join(
+        json.dumps(citizen_values(number)) + "\n" for number in numbers)
+    status, response = Client(url, token).request(
+        "POST", "/registration/batch", body.encode(),
+        {"Content-Type": "application/x-ndjson"})
+    registered = response.count(b'"code": "success"')
+    if status != 200 or registered != population.size:
+        raise SystemExit(
+            "seeding failed, {} of {} citizens registered".format(
+                registered, population.size))
+
+
+def read_query_counts(url):
+    """Return {route: (statements, requests)} from /metrics"""
+    status, body = Client(url).request("GET", "/metrics")
+    counts = defaultdict(lambda: [0, 0])
+    for line in body.decode().splitlines():
+        match = QUERY_METRIC.match(line)
+        if match:
+            kind, route, value = match.groups()
+            counts[route][kind == "count"] += float(value)
+    return counts
+
+
+def percentile(latencies, percent):
+    return latencies[max(math.ceil(len(latencies) * percent / 100) - 1, 0)]
+
+
+def summarize(load_test, elapsed, queries_before, queries_after):
+    """Return {operation: results} and the total of the run"""
+    results = {}
+    for name, weight, route in OPERATIONS + [("total", 0, None)]:
+        if name == "total":
+            latencies = sorted(
+                sum(load_test.latencies.values(), []))
+            errors = sum(load_test.errors.values())
+            statements = sum(after[0] - queries_before[route][0]
+                             for route, after in queries_after.items())
+            requests = sum(after[1] - queries_before[route][1]
+                           for route, after in queries_after.items())
+        else:
+            latencies = sorted(load_test.latencies[name])
+            errors = load_test.errors[name]
+            statements = queries_after[route][0] - queries_before[route][0]
+            requests = queries_after[route][1] - queries_before[route][1]
+        if not latencies:
+            continue
+        results[name] = {
+            "requests": len(latencies),
+            "errors": errors,
+            "throughput": len(latencies) / elapsed,
+            "queries": statements / requests if requests else None
+        }
+        for percent in PERCENTILES:
+            results[name]["p{}".format(percent)] = percentile(
+                latencies, percent) * 1000
+    return results
+
+
+def print_results(results):
+    print("{:<16}{:>9}{:>8}{:>10}{:>9}{:>9}{:>9}{:>9}".format(
+        "operation", "requests", "errors", "req/s", "p50 ms", "p95 ms",
+        "p99 ms", "queries"))
+    for name, result in results.items():
+        print("{:<16}{requests:>9}{errors:>8}{throughput:>10.1f}"
+              "{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}{queries:>9}".format(
+                  name,
+                  **dict(result,
+                         queries="-" if result["queries"] is None else
+                         "{:.2f}".format(result["queries"]))))
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of results against baseline"""
+    regressions = []
+    for name, expected in baseline.items():
+        actual = results.get(name)
+        if actual is None:
+            continue
+        if actual["throughput"] < expected["throughput"] * (1 - tolerance):
+            regressions.append("{} throughput {:.1f} < {:.1f} req/s".format(
+                name, actual["throughput"], expected["throughput"]))
+        actual_errors = actual["errors"] / max(actual["requests"], 1)
+        expected_errors = expected["errors"] / max(expected["requests"], 1)
+        if actual_errors > expected_errors * (1 + tolerance):
+            regressions.append("{} errors {:.1%} > {:.1%}".format(
+                name, actual_errors, expected_errors))
+        if actual["p95"] > expected["p95"] * (1 + tolerance):
+            regressions.append("{} p95 {:.1f} > {:.1f} ms".format(
+                name, actual["p95"], expected["p95"]))
+        if (actual["queries"] is not None and expected["queries"] is not None
+                and actual["queries"] > expected["queries"] *
+            (1 + tolerance)):
+            regressions.append("{} queries {:.2f} > {:.2f}".format(
+                name, actual["queries"], expected["queries"]))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.loadtest",
+        description="Load test of the government API.")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--database-url",
+                        help="boot the app against this database, "
+                        "which is emptied first")
+    target.add_argument("--url", help="load test a running server")
+    parser.add_argument("--population", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30,
+                        help="seconds of load")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE,
+                        metavar="PATH")
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE,
+                        metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed fraction of regression")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    url = boot(args.database_url) if args.database_url else args.url
+    token = login(url)
+
+    # a running server keeps the citizens of earlier runs, take new numbers
+    start = 0 if args.database_url else random.randrange(1, 90) * 10**6
+    population = Population(start, args.population)
+    seed(url, token, population)
+
+    load_test = LoadTest(url, token, population, args.seed)
+    queries_before = read_query_counts(url)
+    elapsed = load_test.run(args.concurrency, args.duration)
+    results = summarize(load_test, elapsed, queries_before,
+                        read_query_counts(url))
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file),
+                                  args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,149 @@
+"""Non-blocking, structured logging of the government service.
+
+A request thread only puts the LogRecord on a bounded queue. A background
+QueueListener thread formats the message, redacts personal fields, writes
+JSON lines to a file and text to the console. Messages must use
+lazy %-style arguments, e.g. logger.info("%s - cancel reservation", id),
+so nothing is formatted for records that are sampled out or dropped.
+
+Every gunicorn worker appends to the same file, so the file is not rotated
+here, two workers rotating at once would rename it under each other.
+Rotate it with logrotate or the like, each worker reopens the file when it
+was moved. With LOG_FILE=- the JSON lines go to the standard output
+instead, for platforms that collect it like Heroku.
+
+Configuration, from the environment:
+    LOG_FILE (str): path of the JSON log file, default government.log, or
+        - for the standard output
+    LOG_QUEUE_SIZE (int): records waiting for the listener before new
+        records are dropped
+    LOG_SAMPLE_RATES (str): fraction of records kept per level, e.g.
+        "DEBUG=0,INFO=0.1", levels not listed are always kept
+"""
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+
+LOG_FILE = os.getenv("LOG_FILE", "government.log")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+
+REDACTED_FIELDS = {
+    "name", "surname", "birth_date", "occupation", "phone_number", "address",
+    "password"
+}
+REDACTED = "[redacted]"
+
+# attributes every LogRecord has, anything else was passed with extra=
+RECORD_ATTRIBUTES = set(
+    vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message"}
+
+
+def parse_sample_rates(rates):
+    """Return {level number: fraction kept} of a LOG_SAMPLE_RATES string"""
+    sample_rates = {}
+    for rate in filter(None, rates.replace(" ", "").split(",")):
+        level, fraction = rate.split("=")
+        sample_rates[logging.getLevelName(level.upper())] = float(fraction)
+    return sample_rates
+
+
+def redact(value):
+    """Return value with the REDACTED_FIELDS of every dict replaced"""
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if key in REDACTED_FIELDS else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of the records of some levels.
+
+    Meant for the hot success paths, warnings and errors should not be
+    sampled.
+    """
+
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        rate = self.sample_rates.get(record.levelno)
+        return rate is None or random.random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """A QueueHandler that leaves formatting to the listener thread and
+    drops records instead of blocking when the queue is full."""
+
+    dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Format a record as one JSON object per line.
+
+    The fields passed with extra= are added to the object, with the
+    REDACTED_FIELDS of their dicts redacted.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = REDACTED if key in REDACTED_FIELDS else redact(
+                    value)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(logger):
+    """Send the records of logger through a queue to a background thread.
+
+    Returns:
+        QueueListener: the started listener, stopped and flushed at exit
+    """
+    if LOG_FILE == "-":
+        handlers = [logging.StreamHandler(sys.stdout)]
+        handlers[0].setFormatter(JsonFormatter())
+    else:
+        file_handler = WatchedFileHandler(LOG_FILE)
+        file_handler.setFormatter(JsonFormatter())
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(
+            logging.Formatter(
+                '%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        handlers = [file_handler, stream_handler]
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(
+        SamplingFilter(parse_sample_rates(LOG_SAMPLE_RATES)))
+    logger.addHandler(queue_handler)
+
+    listener = QueueListener(queue_handler.queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
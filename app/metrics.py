@@ -0,0 +1,176 @@
+"""Prometheus metrics of the government service.
+
+Every request records its latency, status and feedback code, and the
+number and time of the SQL statements it executed. The pool events keep
+count of the open and checked out database connections.
+
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR to an empty directory (done by
+gunicorn.conf.py) so every worker writes its samples there and /metrics
+sums them, whichever worker serves the scrape.
+"""
+from flask import g, has_request_context, request
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry,
+                               Counter, Gauge, Histogram, generate_latest,
+                               multiprocess, REGISTRY)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+import json
+import os
+import time
+
+from app import feedback
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250, 1000)
+FEEDBACK_BODY_SIZE = 4096
+
+REQUEST_LATENCY = Histogram("government_request_seconds",
+                            "Time to serve a request",
+                            ["method", "route"],
+                            buckets=LATENCY_BUCKETS)
+RESPONSES = Counter("government_responses_total",
+                    "Responses by HTTP status",
+                    ["method", "route", "status"])
+FEEDBACKS = Counter("government_feedback_total",
+                    "Responses by the feedback of app/feedback.py",
+                    ["route", "feedback", "code"])
+REQUEST_QUERIES = Histogram("government_request_queries",
+                            "SQL statements executed by a request",
+                            ["route"],
+                            buckets=QUERY_BUCKETS)
+REQUEST_QUERY_SECONDS = Histogram("government_request_query_seconds",
+                                  "Time a request spent executing SQL",
+                                  ["route"],
+                                  buckets=LATENCY_BUCKETS)
+POOL_CONNECTIONS = Gauge("government_db_pool_connections",
+                         "Open and checked out database connections",
+                         ["state"],
+                         multiprocess_mode="livesum")
+
+
+def feedback_codes():
+    """Return {feedback message: (feedback dict name, key)} of every
+    *_FEEDBACK dict of app/feedback.py"""
+    codes = {}
+    for name, messages in vars(feedback).items():
+        if name.endswith("_FEEDBACK") and isinstance(messages, dict):
+            for key, message in messages.items():
+                codes.setdefault(message, (name[:-len("_FEEDBACK")].lower(),
+                                           key))
+    return codes
+
+
+FEEDBACK_CODES = feedback_codes()
+
+
+def get_route():
+    """Return the url rule of the current request, e.g. /registration/<id>"""
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"]
+    if has_request_context():
+        g.query_count = g.get("query_count", 0) + 1
+        g.query_seconds = g.get("query_seconds", 0) + elapsed
+
+
+def start_request():
+    g.request_start = time.perf_counter()
+    g.query_count = 0
+    g.query_seconds = 0
+
+
+def record_response(response):
+    """Count the status and feedback of a response.
+
+    The feedback of a streamed response is not read.
+    """
+    route = get_route()
+    if route == "/metrics":
+        return response
+
+    RESPONSES.labels(request.method, route, response.status_code).inc()
+    feedback_message = read_feedback(response)
+    if feedback_message is not None:
+        group, code = FEEDBACK_CODES.get(feedback_message,
+                                         ("unknown", "unknown"))
+        FEEDBACKS.labels(route, group, code).inc()
+    return response
+
+
+def record_request(error=None):
+    """Record the latency and SQL statements of a request.
+
+    Runs when the request context is torn down, after the last byte of a
+    streamed response.
+    """
+    route = get_route()
+    if route == "/metrics" or "request_start" not in g:
+        return
+
+    REQUEST_LATENCY.labels(request.method, route).observe(
+        time.perf_counter() - g.request_start)
+    REQUEST_QUERIES.labels(route).observe(g.query_count)
+    REQUEST_QUERY_SECONDS.labels(route).observe(g.query_seconds)
+
+
+def read_feedback(response):
+    """Return the "feedback" of a small JSON response body, or None
+
+    Many endpoints return json.dumps() strings, so the body is parsed
+    whatever its content type.
+    """
+    if response.is_streamed or not 0 < (response.content_length or
+                                        0) <= FEEDBACK_BODY_SIZE:
+        return None
+    try:
+        data = json.loads(response.get_data())
+    except ValueError:
+        return None
+    return data.get("feedback") if isinstance(data, dict) else None
+
+
+@event.listens_for(Pool, "connect")
+def open_connection(dbapi_connection, connection_record):
+    POOL_CONNECTIONS.labels("open").inc()
+
+
+@event.listens_for(Pool, "close")
+def close_connection(dbapi_connection, connection_record):
+    POOL_CONNECTIONS.labels("open").dec()
+
+
+@event.listens_for(Pool, "checkout")
+def checkout_connection(dbapi_connection, connection_record,
+                        connection_proxy):
+    POOL_CONNECTIONS.labels("checked_out").inc()
+
+
+@event.listens_for(Pool, "checkin")
+def checkin_connection(dbapi_connection, connection_record):
+    POOL_CONNECTIONS.labels("checked_out").dec()
+
+
+def instrument(flask_app):
+    """Record the metrics of every request of flask_app."""
+    flask_app.before_request(start_request)
+    flask_app.after_request(record_response)
+    flask_app.teardown_request(record_request)
+
+
+def render_metrics():
+    """Return the body and content type of the /metrics response"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
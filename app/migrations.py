@@ -0,0 +1,269 @@
+"""Schema migrations of the government database.
+
+Run every migration that has not been applied yet with
+
+    $ python -m app.migrations
+
+A new database is created from the models directly and all migrations are
+recorded as applied. Each migration receives a connection inside the
+transaction of the run and must leave the schema matching the models.
+"""
+from sqlalchemy import inspect, text
+import pickle
+
+from app.models import *
+
+MIGRATION_BATCH_SIZE = 10000
+
+
+def create_dose_table(connection):
+    """Move the pickled citizen.vaccine_taken lists into the dose table."""
+    connection.execute(
+        text("""
+        CREATE TABLE IF NOT EXISTS dose (
+            id SERIAL PRIMARY KEY,
+            citizen_id NUMERIC NOT NULL
+                REFERENCES citizen (citizen_id) ON DELETE CASCADE,
+            vaccine_name VARCHAR(200) NOT NULL,
+            sequence INTEGER NOT NULL,
+            timestamp TIMESTAMP WITHOUT TIME ZONE,
+            site_name VARCHAR(200),
+            UNIQUE (citizen_id, sequence)
+        )"""))
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_dose_vaccine_name "
+             "ON dose (vaccine_name)"))
+
+    columns = [
+        column["name"]
+        for column in inspect(connection).get_columns(Citizen.__tablename__)
+    ]
+    if "vaccine_taken" not in columns:
+        return
+
+    rows = connection.execution_options(stream_results=True).execute(
+        text("SELECT citizen_id, vaccine_taken FROM citizen "
+             "WHERE vaccine_taken IS NOT NULL"))
+    insert = text("INSERT INTO dose (citizen_id, vaccine_name, sequence) "
+                  "VALUES (:citizen_id, :vaccine_name, :sequence)")
+    while True:
+        batch = rows.fetchmany(MIGRATION_BATCH_SIZE)
+        if not batch:
+            break
+        doses = [{
+            "citizen_id": citizen_id,
+            "vaccine_name": vaccine_name,
+            "sequence": sequence
+        } for citizen_id, vaccine_taken in batch
+                 for sequence, vaccine_name in enumerate(
+                     pickle.loads(vaccine_taken), 1)]
+        if doses:
+            connection.execute(insert, doses)
+    rows.close()
+
+    connection.execute(text("ALTER TABLE citizen DROP COLUMN vaccine_taken"))
+
+
+def create_unchecked_reservation_index(connection):
+    """Allow at most one unchecked reservation per citizen.
+
+    Fails if a citizen already has several unchecked reservations, those
+    need to be checked or cancelled before the migration can be applied.
+    """
+    connection.execute(
+        text("CREATE UNIQUE INDEX IF NOT EXISTS "
+             "uq_reservation_unchecked_citizen "
+             "ON reservation (citizen_id) WHERE NOT checked"))
+
+
+def create_reservation_indexes(connection):
+    """Index the reservation lookups by citizen, site and queue."""
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_reservation_citizen_id_checked "
+             "ON reservation (citizen_id, checked)"))
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_reservation_site_name "
+             "ON reservation (site_name)"))
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_reservation_queue "
+             "ON reservation (queue)"))
+
+
+def use_bigint_citizen_id(connection):
+    """Store citizen_id as BIGINT instead of arbitrary precision NUMERIC."""
+    connection.execute(
+        text("ALTER TABLE dose DROP CONSTRAINT IF EXISTS "
+             "dose_citizen_id_fkey"))
+    for table in ("citizen", "reservation", "dose"):
+        connection.execute(
+            text("ALTER TABLE {} ALTER COLUMN citizen_id TYPE BIGINT".format(
+                table)))
+    connection.execute(
+        text("ALTER TABLE dose ADD CONSTRAINT dose_citizen_id_fkey "
+             "FOREIGN KEY (citizen_id) REFERENCES citizen (citizen_id) "
+             "ON DELETE CASCADE"))
+
+
+def create_vaccine_sequence_table(connection):
+    """Move the vaccine sequence rules into a versioned table."""
+    from app.assistant import VACCINE_SEQUENCE
+
+    connection.execute(
+        text("""
+        CREATE TABLE IF NOT EXISTS vaccine_sequence (
+            id SERIAL PRIMARY KEY,
+            version INTEGER NOT NULL,
+            vaccines VARCHAR(200)[] NOT NULL,
+            timestamp TIMESTAMP WITHOUT TIME ZONE
+        )"""))
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_vaccine_sequence_version "
+             "ON vaccine_sequence (version)"))
+    if connection.execute(text("SELECT 1 FROM vaccine_sequence")).first():
+        return
+    connection.execute(
+        text("INSERT INTO vaccine_sequence (version, vaccines, timestamp) "
+             "VALUES (1, :vaccines, :timestamp)"), [{
+                 "vaccines": pattern,
+                 "timestamp": datetime.now()
+             } for pattern in VACCINE_SEQUENCE])
+
+
+def add_citizen_version(connection):
+    """Version the citizens for the validators of conditional GETs."""
+    connection.execute(
+        text("ALTER TABLE citizen "
+             "ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1, "
+             "ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITHOUT TIME ZONE "
+             "DEFAULT timezone('utc', now())"))
+
+
+def create_reservation_change_table(connection):
+    """Log the reservation changes for GET /reservations/changes."""
+    connection.execute(
+        text("""
+        CREATE TABLE IF NOT EXISTS reservation_change (
+            id BIGSERIAL PRIMARY KEY,
+            transaction_id BIGINT NOT NULL DEFAULT txid_current(),
+            operation VARCHAR(20) NOT NULL,
+            reservation_id INTEGER,
+            citizen_id BIGINT,
+            timestamp TIMESTAMP WITHOUT TIME ZONE
+        )"""))
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_reservation_change_cursor "
+             "ON reservation_change (transaction_id, id)"))
+
+
+def add_reservation_change_site(connection):
+    """Tag the reservation changes with their site for the site events."""
+    connection.execute(
+        text("ALTER TABLE reservation_change "
+             "ADD COLUMN IF NOT EXISTS site_name VARCHAR(200)"))
+    connection.execute(
+        text("UPDATE reservation_change SET site_name = reservation.site_name "
+             "FROM reservation "
+             "WHERE reservation.id = reservation_change.reservation_id"))
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_reservation_change_site "
+             "ON reservation_change (site_name, transaction_id, id)"))
+
+
+def create_daily_stat_table(connection):
+    """Count the reservations and doses per site, vaccine and day."""
+    connection.execute(
+        text("""
+        CREATE TABLE IF NOT EXISTS daily_stat (
+            site_name VARCHAR(200) NOT NULL,
+            vaccine_name VARCHAR(200) NOT NULL,
+            day DATE NOT NULL,
+            pending INTEGER NOT NULL DEFAULT 0,
+            queued INTEGER NOT NULL DEFAULT 0,
+            checked INTEGER NOT NULL DEFAULT 0,
+            doses INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (site_name, vaccine_name, day)
+        )"""))
+    for statement in DAILY_STAT_DDL + RECOMPUTE_DAILY_STATS:
+        connection.exec_driver_sql(statement)
+
+
+def create_job_table(connection):
+    """Persist the background jobs of app/jobs.py."""
+    connection.execute(
+        text("""
+        CREATE TABLE IF NOT EXISTS job (
+            id SERIAL PRIMARY KEY,
+            kind VARCHAR(50) NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            params JSON,
+            done BIGINT NOT NULL DEFAULT 0,
+            total BIGINT,
+            result JSON,
+            error TEXT,
+            worker VARCHAR(200),
+            username VARCHAR(200),
+            created_at TIMESTAMP WITHOUT TIME ZONE,
+            started_at TIMESTAMP WITHOUT TIME ZONE,
+            updated_at TIMESTAMP WITHOUT TIME ZONE,
+            finished_at TIMESTAMP WITHOUT TIME ZONE
+        )"""))
+    connection.execute(
+        text("CREATE INDEX IF NOT EXISTS ix_job_status ON job (status)"))
+
+
+def lock_daily_stat_pairs(connection):
+    """Update the daily_stat counters of a site and vaccine under a lock."""
+    for statement in DAILY_STAT_DDL:
+        connection.exec_driver_sql(statement)
+
+
+MIGRATIONS = [
+    ("0001_dose_history", create_dose_table),
+    ("0002_unchecked_reservation_index", create_unchecked_reservation_index),
+    ("0003_reservation_indexes", create_reservation_indexes),
+    ("0004_bigint_citizen_id", use_bigint_citizen_id),
+    ("0005_vaccine_sequence", create_vaccine_sequence_table),
+    ("0006_citizen_version", add_citizen_version),
+    ("0007_reservation_change", create_reservation_change_table),
+    ("0008_reservation_change_site", add_reservation_change_site),
+    ("0009_daily_stat", create_daily_stat_table),
+    ("0010_job", create_job_table),
+    ("0011_daily_stat_lock", lock_daily_stat_pairs),
+]
+
+
+def migrate():
+    """Bring the database schema up to date with the models."""
+    with db.engine.begin() as connection:
+        is_new = not inspect(connection).has_table(Citizen.__tablename__)
+        if is_new:
+            db.metadata.create_all(connection)
+
+        connection.execute(
+            text("""
+            CREATE TABLE IF NOT EXISTS schema_migration (
+                version VARCHAR(200) PRIMARY KEY,
+                applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+            )"""))
+        applied = {
+            version
+            for version, in connection.execute(
+                text("SELECT version FROM schema_migration"))
+        }
+
+        for version, migration in MIGRATIONS:
+            if version in applied:
+                continue
+            if not is_new:
+                logger.info("applying migration %s", version)
+                migration(connection)
+            connection.execute(
+                text("INSERT INTO schema_migration (version, applied_at) "
+                     "VALUES (:version, :applied_at)"), {
+                         "version": version,
+                         "applied_at": datetime.now()
+                     })
+
+
+if __name__ == '__main__':
+    migrate()
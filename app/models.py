@@ -1,33 +1,30 @@
 from flask import Flask
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 import os
 import logging
 
+from app.logs import setup_logging
+from app.replicas import RoutingSQLAlchemy, replica_binds
+
 app = Flask(__name__)
 CORS(app)
 
 app.debug = os.getenv("DEBUG")
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("SQLALCHEMY_DATABASE_URI")
+app.config['SQLALCHEMY_BINDS'] = replica_binds()
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
+log_listener = setup_logging(logger)
 
-formatter = logging.Formatter(
-    '%(asctime)s %(levelname)s %(name)s: %(message)s')
-
-file_handler = logging.FileHandler('government.log')
-file_handler.setFormatter(formatter)
-
-stream_handler = logging.StreamHandler()
-stream_handler.setFormatter(formatter)
 
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+def format_citizen_id(citizen_id):
+    """Return the 13 digits string of a citizen id stored as an integer"""
+    return str(citizen_id).zfill(13) if citizen_id is not None else "None"
 
 
 class Citizen(db.Model):
@@ -42,11 +39,14 @@ class Citizen(db.Model):
         phone_number (str): phone number
         is_risk (bool): True if has risks medical conditions
         address (str): current home address
-        vaccine_taken (list): list of vaccine taken
+        doses (list): the Dose history in the order they were taken
+        version (int): bumped whenever the citizen, their reservations or
+            doses change
+        updated_at (datetime): Date and time of the last change, in UTC
     """
     __tablename__ = 'citizen'
     id = db.Column(db.Integer, primary_key=True)
-    citizen_id = db.Column(db.Numeric, unique=True)
+    citizen_id = db.Column(db.BigInteger, unique=True)
     name = db.Column(db.String(200))
     surname = db.Column(db.String(200))
     birth_date = db.Column(db.Date)
@@ -54,7 +54,18 @@ class Citizen(db.Model):
     phone_number = db.Column(db.String(200), unique=True)
     is_risk = db.Column(db.Boolean)
     address = db.Column(db.Text())
-    vaccine_taken = db.Column(db.PickleType())
+    version = db.Column(db.Integer,
+                        nullable=False,
+                        default=1,
+                        server_default='1')
+    updated_at = db.Column(db.DateTime,
+                           default=datetime.utcnow,
+                           server_default=db.text("timezone('utc', now())"))
+    doses = db.relationship('Dose',
+                            order_by='Dose.sequence',
+                            lazy='selectin',
+                            cascade='all, delete-orphan',
+                            passive_deletes=True)
 
     def __init__(self, citizen_id, name, surname, birth_date, occupation,
                  phone_number, is_risk, address):
@@ -66,16 +77,18 @@ class Citizen(db.Model):
         self.phone_number = phone_number
         self.is_risk = is_risk
         self.address = address
-        self.vaccine_taken = []
-        logger.info(
-            'created Citizen: {} - {} {} - birth date: {} occupation: {} phone_number: {} is_risk: {} address: {} vaccine taken: {}'
-            .format(self.citizen_id, self.name, self.surname, self.birth_date,
-                    self.occupation, self.phone_number, self.is_risk,
-                    self.address, self.vaccine_taken))
+        self.doses = []
+        logger.info('created Citizen: %s - is_risk: %s', self.citizen_id,
+                    self.is_risk)
+
+    @property
+    def vaccine_taken(self):
+        """list: names of the vaccines taken, in order"""
+        return [dose.vaccine_name for dose in self.doses]
 
     def get_dict(self):
         return {
-            "citizen_id": str(self.citizen_id),
+            "citizen_id": format_citizen_id(self.citizen_id),
             "name": str(self.name),
             "surname": str(self.surname),
             "birth_date": str(self.birth_date),
@@ -100,12 +113,18 @@ class Reservation(db.Model):
         checked (bool): Check whether you got the vaccine or not
     """
     __tablename__ = 'reservation'
+    __table_args__ = (db.Index('uq_reservation_unchecked_citizen',
+                               'citizen_id',
+                               unique=True,
+                               postgresql_where=db.text('NOT checked')),
+                      db.Index('ix_reservation_citizen_id_checked',
+                               'citizen_id', 'checked'))
     id = db.Column(db.Integer, primary_key=True)
-    citizen_id = db.Column(db.Numeric)
-    site_name = db.Column(db.String(200))
+    citizen_id = db.Column(db.BigInteger)
+    site_name = db.Column(db.String(200), index=True)
     vaccine_name = db.Column(db.String(200))
     timestamp = db.Column(db.DateTime)
-    queue = db.Column(db.DateTime, default=None)
+    queue = db.Column(db.DateTime, default=None, index=True)
     checked = db.Column(db.Boolean, default=False)
 
     def __init__(self, citizen_id, site_name, vaccine_name):
@@ -113,14 +132,15 @@ class Reservation(db.Model):
         self.site_name = site_name
         self.vaccine_name = vaccine_name
         self.timestamp = datetime.now()
+        self.queue = None
+        self.checked = False
         logger.info(
-            'created Reservation: {} - site name: {} vaccine name: {} time: {} queue: {} checked: {}'
-            .format(self.citizen_id, self.site_name, self.vaccine_name,
-                    self.timestamp, self.queue, self.checked))
+            'created Reservation: %s - site name: %s vaccine name: %s time: %s',
+            self.citizen_id, self.site_name, self.vaccine_name, self.timestamp)
 
     def get_dict(self):
         return {
-            "citizen_id": str(self.citizen_id),
+            "citizen_id": format_citizen_id(self.citizen_id),
             "site_name": str(self.site_name),
             "vaccine_name": str(self.vaccine_name),
             "timestamp": str(self.timestamp),
@@ -129,6 +149,330 @@ class Reservation(db.Model):
         }
 
 
+class ReservationChange(db.Model):
+    """
+    A class to represent an entry of the reservation change feed.
+    Attributes:
+        id (int): order of the change within its transaction
+        transaction_id (int): id of the database transaction of the change,
+            the feed is read in (transaction_id, id) order
+        operation (str): "insert", "update", "delete", or "reset" when all
+            reservations were deleted
+        reservation_id (int): reservation ID, None for a reset
+        citizen_id (int): citizen ID, None for a reset
+        site_name (str): site of the reservation, None for a reset
+        timestamp (datetime): Date and time of the change, in UTC
+    """
+    __tablename__ = 'reservation_change'
+    __table_args__ = (db.Index('ix_reservation_change_cursor',
+                               'transaction_id', 'id'),
+                      db.Index('ix_reservation_change_site', 'site_name',
+                               'transaction_id', 'id'))
+    id = db.Column(db.BigInteger, primary_key=True)
+    transaction_id = db.Column(db.BigInteger,
+                               nullable=False,
+                               server_default=db.text('txid_current()'))
+    operation = db.Column(db.String(20), nullable=False)
+    reservation_id = db.Column(db.Integer)
+    citizen_id = db.Column(db.BigInteger)
+    site_name = db.Column(db.String(200))
+    timestamp = db.Column(db.DateTime)
+
+
+class Dose(db.Model):
+    """
+    A class to represent a vaccine dose taken by a citizen.
+    Attributes:
+        id (int): dose ID
+        citizen_id (int): citizen ID
+        vaccine_name (str): name of vaccine
+        sequence (int): 1 for the first dose of the citizen, 2 for the second...
+        timestamp (datetime): Date and time the dose was reported
+        site_name (str): name of the place for vaccination, None for unknown
+    """
+    __tablename__ = 'dose'
+    __table_args__ = (db.UniqueConstraint('citizen_id', 'sequence'), )
+    id = db.Column(db.Integer, primary_key=True)
+    citizen_id = db.Column(db.BigInteger,
+                           db.ForeignKey('citizen.citizen_id',
+                                         ondelete='CASCADE'),
+                           nullable=False)
+    vaccine_name = db.Column(db.String(200), nullable=False, index=True)
+    sequence = db.Column(db.Integer, nullable=False)
+    timestamp = db.Column(db.DateTime)
+    site_name = db.Column(db.String(200))
+
+    def __init__(self, citizen_id, vaccine_name, sequence, site_name=None):
+        self.citizen_id = citizen_id
+        self.vaccine_name = vaccine_name
+        self.sequence = sequence
+        self.site_name = site_name
+        self.timestamp = datetime.now()
+
+    def get_dict(self):
+        return {
+            "citizen_id": format_citizen_id(self.citizen_id),
+            "vaccine_name": str(self.vaccine_name),
+            "sequence": str(self.sequence),
+            "timestamp": str(self.timestamp),
+            "site_name": str(self.site_name)
+        }
+
+
+class VaccineSequence(db.Model):
+    """
+    A class to represent an allowed order of vaccine doses.
+    Attributes:
+        id (int): sequence ID
+        version (int): version of the rule set the sequence belongs to,
+            the highest version is the one in use
+        vaccines (list): names of the vaccines in the order they are taken
+        timestamp (datetime): Date and time the rule set was published
+    """
+    __tablename__ = 'vaccine_sequence'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, index=True)
+    vaccines = db.Column(db.ARRAY(db.String(200)), nullable=False)
+    timestamp = db.Column(db.DateTime)
+
+    def __init__(self, version, vaccines):
+        self.version = version
+        self.vaccines = vaccines
+        self.timestamp = datetime.now()
+
+
+class DailyStat(db.Model):
+    """
+    A class to represent the counters of a site, a vaccine and a day.
+    The triggers of DAILY_STAT_DDL keep them up to date in the transaction
+    of every write to the reservation and dose tables.
+    Attributes:
+        site_name (str): name of the vaccination site, '' for unknown
+        vaccine_name (str): name of vaccine
+        day (date): day of the queue of the reservations, of the
+            reservation while it has no queue, or of the dose, -infinity
+            for unknown
+        pending (int): reservations neither queued nor checked
+        queued (int): reservations queued but not checked
+        checked (int): reservations checked
+        doses (int): doses administered
+    """
+    __tablename__ = 'daily_stat'
+    site_name = db.Column(db.String(200), primary_key=True)
+    vaccine_name = db.Column(db.String(200), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    pending = db.Column(db.Integer, nullable=False, server_default='0')
+    queued = db.Column(db.Integer, nullable=False, server_default='0')
+    checked = db.Column(db.Integer, nullable=False, server_default='0')
+    doses = db.Column(db.Integer, nullable=False, server_default='0')
+
+
+# the stat rows of a reservation or dose table or transition table, with
+# sign -1 for the rows removed
+RESERVATION_STAT_ROWS = """
+    SELECT {sign} AS sign, site_name, vaccine_name,
+        CAST(coalesce(queue, timestamp) AS DATE) AS day,
+        NOT coalesce(checked, FALSE) AND queue IS NULL AS pending,
+        NOT coalesce(checked, FALSE) AND queue IS NOT NULL AS queued,
+        coalesce(checked, FALSE) AS checked, FALSE AS dose
+    FROM {rows}"""
+DOSE_STAT_ROWS = """
+    SELECT {sign} AS sign, site_name, vaccine_name,
+        CAST(timestamp AS DATE) AS day, FALSE AS pending, FALSE AS queued,
+        FALSE AS checked, TRUE AS dose
+    FROM {rows}"""
+
+# lock the site and vaccine pairs of the stat rows of {rows} until the
+# transaction ends, in name order. The counters of a pair are only updated
+# under its lock: a queue_report locks the day of the reservation then the
+# day of its queue, a report_taken the day of the queue then the day of the
+# dose, so locking the counter rows alone deadlocks
+LOCK_DAILY_STATS = """
+    PERFORM pg_advisory_xact_lock(hashtext('daily_stat'),
+                                  hashtext(site_name || '/' || vaccine_name))
+    FROM (SELECT DISTINCT coalesce(site_name, '') AS site_name,
+              coalesce(vaccine_name, '') AS vaccine_name
+          FROM ({rows}) change
+          ORDER BY 1, 2) pair"""
+
+# add the stat rows of {rows} to the counters, in key order
+ADD_DAILY_STATS = """
+    INSERT INTO daily_stat AS stat
+        (site_name, vaccine_name, day, pending, queued, checked, doses)
+    SELECT coalesce(site_name, ''), coalesce(vaccine_name, ''),
+        coalesce(day, DATE '-infinity'),
+        sum(sign * CAST(pending AS INTEGER)),
+        sum(sign * CAST(queued AS INTEGER)),
+        sum(sign * CAST(checked AS INTEGER)),
+        sum(sign * CAST(dose AS INTEGER))
+    FROM ({rows}) change
+    GROUP BY 1, 2, 3
+    HAVING sum(sign * CAST(pending AS INTEGER)) <> 0
+        OR sum(sign * CAST(queued AS INTEGER)) <> 0
+        OR sum(sign * CAST(checked AS INTEGER)) <> 0
+        OR sum(sign * CAST(dose AS INTEGER)) <> 0
+    ORDER BY 1, 2, 3
+    ON CONFLICT (site_name, vaccine_name, day) DO UPDATE SET
+        pending = stat.pending + excluded.pending,
+        queued = stat.queued + excluded.queued,
+        checked = stat.checked + excluded.checked,
+        doses = stat.doses + excluded.doses"""
+
+
+def update_daily_stats(rows):
+    """Return the plpgsql statements adding the stat rows of rows to
+    daily_stat under the locks of their site and vaccine pairs"""
+    return LOCK_DAILY_STATS.format(rows=rows) + ";" + ADD_DAILY_STATS.format(
+        rows=rows)
+
+
+def count_stats_function(name, stat_rows):
+    """Return the CREATE FUNCTION of a statement trigger that adds the
+    stat_rows of its transition tables to daily_stat"""
+    inserted = stat_rows.format(sign=1, rows="new_rows")
+    deleted = stat_rows.format(sign=-1, rows="old_rows")
+    return """
+        CREATE OR REPLACE FUNCTION {name}() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                {insert};
+            ELSIF TG_OP = 'UPDATE' THEN
+                {update};
+            ELSE
+                {delete};
+            END IF;
+            RETURN NULL;
+        END $$""".format(name=name,
+                         insert=update_daily_stats(inserted),
+                         update=update_daily_stats(inserted + " UNION ALL " +
+                                                   deleted),
+                         delete=update_daily_stats(deleted))
+
+
+def count_stats_triggers(table, function):
+    """Return the statements creating the triggers of a table"""
+    statements = []
+    for operation, transition in [("INSERT", "NEW TABLE AS new_rows"),
+                                  ("UPDATE", "OLD TABLE AS old_rows "
+                                   "NEW TABLE AS new_rows"),
+                                  ("DELETE", "OLD TABLE AS old_rows")]:
+        trigger = "{}_stats_{}".format(table, operation.lower())
+        statements.append("DROP TRIGGER IF EXISTS {} ON {}".format(
+            trigger, table))
+        statements.append(
+            "CREATE TRIGGER {} AFTER {} ON {} REFERENCING {} "
+            "FOR EACH STATEMENT EXECUTE FUNCTION {}()".format(
+                trigger, operation, table, transition, function))
+    trigger = "{}_stats_truncate".format(table)
+    statements.append("DROP TRIGGER IF EXISTS {} ON {}".format(trigger, table))
+    statements.append("CREATE TRIGGER {} AFTER TRUNCATE ON {} "
+                      "FOR EACH STATEMENT EXECUTE FUNCTION "
+                      "clear_daily_stats()".format(trigger, table))
+    return statements
+
+
+CLEAR_DAILY_STATS_FUNCTION = """
+    CREATE OR REPLACE FUNCTION clear_daily_stats() RETURNS trigger
+    LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_TABLE_NAME = 'reservation' THEN
+            UPDATE daily_stat SET pending = 0, queued = 0, checked = 0;
+        ELSE
+            UPDATE daily_stat SET doses = 0;
+        END IF;
+        DELETE FROM daily_stat
+        WHERE pending = 0 AND queued = 0 AND checked = 0 AND doses = 0;
+        RETURN NULL;
+    END $$"""
+
+# the functions and triggers that maintain daily_stat, run after
+# create_all() and by the migration that added the table
+DAILY_STAT_DDL = [
+    CLEAR_DAILY_STATS_FUNCTION,
+    count_stats_function("count_reservation_stats", RESERVATION_STAT_ROWS),
+    count_stats_function("count_dose_stats", DOSE_STAT_ROWS),
+] + count_stats_triggers("reservation", "count_reservation_stats") + (
+    count_stats_triggers("dose", "count_dose_stats"))
+
+# rebuild daily_stat from the tables, writes wait until the transaction ends
+RECOMPUTE_DAILY_STATS = [
+    "LOCK TABLE reservation, dose IN SHARE MODE",
+    "DELETE FROM daily_stat",
+    ADD_DAILY_STATS.format(rows=RESERVATION_STAT_ROWS.format(
+        sign=1, rows="reservation") + " UNION ALL " +
+                           DOSE_STAT_ROWS.format(sign=1, rows="dose")),
+]
+
+
+@db.event.listens_for(db.metadata, "after_create")
+def create_daily_stat_triggers(target, connection, **kw):
+    for statement in DAILY_STAT_DDL:
+        connection.exec_driver_sql(statement)
+
+
+class Job(db.Model):
+    """
+    A class to represent a background job, see app/jobs.py.
+    Attributes:
+        id (int): job ID
+        kind (str): what the job does, a key of JOB_RUNNERS
+        status (str): "queued", "running", "succeeded" or "failed"
+        params (dict): arguments of the job
+        done (int): units of work done, rows or lines
+        total (int): units of work to do, None when unknown
+        result (dict): outcome of a succeeded job
+        error (str): why a failed job failed
+        worker (str): "host:pid" of the process running the job
+        username (str): admin who submitted the job
+        created_at (datetime): Date and time the job was submitted
+        started_at (datetime): Date and time the job started
+        updated_at (datetime): Date and time of the last progress
+        finished_at (datetime): Date and time the job ended
+    """
+    __tablename__ = 'job'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, index=True)
+    params = db.Column(db.JSON)
+    done = db.Column(db.BigInteger, nullable=False, server_default='0')
+    total = db.Column(db.BigInteger)
+    result = db.Column(db.JSON)
+    error = db.Column(db.Text)
+    worker = db.Column(db.String(200))
+    username = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime)
+    started_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __init__(self, kind, params, worker, username):
+        self.kind = kind
+        self.status = "queued"
+        self.params = params
+        self.done = 0
+        self.worker = worker
+        self.username = username
+        self.created_at = datetime.now()
+        self.updated_at = self.created_at
+
+    def get_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "done": self.done,
+            "total": self.total,
+            "result": self.result,
+            "error": self.error,
+            "username": self.username,
+            "created_at": str(self.created_at),
+            "started_at": str(self.started_at),
+            "updated_at": str(self.updated_at),
+            "finished_at": str(self.finished_at)
+        }
+
+
 class Users(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(200), unique=True)
@@ -0,0 +1,233 @@
+"""Seed the database with a deterministic synthetic population.
+
+    $ python -m app.population 1000000
+
+Citizens are numbered from --first. Citizen number n has the citizen id
+make_citizen_id(n) and a phone number made of n, so both are unique, and
+the same --first and --seed always give the same population. Every
+citizen took a prefix of one of the published vaccine sequences, and some
+of those with doses left have an unchecked reservation for their next one.
+
+The rows are generated with numpy in chunks and streamed into Postgres with
+COPY, all in one transaction, and the reservations are added to the
+reservation change feed. The citizen ids and phone numbers must not be
+in the database yet.
+"""
+import argparse
+import io
+import sys
+import time
+
+from app.assistant import *
+
+CHUNK_SIZE = 100000
+DEFAULT_FIRST = 100000000000
+
+NAMES = [
+    "Somchai", "Somsak", "Somporn", "Malee", "Suda", "Anong", "Prasert",
+    "Niran", "Kanya", "Wichai", "Pranee", "Sompong", "Nattapong", "Ratana",
+    "Thanakorn", "Siriporn"
+]
+SURNAMES = [
+    "Saetang", "Srisuk", "Wongsawat", "Chaiyaporn", "Boonmee", "Rattanakul",
+    "Kaewmanee", "Suksawat", "Thongdee", "Phongphan", "Intharaksa",
+    "Chantarasri"
+]
+OCCUPATIONS = [
+    "farmer", "teacher", "nurse", "engineer", "merchant", "driver", "student",
+    "officer", "cook", "retired"
+]
+PROVINCES = [
+    "Bangkok", "Chiang Mai", "Khon Kaen", "Nakhon Ratchasima", "Phuket",
+    "Songkhla", "Udon Thani", "Chon Buri", "Nonthaburi", "Ayutthaya"
+]
+SITE_NAMES = ["OGYHSite", "BangSueSite", "CentralWorldSite", "MuangThongSite"]
+PHONE_PREFIXES = ["06", "08", "09"]
+PHONE_NUMBER_COUNT = len(PHONE_PREFIXES) * 10**8
+FIRST_BIRTH_DATE = np.datetime64("1930-01-01")
+LAST_BIRTH_DATE = np.datetime64("2008-12-31")
+RISK_RATE = 0.15
+RESERVATION_RATE = 0.3
+QUEUED_RATE = 0.5
+
+CITIZEN_COLUMNS = ("citizen_id", "name", "surname", "birth_date",
+                   "occupation", "phone_number", "is_risk", "address")
+DOSE_COLUMNS = ("citizen_id", "vaccine_name", "sequence", "timestamp",
+                "site_name")
+RESERVATION_COLUMNS = ("citizen_id", "site_name", "vaccine_name", "timestamp",
+                       "queue", "checked")
+COPY_TABLES = [
+    (Citizen.__tablename__, CITIZEN_COLUMNS),
+    (Dose.__tablename__, DOSE_COLUMNS),
+    (Reservation.__tablename__, RESERVATION_COLUMNS),
+]
+
+
+def get_published_sequences():
+    """Return the vaccine sequences in use, like get_vaccine_rules()"""
+    version = db.session.query(db.func.max(VaccineSequence.version)).scalar()
+    if version is None:
+        return VACCINE_SEQUENCE
+    return [
+        sequence.vaccines for sequence in VaccineSequence.query.filter_by(
+            version=version).order_by(VaccineSequence.id)
+    ]
+
+
+def make_citizen_ids(numbers):
+    """Return the citizen ids of an int64 array of 12 digits numbers, like
+    make_citizen_id()"""
+    digits = numbers[:, None] // 10**np.arange(11, -1, -1, dtype=np.int64) % 10
+    checksum = (11 - (digits @ ID_CHECKSUM_WEIGHTS) % 11) % 10
+    return numbers * 10 + checksum
+
+
+def make_phone_numbers(numbers):
+    """Return the phone numbers of an int64 array of numbers, distinct for
+    up to PHONE_NUMBER_COUNT consecutive numbers"""
+    return [
+        PHONE_PREFIXES[number // 10**8] + "{:08d}".format(number % 10**8)
+        for number in (numbers % PHONE_NUMBER_COUNT).tolist()
+    ]
+
+
+def generate_chunk(first, count, sequences, seed, now):
+    """Return the citizen, dose and reservation COPY rows of count citizens
+
+    Args:
+        first (int): number of the first citizen
+        count (int): number of citizens
+        sequences (list): the vaccine sequences the doses follow
+        seed (int): seed of the random choices
+        now (datetime): time of the doses and reservations, queues are set
+            a day later
+
+    Returns:
+        tuple: three strings in the COPY text format, in COPY_TABLES order
+    """
+    queue = (now + timedelta(days=1)).isoformat(sep=" ")
+    now = now.isoformat(sep=" ")
+    generator = np.random.default_rng([seed, first])
+    numbers = np.arange(first, first + count, dtype=np.int64)
+    citizen_ids = make_citizen_ids(numbers).tolist()
+    phone_numbers = make_phone_numbers(numbers)
+    birth_dates = (FIRST_BIRTH_DATE + generator.integers(
+        0, (LAST_BIRTH_DATE - FIRST_BIRTH_DATE).astype(int), count)).astype(
+            str).tolist()
+    names = generator.integers(0, len(NAMES), count).tolist()
+    surnames = generator.integers(0, len(SURNAMES), count).tolist()
+    occupations = generator.integers(0, len(OCCUPATIONS), count).tolist()
+    provinces = generator.integers(0, len(PROVINCES), count).tolist()
+    is_risks = (generator.random(count) < RISK_RATE).tolist()
+
+    patterns = generator.integers(0, len(sequences), count).tolist()
+    taken = generator.random(count)
+    sites = generator.integers(0, len(SITE_NAMES), count).tolist()
+    reserves = (generator.random(count) < RESERVATION_RATE).tolist()
+    queues = (generator.random(count) < QUEUED_RATE).tolist()
+
+    citizens, doses, reservations = [], [], []
+    for row, citizen_id in enumerate(citizen_ids):
+        citizens.append("\t".join(
+            (str(citizen_id), NAMES[names[row]], SURNAMES[surnames[row]],
+             birth_dates[row], OCCUPATIONS[occupations[row]],
+             phone_numbers[row], "t" if is_risks[row] else "f",
+             PROVINCES[provinces[row]])))
+
+        pattern = sequences[patterns[row]]
+        count_taken = int(taken[row] * (len(pattern) + 1))
+        site_name = SITE_NAMES[sites[row]]
+        for sequence, vaccine_name in enumerate(pattern[:count_taken], 1):
+            doses.append("\t".join((str(citizen_id), vaccine_name,
+                                    str(sequence), now, site_name)))
+        if count_taken < len(pattern) and reserves[row]:
+            reservations.append("\t".join(
+                (str(citizen_id), site_name, pattern[count_taken], now,
+                 queue if queues[row] else "\\N", "f")))
+
+    return tuple("".join(line + "\n" for line in lines)
+                 for lines in (citizens, doses, reservations))
+
+
+def copy_rows(cursor, table, columns, rows):
+    """COPY rows, a string in the COPY text format, into table"""
+    if rows:
+        cursor.copy_expert(
+            "COPY {} ({}) FROM STDIN".format(table, ", ".join(columns)),
+            io.StringIO(rows))
+
+
+def seed_population(count, first=DEFAULT_FIRST, seed=0):
+    """Insert count synthetic citizens with their doses and reservations.
+
+    Returns:
+        tuple: the number of (citizens, doses, reservations) inserted
+    """
+    sequences = get_published_sequences()
+    db.session.rollback()
+    now = datetime.now()
+    totals = [0] * len(COPY_TABLES)
+
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT coalesce(max(id), 0) FROM reservation")
+        last_reservation_id = cursor.fetchone()[0]
+        for start in range(first, first + count, CHUNK_SIZE):
+            size = min(CHUNK_SIZE, first + count - start)
+            chunk = generate_chunk(start, size, sequences, seed, now)
+            for index, (table, columns) in enumerate(COPY_TABLES):
+                copy_rows(cursor, table, columns, chunk[index])
+                totals[index] += chunk[index].count("\n")
+            logger.info("seeded %s of %s citizens", start - first + size,
+                        count)
+        cursor.execute(
+            "INSERT INTO reservation_change "
+            "(operation, reservation_id, citizen_id, site_name, timestamp) "
+            "SELECT 'insert', id, citizen_id, site_name, %s "
+            "FROM reservation "
+            "WHERE id > %s ORDER BY id",
+            (datetime.utcnow(), last_reservation_id))
+        cursor.execute(
+            "SELECT pg_notify(%s, site_name) FROM "
+            "(SELECT DISTINCT site_name FROM reservation WHERE id > %s) site",
+            (CHANGE_CHANNEL, last_reservation_id))
+        connection.commit()
+    finally:
+        connection.close()
+    return tuple(totals)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.population",
+        description="Seed the database with synthetic citizens.")
+    parser.add_argument("count", type=int, help="number of citizens")
+    parser.add_argument("--first",
+                        type=int,
+                        default=DEFAULT_FIRST,
+                        help="number of the first citizen, its citizen id "
+                        "is this number followed by the checksum digit")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    if not 10**11 <= args.first <= 10**12 - args.count:
+        parser.error("the citizen numbers must have 12 digits")
+    if args.count > PHONE_NUMBER_COUNT:
+        parser.error("at most {} citizens have distinct phone numbers".format(
+            PHONE_NUMBER_COUNT))
+    return args
+
+
+def main(argv):
+    args = parse_args(argv)
+    start = time.perf_counter()
+    with app.app_context():
+        citizens, doses, reservations = seed_population(
+            args.count, args.first, args.seed)
+    print("seeded {} citizens, {} doses and {} reservations in {:.1f}s".format(
+        citizens, doses, reservations, time.perf_counter() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,177 @@
+"""Route the reads of read-only endpoints to Postgres streaming replicas.
+
+The replicas are Flask-SQLAlchemy binds named replica_0, replica_1, ...
+A request reads from a replica only when its view is decorated with
+read_replica() in app/app.py and sets g.replica_bind, everything else,
+and every write, uses the primary of SQLALCHEMY_DATABASE_URI.
+
+Each process runs one thread that measures the replay lag of the replicas
+every REPLICA_CHECK_SECONDS, so no request waits for it, and stops reading
+a replica that is more than REPLICA_MAX_LAG_SECONDS behind or unreachable,
+the reads then fall back to the primary. The reads go to the primary until
+the first measure.
+
+A client that wrote reads from the primary for READ_PRIMARY_SECONDS,
+longer than a readable replica can be behind, so it sees its own writes.
+The deadline is sent back both as a cookie and as a response header, a
+client that keeps neither cookies nor the header, and does not send it
+back on its reads, may not see its writes for up to
+REPLICA_MAX_LAG_SECONDS.
+
+Configuration, from the environment:
+    SQLALCHEMY_REPLICA_URIS (str): comma separated URIs of the replicas,
+        all reads go to the primary when empty
+    REPLICA_MAX_LAG_SECONDS (float): the lag above which a replica is not
+        read
+    REPLICA_CHECK_SECONDS (float): how often the lag is measured
+    REPLICA_CONNECT_TIMEOUT_SECONDS (int): how long to wait for a replica
+        to accept a connection, 2 seconds at least for libpq
+    READ_PRIMARY_SECONDS (float): how long a client reads from the primary
+        after a write
+"""
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from prometheus_client import Gauge
+from sqlalchemy import orm, text
+from sqlalchemy.engine import make_url
+import logging
+import os
+import random
+import threading
+import time
+
+REPLICA_URIS = [
+    uri.strip()
+    for uri in os.getenv("SQLALCHEMY_REPLICA_URIS", "").split(",")
+    if uri.strip()
+]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", 5))
+REPLICA_CHECK_SECONDS = float(os.getenv("REPLICA_CHECK_SECONDS", 5))
+REPLICA_CONNECT_TIMEOUT_SECONDS = int(
+    os.getenv("REPLICA_CONNECT_TIMEOUT_SECONDS", 2))
+READ_PRIMARY_SECONDS = float(
+    os.getenv("READ_PRIMARY_SECONDS",
+              2 * (REPLICA_MAX_LAG_SECONDS + REPLICA_CHECK_SECONDS)))
+
+# seconds since the last replayed transaction, 0 when the replica replayed
+# all it received, NULL when it does not stream from the primary. Only the
+# pid of pg_stat_wal_receiver is shown to roles without pg_read_all_stats,
+# its row exists while the WAL receiver runs, and the received position
+# once it has streamed, so the app role needs no grant
+REPLICA_LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver)
+            OR pg_last_wal_receive_lsn() IS NULL THEN NULL
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END""")
+
+REPLICA_LAG = Gauge("government_db_replica_lag_seconds",
+                    "Replay lag of the read replicas, -1 when unreachable",
+                    ["replica"],
+                    multiprocess_mode="max")
+
+# the logger of app/models.py, its records go through setup_logging()
+logger = logging.getLogger("app.models")
+
+
+def replica_binds():
+    """Return the SQLALCHEMY_BINDS of the REPLICA_URIS, with a
+    connect_timeout so an unreachable replica fails fast"""
+    binds = {}
+    for index, uri in enumerate(REPLICA_URIS):
+        url = make_url(uri)
+        if "connect_timeout" not in url.query:
+            url = url.update_query_dict(
+                {"connect_timeout": str(REPLICA_CONNECT_TIMEOUT_SECONDS)})
+        binds["replica_{}".format(index)] = url.render_as_string(
+            hide_password=False)
+    return binds
+
+
+def is_readable(lag):
+    """Return True if a replica with this lag, None if unknown, can be read"""
+    return lag is not None and lag <= REPLICA_MAX_LAG_SECONDS
+
+
+class RoutingSession(SignallingSession):
+    """A session that runs the queries of a read_replica() request on the
+    replica chosen for it."""
+
+    def get_bind(self, mapper=None, clause=None):
+        bind_key = g.get("replica_bind") if has_app_context() else None
+        if bind_key is not None:
+            return get_state(self.app).db.get_engine(self.app, bind=bind_key)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with read replicas, see the module docstring."""
+
+    def __init__(self, *args, **kwargs):
+        self.replica_lags = {}
+        self.replica_monitor = None
+        self.replica_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def measure_replica_lags(self, flask_app):
+        """Measure the lag of every replica, None when it is unreachable"""
+        for bind_key in replica_binds():
+            try:
+                with self.get_engine(flask_app,
+                                     bind=bind_key).connect() as connection:
+                    lag = connection.execute(REPLICA_LAG_QUERY).scalar()
+                error = "not streaming" if lag is None else None
+            except Exception as e:
+                lag, error = None, e
+            lag = float(lag) if lag is not None else None
+            if is_readable(self.replica_lags.get(bind_key, 0)) and (
+                    not is_readable(lag)):
+                logger.warning("%s - replica lag %s, reading the primary",
+                               bind_key, lag if error is None else error)
+            elif is_readable(lag) and not is_readable(
+                    self.replica_lags.get(bind_key, 0)):
+                logger.info("%s - replica caught up", bind_key)
+            # replaced, not updated, as the requests read it meanwhile
+            self.replica_lags = dict(self.replica_lags, **{bind_key: lag})
+            REPLICA_LAG.labels(bind_key).set(lag if lag is not None else -1)
+
+    def monitor_replicas(self, flask_app):
+        """Measure the lag of the replicas every REPLICA_CHECK_SECONDS,
+        the target of the replica-monitor thread"""
+        while True:
+            started = time.monotonic()
+            try:
+                self.measure_replica_lags(flask_app)
+            except Exception:
+                logger.exception("replica lag check failed")
+            time.sleep(
+                max(0, REPLICA_CHECK_SECONDS - (time.monotonic() - started)))
+
+    def choose_replica(self, flask_app):
+        """Return the bind key of a replica to read from, None to read from
+        the primary
+
+        The first call of a process starts its replica-monitor thread, the
+        requests only read the last measure, see monitor_replicas().
+        """
+        if not REPLICA_URIS:
+            return None
+        if self.replica_monitor is None:
+            with self.replica_lock:
+                if self.replica_monitor is None:
+                    self.replica_monitor = threading.Thread(
+                        target=self.monitor_replicas,
+                        args=(flask_app, ),
+                        name="replica-monitor",
+                        daemon=True)
+                    self.replica_monitor.start()
+        readable = [
+            bind_key for bind_key, lag in self.replica_lags.items()
+            if is_readable(lag)
+        ]
+        return random.choice(readable) if readable else None
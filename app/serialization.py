@@ -0,0 +1,155 @@
+"""Serialize large lists without loading ORM objects.
+
+A list endpoint selects only the columns it returns, as plain row tuples,
+and turns each row into JSON with an Encoder built once for its shape.
+The output is the same as json.dumps(get_dict(), ensure_ascii=False) of
+the ORM objects, without building the objects, their dose collections and
+the intermediate dicts. The encoded rows of a batch of STREAM_BATCH_SIZE
+are collected in one reused buffer and sent as one chunk.
+
+    $ python -m app.benchmark_serialization
+
+compares the cost per row with the ORM path.
+"""
+from json.encoder import encode_basestring
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+
+from app.assistant import *
+
+
+def encode_string(value):
+    """Return the JSON of str(value), as get_dict() does for most fields"""
+    return encode_basestring(str(value))
+
+
+def encode_citizen_id(value):
+    return encode_basestring(format_citizen_id(value))
+
+
+def encode_integer(value):
+    return str(value)
+
+
+class Encoder:
+    """Encode row tuples as JSON objects with fixed keys.
+
+    The keys are formatted into a template once, encoding a row is a single
+    %-format of the template with one converter call per column, so it
+    makes no dict and no per-key dispatch.
+
+    Args:
+        fields (list): (key, converter) in the order of the object, a
+            converter turns the value at its position in the row into JSON
+            text. A nested Encoder encodes the next columns of the row as
+            an object.
+    """
+
+    def __init__(self, fields):
+        parts, self.converters = [], []
+        for key, converter in fields:
+            if isinstance(converter, Encoder):
+                parts.append("{}: {}".format(encode_basestring(key),
+                                             converter.template))
+                self.converters.extend(converter.converters)
+            else:
+                parts.append("{}: %s".format(encode_basestring(key)))
+                self.converters.append(converter)
+        self.template = "{" + ", ".join(parts) + "}"
+
+    def encode(self, row):
+        return self.template % tuple(
+            convert(value) for convert, value in zip(self.converters, row))
+
+
+# the vaccine names of a citizen in order, like Citizen.vaccine_taken
+VACCINE_TAKEN = db.select(
+    db.func.coalesce(
+        db.func.array_agg(aggregate_order_by(Dose.vaccine_name,
+                                             Dose.sequence)),
+        db.literal_column("'{}'::varchar[]"))).where(
+            Dose.citizen_id == Citizen.citizen_id).scalar_subquery()
+
+# columns and encoder of Citizen.get_dict()
+CITIZEN_COLUMNS = (Citizen.citizen_id, Citizen.name, Citizen.surname,
+                   Citizen.birth_date, Citizen.occupation,
+                   Citizen.phone_number, Citizen.is_risk, Citizen.address,
+                   VACCINE_TAKEN)
+CITIZEN_ENCODER = Encoder([
+    ("citizen_id", encode_citizen_id),
+    ("name", encode_string),
+    ("surname", encode_string),
+    ("birth_date", encode_string),
+    ("occupation", encode_string),
+    ("phone_number", encode_string),
+    ("is_risk", encode_string),
+    ("address", encode_string),
+    ("vaccine_taken", encode_string),
+])
+
+# columns and encoder of an item of GET /reservations, the
+# Reservation.get_dict() with the id and the citizen_data of its citizen
+RESERVATION_LIST_COLUMNS = (Reservation.citizen_id, Reservation.site_name,
+                            Reservation.vaccine_name, Reservation.timestamp,
+                            Reservation.queue, Reservation.checked,
+                            Reservation.id) + CITIZEN_COLUMNS
+RESERVATION_LIST_ENCODER = Encoder([
+    ("citizen_id", encode_citizen_id),
+    ("site_name", encode_string),
+    ("vaccine_name", encode_string),
+    ("timestamp", encode_string),
+    ("queue", encode_string),
+    ("checked", encode_string),
+    ("id", encode_integer),
+    ("citizen_data", CITIZEN_ENCODER),
+])
+
+
+def iter_reservation_rows(after=0, limit=None):
+    """Yield batches of RESERVATION_LIST_COLUMNS rows in reservation id
+    order through a server-side cursor
+
+    Args:
+        after (int): only reservations with an id greater than this are returned
+        limit (int): maximum number of reservations, None for no limit
+
+    Returns:
+        generator: lists of up to STREAM_BATCH_SIZE row tuples
+    """
+    query = db.select(*RESERVATION_LIST_COLUMNS).join(
+        Citizen, Citizen.citizen_id == Reservation.citizen_id).where(
+            Reservation.id > after).order_by(Reservation.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return db.session.execute(query,
+                              execution_options={
+                                  "stream_results": True
+                              }).partitions(STREAM_BATCH_SIZE)
+
+
+def stream_rows(batches, encoder, ndjson=False):
+    """Serialize batches of rows as a JSON array or newline-delimited JSON
+
+    Args:
+        batches (iterable): lists of row tuples
+        encoder (Encoder): the encoder of the rows
+        ndjson (bool): True to emit one JSON document per line
+
+    Returns:
+        generator: one chunk of the serialized response body per batch
+    """
+    encode = encoder.encode
+    buffer = []
+    start = "" if ndjson else "["
+    for rows in batches:
+        buffer.extend(map(encode, rows))
+        if not buffer:
+            continue
+        if ndjson:
+            buffer.append("")
+            yield "\n".join(buffer)
+        else:
+            yield start + ", ".join(buffer)
+            start = ", "
+        buffer.clear()
+    if not ndjson:
+        yield "[]" if start == "[" else "]"
@@ -0,0 +1,24 @@
+"""gunicorn settings, read from the working directory by `gunicorn app.app:app`"""
+import os
+import shutil
+import tempfile
+
+# an open /sites/<site_name>/events stream holds a thread, see app/events.py
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 32))
+
+# every worker writes its metrics here, /metrics sums them
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR",
+                      os.path.join(tempfile.gettempdir(), "government-metrics"))
+
+
+def on_starting(server):
+    """Start from empty metrics, the files of a previous run are stale"""
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+
+def child_exit(server, worker):
+    """Drop the live gauges of a dead worker"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)